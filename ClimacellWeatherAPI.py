@@ -2,9 +2,14 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import datetime
+import asyncio
 import concurrent.futures
+import datetime
+import hashlib
+import math
 import sys
+import threading
+import time
 
 #  These may be available in distro packages, or may need to be
 #  installed with pip
@@ -21,8 +26,55 @@ from astral import moon
 #  probably needs to be installed with pip.
 from timezonefinder import TimezoneFinder
 
-#  Application module
+#  Application modules
+import DarkskyAPICache
 import DarkskyAPIFunctions as functions
+import DarkskyAPIMetrics
+
+#  A free Climacell API key gets 1000 calls a day.  The calls made with
+#  each key are counted, by all of the worker processes, and
+#  climacell_quota_reserve of them are never used so that a miscount
+#  can't get the key refused.  Climacell's day is assumed to start at
+#  midnight UTC.
+climacell_daily_quota = 1000
+climacell_quota_reserve = 10
+
+#  How often each Climacell endpoint is called for a location, in
+#  seconds, when the key's quota allows it.  Responses are built from the
+#  data from the last call in between.  When the rest of today's quota
+#  won't stretch that far, between all of the locations requested with
+#  the key in the last climacell_active_window seconds, the intervals are
+#  all made longer by the same factor.
+climacell_refresh_intervals = {'current': 300, 'minutely': 300, 'hourly': 1800, 'daily': 10800}
+climacell_active_window = 3600
+
+#  The oldest data from each endpoint that is used.  An endpoint whose
+#  interval would have to be made longer than this isn't called any more,
+#  today, and its section is left to NOAA.  The minute-by-minute forecast
+#  goes first and the hourly forecast last.
+climacell_max_ages = {'current': 1800, 'minutely': 900, 'hourly': 6 * 3600, 'daily': 86400}
+
+#  The number of seconds that each process keeps its plan for a key
+#  before counting the calls and locations again
+climacell_plan_ttl = 60
+
+#  The data from the last call to each endpoint for each location, the
+#  calls made with each key today and the locations requested with each
+#  key recently, shared by all of the worker processes
+_payloads = DarkskyAPICache.PersistentCache('climacell_payloads')
+_quota = DarkskyAPICache.PersistentCache('climacell_quota')
+_active = DarkskyAPICache.PersistentCache('climacell_active')
+
+#  What the asynchronous calls return for the endpoints that are skipped
+#  to save the quota
+_skipped = object()
+
+#  Each process's plan for each key, and the times it last marked each
+#  location active, so that it doesn't write to the shared tables on
+#  every request
+_plans = {}
+_marked = {}
+_budget_lock = threading.Lock()
 
 def _mapIcons(icon, flask_app=None):
 	"""
@@ -83,13 +135,13 @@ def _mapIcons(icon, flask_app=None):
 	return ''
 
 def _mapClimacellWeatherCode(code):
-	'''
+	"""
 	Translate Climacell's weather_code values into short text phrases
 	 
 	code: a Climacell weather_code
 	
 	Returns a string
-	'''
+	"""
 	weather_codes = {
 		'freezing_rain_heavy': 'Heavt Freezing Rain', 
 		'freezing_rain': 'Freezing Rain', 
@@ -125,18 +177,292 @@ def _mapClimacellWeatherCode(code):
 	return ''
 
 def _epochTime(dt_str):
-	'''
+	"""
 	Convert Climacell date string to UNIX epoch timestamp
-	'''
+	"""
 	return int(datetime.datetime.strptime(dt_str, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=datetime.timezone.utc).timestamp())
 	
 def _dailyEpochTime(dt_str):
-	'''
+	"""
 	Convert Climacell daily date string to UNIX epoch timestamp
-	'''
+	"""
 	return int(datetime.datetime.combine(datetime.datetime.strptime(dt_str, '%Y-%m-%d'), datetime.time()).timestamp())	
-def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
-	'''
+
+#  The Climacell API calls and the sections of the output that they are for
+_sections = [('current', 'currently'), ('minutely', 'minutely'), ('hourly', 'hourly'), ('daily', 'daily')]
+
+def fetch(latitude, longitude, apikey, flask_app=None, exclude=()):
+	"""
+	Start all of the Climacell API calls for a location.  The calls run in
+	the background so that the caller can do other work, like collecting
+	the NOAA data, while they complete.
+	
+	Latitude
+	longitude: geolocation obtained from the request URL
+	apikey: the user's Climacell API key from a free account (or paid)
+	flask_app : an object containing a Flask application's details.  Used
+                to allow us to write into the application log.
+	exclude: the DarkSky blocks, like "minutely", whose API calls should
+	         be skipped
+	
+	Returns a dictionary of concurrent.futures.Future objects, keyed by
+	"current", "minutely", "hourly" and "daily", that can be passed to
+	the get function.  The calls for excluded blocks are left out.
+	"""
+
+	#  Do all of the Climacell API calls simultaneously, in seperate
+	#  threads, to save time.  The data that is recent enough, or that
+	#  the key's quota can't spare a call for, comes from the last call.
+	cc_headers = _headers(apikey)
+	calls, cached = _plan(latitude, longitude, apikey, exclude)
+	fetched = {}
+	for name, url in calls.items():
+		fetched[name] = functions.submit(_fetchPayload, name, latitude, longitude, url, cc_headers, flask_app)
+	for name, payload in cached.items():
+		fetched[name] = concurrent.futures.Future()
+		fetched[name].set_result(payload)
+	return fetched
+
+def fetchAsync(session, latitude, longitude, apikey, flask_app=None, exclude=()):
+	"""
+	The asynchronous version of fetch.  The calls are made with aiohttp as
+	asyncio tasks.
+
+	session: the aiohttp.ClientSession returned by
+	         DarkskyAPIFunctions.createAsyncSession
+
+	Returns a dictionary of asyncio tasks that can be passed to getAsync.
+	The tasks for the endpoints that the key's quota can't spare a call
+	for, and that have no recent data, return _skipped.
+	"""
+	cc_headers = _headers(apikey)
+	#  The plan reads and writes the shared tables, so it is made on
+	#  another thread and the calls wait for it
+	plan = asyncio.ensure_future(functions.runBlocking(_plan, latitude, longitude, apikey, exclude))
+	fetched = {}
+	for name in _urls(latitude, longitude, exclude):
+		fetched[name] = asyncio.ensure_future(_fetchPlannedAsync(session, plan, name, latitude, longitude, cc_headers, flask_app))
+	return fetched
+
+def _headers(apikey):
+	"""
+	Returns the headers to send with the Climacell API calls
+	"""
+	return {
+		'Accept': 'application/json',
+		'apikey': apikey
+	}
+
+def _urls(latitude, longitude, exclude=()):
+	"""
+	Returns a dictionary of the Climacell API URLs for a location, keyed
+	by "current", "minutely", "hourly" and "daily".  The URLs for excluded
+	blocks are left out.
+	"""
+	urls = {}
+
+	if 'currently' not in exclude:
+		urls['current'] = 'https://api.climacell.co/v3/weather/realtime?lat={}&lon={}&unit_system=us&fields=precipitation,precipitation%3Ain%2Fhr,precipitation_type,temp,feels_like,dewpoint,wind_speed,wind_gust,baro_pressure%3AhPa,visibility,humidity,wind_direction,cloud_cover,weather_code,o3'.format(latitude, longitude)
+
+	if 'minutely' not in exclude:
+		minutely_starttime = (functions.utcnow() + datetime.timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+		minutely_endtime = (functions.utcnow() + datetime.timedelta(minutes=61)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+		urls['minutely'] = 'https://api.climacell.co/v3/weather/nowcast?lat={}&lon={}&unit_system=us&fields=precipitation%3Ain%2Fhr,precipitation_type&start_time={}&end_time={}&timestep=1'.format(latitude, longitude, minutely_starttime, minutely_endtime)
+
+	if 'hourly' not in exclude:
+		urls['hourly'] = 'https://api.climacell.co/v3/weather/forecast/hourly?lat={}&lon={}&unit_system=us&fields=precipitation,precipitation%3Ain%2Fhr,precipitation_type,precipitation_probability,temp,feels_like,dewpoint,wind_speed,wind_gust,baro_pressure%3AhPa,visibility,humidity,wind_direction,cloud_cover,weather_code,o3&start_time=now'.format(latitude, longitude)
+
+	if 'daily' not in exclude:
+		urls['daily'] = 'https://api.climacell.co/v3/weather/forecast/daily?lat={}&lon={}&start_time=now&unit_system=us&fields=temp,feels_like,wind_speed,wind_direction,baro_pressure%3AhPa,precipitation,precipitation%3Ain%2Fhr,precipitation_probability,visibility,humidity,sunrise,sunset,weather_code'.format(latitude, longitude)
+
+	return urls
+
+def _apikeyHash(apikey):
+	return hashlib.sha256(apikey.encode()).hexdigest()[:16]
+
+def _payloadKey(name, latitude, longitude):
+	return '{}|{:.3f},{:.3f}'.format(name, latitude, longitude)
+
+def _fetchPayload(name, latitude, longitude, url, headers, flask_app=None):
+	"""
+	Make a Climacell API call and keep its data for the requests that
+	follow
+
+	Returns a JSON object or "False", like DarkskyAPIFunctions.getURL
+	"""
+	payload = functions.getURL(url, headers, flask_app)
+	if payload:
+		_payloads.put(_payloadKey(name, latitude, longitude), {'fetched': time.time(), 'payload': payload}, climacell_max_ages[name])
+	return payload
+
+async def _fetchPlannedAsync(session, plan, name, latitude, longitude, headers, flask_app=None):
+	"""
+	The asynchronous version of _fetchPayload.  Waits for the plan made
+	by _plan and then makes the call, or uses the data from the last one,
+	as it says.
+
+	plan: an asyncio task that returns the result of _plan
+
+	Returns a JSON object, "False", or _skipped if the plan has neither a
+	call nor data for the endpoint
+	"""
+	calls, cached = await plan
+	if name in cached:
+		return cached[name]
+	if name not in calls:
+		return _skipped
+	payload = await functions.getURLAsync(session, calls[name], headers, flask_app)
+	if payload:
+		await functions.runBlocking(_payloads.put, _payloadKey(name, latitude, longitude), {'fetched': time.time(), 'payload': payload}, climacell_max_ages[name])
+	return payload
+
+def _quotaKey(apikey_hash):
+	return '{}|{}'.format(datetime.datetime.now(datetime.timezone.utc).date().isoformat(), apikey_hash)
+
+def _markActive(apikey_hash, latitude, longitude):
+	"""
+	Note that a location has been requested with a key.  Each process
+	only writes this to the shared table a few times a window.
+	"""
+	now = time.time()
+	key = '{}|{:.3f},{:.3f}'.format(apikey_hash, latitude, longitude)
+	with _budget_lock:
+		if _marked.get(key, 0) > now - climacell_active_window / 4:
+			return
+		if len(_marked) > 4096:
+			for marked_key, marked in list(_marked.items()):
+				if marked < now - climacell_active_window:
+					del _marked[marked_key]
+		_marked[key] = now
+	_active.put(key, True, climacell_active_window)
+
+def _budget(apikey_hash):
+	"""
+	Work out how much longer than climacell_refresh_intervals the
+	intervals between the calls made with a key have to be to make the
+	rest of today's quota last until midnight, and which endpoints can't
+	be called at all.  Each process does this every climacell_plan_ttl
+	seconds for each key.
+
+	Returns a (factor, set of the endpoints not to call) tuple
+	"""
+	now = time.time()
+	with _budget_lock:
+		plan = _plans.get(apikey_hash)
+	if plan and plan['time'] > now - climacell_plan_ttl:
+		return (plan['stretch'], plan['dropped'])
+
+	spent = _quota.get(_quotaKey(apikey_hash)) or 0
+	locations = len([key for key, value in _active.items() if key.startswith(apikey_hash + '|')])
+	supply = (climacell_daily_quota - climacell_quota_reserve - spent) / (86400 - now % 86400)
+
+	#  Stop calling the endpoint whose interval has the least room to
+	#  grow, one at a time, until the others fit in the quota
+	dropped = set()
+	while True:
+		demand = max(1, locations) * sum([1 / interval for name, interval in climacell_refresh_intervals.items() if name not in dropped])
+		stretch = max(1, demand / supply) if supply > 0 else math.inf
+		over = [name for name in climacell_refresh_intervals if name not in dropped and climacell_refresh_intervals[name] * stretch > climacell_max_ages[name]]
+		if not over:
+			break
+		dropped.add(min(over, key=lambda name: climacell_max_ages[name] / climacell_refresh_intervals[name]))
+
+	if (plan['dropped'] if plan else set()) != dropped:
+		print('Climacell endpoints not being called for API key {}: {}'.format(apikey_hash, ', '.join(sorted(dropped)) or 'none'))
+	with _budget_lock:
+		_plans[apikey_hash] = {'time': now, 'stretch': stretch, 'dropped': dropped}
+	return (stretch, dropped)
+
+def _spendCall(apikey_hash):
+	"""
+	Count a Climacell call against a key's quota for today
+
+	Returns False, and counts nothing, if the quota has been used up
+	"""
+	key = _quotaKey(apikey_hash)
+	spent = _quota.increment(key, 1, 2 * 86400)
+	if spent is None:
+		#  The count couldn't be kept, so let the call go ahead rather than
+		#  leave the response without Climacell's data
+		return True
+	if spent > climacell_daily_quota - climacell_quota_reserve:
+		_quota.increment(key, -1, 2 * 86400)
+		return False
+	return True
+
+def _plan(latitude, longitude, apikey, exclude=()):
+	"""
+	Decide which of the Climacell API calls for a location to make, and
+	which endpoints' data to take from the last call instead, to keep
+	within the key's daily quota
+
+	Returns a (calls, cached) tuple of dictionaries keyed like the one
+	returned by _urls.  calls holds the URLs to call and cached the data
+	to use instead.  Endpoints that are in neither have no data that is
+	recent enough and can't be called, and their sections are left to
+	NOAA.
+	"""
+	apikey_hash = _apikeyHash(apikey)
+	_markActive(apikey_hash, latitude, longitude)
+	stretch, dropped = _budget(apikey_hash)
+	now = time.time()
+	calls = {}
+	cached = {}
+	for name, url in _urls(latitude, longitude, exclude).items():
+		last = _payloads.get(_payloadKey(name, latitude, longitude))
+		if last and (name in dropped or now - last['fetched'] < climacell_refresh_intervals[name] * stretch):
+			cached[name] = last['payload']
+			decision = 'cached'
+		elif name not in dropped and _spendCall(apikey_hash):
+			calls[name] = url
+			decision = 'called'
+		elif last:
+			cached[name] = last['payload']
+			decision = 'cached'
+		else:
+			decision = 'skipped'
+		DarkskyAPIMetrics.inc('darksky_climacell_budget_total', {'endpoint': name, 'decision': decision})
+	return (calls, cached)
+
+def _fetchedResult(future, name, section, flask_app=None):
+	"""
+	Wait for one of the API calls started by the fetch function to finish,
+	but not past the deadline for the section of the response that it is
+	for, and return its result.  Returns None if it raised an exception
+	or didn't finish in time.
+	"""
+	try:
+		return functions.waitFor(future, section)
+	except concurrent.futures.TimeoutError:
+		if flask_app:
+			flask_app.logger.warning('{} API call was not finished in time'.format(name))
+		print('{} API call was not finished in time'.format(name))
+		return None
+	except:
+		if flask_app:
+			flask_app.logger.error('Exception occurred during {} API call: {}'.format(name, sys.exc_info()[0]))
+		print('Exception occurred during {} API call: {}'.format(name, sys.exc_info()[0]))
+		return None
+
+async def _fetchedResultAsync(task, name, section, flask_app=None):
+	"""
+	The asynchronous version of _fetchedResult
+	"""
+	try:
+		return await functions.waitForAsync(task, section)
+	except asyncio.TimeoutError:
+		if flask_app:
+			flask_app.logger.warning('{} API call was not finished in time'.format(name))
+		print('{} API call was not finished in time'.format(name))
+		return None
+	except Exception:
+		if flask_app:
+			flask_app.logger.error('Exception occurred during {} API call: {}'.format(name, sys.exc_info()[0]))
+		print('Exception occurred during {} API call: {}'.format(name, sys.exc_info()[0]))
+		return None
+
+def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None, fetched=None, exclude=(), extend=None):
+	"""
 	Use the weather data from the Climacell API.  This data will overwrite
 	and extend what we got from NOAA.
 	
@@ -150,80 +476,77 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 	                  scratch.
 	flask_app : an object containing a Flask application's details.  Used
                 to allow us to write into the application log.
+	fetched: the dictionary of API calls returned by the fetch function,
+	         if the caller started them ahead of time.  This is optional.
+	         If it isn't passed through then the calls are made here.
+	exclude: the DarkSky blocks to leave out, as for the fetch function
+	extend: "hourly" to return 168 hours of hourly data instead of 48
 	                   
 	Returns a DarkSky JSON structure that can be the output of this web
-	service
-	'''
+	service.  Sections whose Climacell data couldn't be obtained before
+	the response's deadline are listed in the "partial" flag.
+	"""
 
-	cc_headers = {
-		'Accept': 'application/json',
-		'apikey': apikey
-	}
-	
-	#  Do all of the Climacell API calls simultaneously, in seperate
-	#  threads, to save time
-	with concurrent.futures.ThreadPoolExecutor() as executor:
-		url = 'https://api.climacell.co/v3/weather/realtime?lat={}&lon={}&unit_system=us&fields=precipitation,precipitation%3Ain%2Fhr,precipitation_type,temp,feels_like,dewpoint,wind_speed,wind_gust,baro_pressure%3AhPa,visibility,humidity,wind_direction,cloud_cover,weather_code,o3'.format(latitude, longitude)
-		get_current = executor.submit(functions.getURL, url, cc_headers, flask_app)
-	
-		minutely_starttime = (datetime.datetime.utcnow() + datetime.timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
-		minutely_endtime = (datetime.datetime.utcnow() + datetime.timedelta(minutes=61)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
-		url = 'https://api.climacell.co/v3/weather/nowcast?lat={}&lon={}&unit_system=us&fields=precipitation%3Ain%2Fhr,precipitation_type&start_time={}&end_time={}&timestep=1'.format(latitude, longitude, minutely_starttime, minutely_endtime)
-		get_minutely = executor.submit(functions.getURL, url, cc_headers, flask_app)
-	
-		url = 'https://api.climacell.co/v3/weather/forecast/hourly?lat={}&lon={}&unit_system=us&fields=precipitation,precipitation%3Ain%2Fhr,precipitation_type,precipitation_probability,temp,feels_like,dewpoint,wind_speed,wind_gust,baro_pressure%3AhPa,visibility,humidity,wind_direction,cloud_cover,weather_code,o3&start_time=now'.format(latitude, longitude)
-		get_hourly = executor.submit(functions.getURL, url, cc_headers, flask_app)
-	
-		url = 'https://api.climacell.co/v3/weather/forecast/daily?lat={}&lon={}&start_time=now&unit_system=us&fields=temp,feels_like,wind_speed,wind_direction,baro_pressure%3AhPa,precipitation,precipitation%3Ain%2Fhr,precipitation_probability,visibility,humidity,sunrise,sunset,weather_code'.format(latitude, longitude)
-		get_daily = executor.submit(functions.getURL, url, cc_headers, flask_app)
-		
-		try:
-			cc_current_obj = get_current.result()
-		except:
-			flask_app.logger.error('Exception occurred during cc_current_obj API call: {}'.format(sys.exc_info()[0]))
-			cc_current_obj = None
-		#  If this request failed, return an empty dictionary
-		if not cc_current_obj:
-			if input_dictionary:
-				return input_dictionary
-			else:
-				return False
-		
-		try:
-			cc_minutely_obj = get_minutely.result()
-		except:
-			flask_app.logger.error('Exception occurred during cc_minutely_obj API call: {}'.format(sys.exc_info()[0]))
-			cc_minutely_obj = None
-		#  If this request failed, return an empty dictionary
-		if not cc_minutely_obj:
-			if input_dictionary:
-				return input_dictionary
-			else:
-				return False
-		
-		try:
-			cc_hourly_obj = get_hourly.result()
-		except:
-			flask_app.logger.error('Exception occurred during cc_hourly_obj API call: {}'.format(sys.exc_info()[0]))
-			cc_hourly_obj = None
-		#  If this request failed, return an empty dictionary
-		if not cc_hourly_obj:
-			if input_dictionary:
-				return input_dictionary
-			else:
-				return False
-		
-		try:
-			cc_daily_obj = get_daily.result()
-		except:
-			flask_app.logger.error('Exception occurred during cc_daily_obj API call: {}'.format(sys.exc_info()[0]))
-			cc_daily_obj = None
-		#  If this request failed, return an empty dictionary
-		if not cc_daily_obj:
-			if input_dictionary:
-				return input_dictionary
-			else:
-				return False
+	if fetched is None:
+		fetched = fetch(latitude, longitude, apikey, flask_app, exclude)
+
+	results = {}
+	for name, section in _sections:
+		if name in fetched:
+			results[name] = _fetchedResult(fetched[name], 'cc_{}_obj'.format(name), section, flask_app)
+	return _transform(latitude, longitude, results, input_dictionary, flask_app, exclude, extend)
+
+async def getAsync(session, latitude, longitude, apikey, input_dictionary=None, flask_app=None, fetched=None, exclude=(), extend=None):
+	"""
+	The asynchronous version of get
+
+	session: the aiohttp.ClientSession returned by
+	         DarkskyAPIFunctions.createAsyncSession
+	fetched: the dictionary of tasks returned by the fetchAsync function
+
+	Returns a DarkSky JSON structure, like get
+	"""
+	if fetched is None:
+		fetched = fetchAsync(session, latitude, longitude, apikey, flask_app, exclude)
+
+	results = {}
+	for name, section in _sections:
+		if name in fetched:
+			result = await _fetchedResultAsync(fetched[name], 'cc_{}_obj'.format(name), section, flask_app)
+			if result is not _skipped:
+				results[name] = result
+	#  Building the output takes long enough to hold up the event loop
+	return await functions.runBlocking(_transform, latitude, longitude, results, input_dictionary, flask_app, exclude, extend)
+
+def _transform(latitude, longitude, results, input_dictionary=None, flask_app=None, exclude=(), extend=None):
+	"""
+	Build the output from the results of the Climacell API calls
+
+	results: a dictionary of the decoded API responses, keyed like the
+	         dictionary returned by fetch, holding None for the calls that
+	         failed.  The calls for excluded blocks are left out.
+
+	Returns a DarkSky JSON structure, or "False", like get
+	"""
+
+	#  The sections whose calls failed, or didn't finish before the
+	#  deadline, are left as they are in the input dictionary and listed
+	#  in its "partial" flag.  If all of the calls failed, return what we
+	#  were given.  The calls for excluded blocks were never made, and
+	#  neither were the ones the key's quota couldn't spare.
+	partial = [section for name, section in _sections if name in results and not results[name]]
+	if not results:
+		return input_dictionary if input_dictionary else False
+	if len(partial) == len(results):
+		if input_dictionary:
+			functions.flagPartial(input_dictionary, partial)
+			return input_dictionary
+		else:
+			return False
+	cc_current_obj = results.get('current')
+	cc_minutely_obj = results.get('minutely')
+	cc_hourly_obj = results.get('hourly')
+	cc_daily_obj = results.get('daily')
 
 	#  Use the input dictionary or build a new one if we didn't get one
 	if input_dictionary:
@@ -250,11 +573,24 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 
 		#  Calculate the timezone's offset from UTC in hours and add that
 		#  to the output
-		tz_now = datetime.datetime.now(pytz.timezone(output['timezone']))
+		tz_now = functions.now(pytz.timezone(output['timezone']))
 		output['offset'] = tz_now.utcoffset().total_seconds() / 3600
 
+	#  Our current conditions replace NOAA's entirely, so they are only
+	#  partial if we didn't get them either
+	if cc_current_obj and 'currently' in output['flags'].get('partial', []):
+		output['flags']['partial'].remove('currently')
+		if not output['flags']['partial']:
+			del output['flags']['partial']
+	functions.flagPartial(output, partial)
+
+	#  Measure the CPU time spent building each section of the output
+	timer = DarkskyAPIMetrics.TransformTimer('climacell')
+
 	#--------------------------   C u r r e n t l y   --------------------------#
 
+	timer.section('currently')
+
 	#  Populate the output dictionary with the current observations
 	if cc_current_obj:
 		output['currently'] = {
@@ -281,6 +617,8 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 		}
 
 	#---------------------------   M i n u t e l y   ---------------------------#	
+
+	timer.section('minutely')
 	
 	#  Add the minutely data from Climacell to the output dictionary
 	if cc_minutely_obj:
@@ -289,8 +627,13 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 		#  If we already have minutely data, we won't change it.  We  only
 		#  use our data when there isn't anything already in place.
 		if not minutely_data or len(minutely_data) == 0:
+			#  The data may be from an earlier call, so skip the minutes
+			#  that have passed
+			now_timestamp = functions.now().timestamp()
 			minutely_data = []
 			for minute in cc_minutely_obj:
+				if _epochTime(minute['observation_time']['value']) < now_timestamp - 60:
+					continue
 				minutely_data.append({
 					'time': _epochTime(minute['observation_time']['value']),
 					'precipIntensity': functions.getKeyValue(minute, ['precipitation', 'value']),
@@ -308,6 +651,8 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 			}
 		
 	#-----------------------------   H o u r l y   -----------------------------#	
+
+	timer.section('hourly')
 	
 	#  Add the hourly data from Climacell to the output dictionary
 	if cc_hourly_obj:
@@ -317,17 +662,23 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 		#  with just a timestamp for each day
 		if not hourly_data or len(hourly_data) == 0:
 			hourly_data = []
-			timestamp = int(datetime.datetime.combine(datetime.date.today(),datetime.time(datetime.datetime.now().hour)).timestamp())
-			for timestamp in range(timestamp + (timestamp + (3600 * 48)), 3600):
+			hours = 168 if extend == 'hourly' else 48
+			timestamp = int(functions.now().replace(minute=0, second=0, microsecond=0).timestamp())
+			for timestamp in range(timestamp, timestamp + (3600 * hours), 3600):
 				hourly_data.append({
 					'time': int(timestamp)
 				})
 
-		#  Add the Climacell data for each day
+		#  Add the Climacell data for each hour, matched up by time because
+		#  the data may be from an earlier call.  Climacell may have fewer
+		#  hours than an extended hourly forecast.
+		cc_hours = {}
+		for cc_hour in cc_hourly_obj:
+			cc_hours[_epochTime(cc_hour['observation_time']['value'])] = cc_hour
 		for i in range(len(hourly_data)):
 			hour = hourly_data[i]
-			cc_hour = cc_hourly_obj[i]
-			if hour['time'] == _epochTime(cc_hour['observation_time']['value']):
+			cc_hour = cc_hours.get(hour['time'])
+			if cc_hour:
 				hourly_data[i] = {
 					'time': hour['time'],
 					'summary': functions.getKeyValue(cc_hour, ['weather_code', 'value'], lambda x: _mapClimacellWeatherCode(x)),
@@ -351,18 +702,21 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 					'ozone': functions.getKeyValue(cc_hour, ['o3', 'value'])
 				}
 
-			#  Use data from the first hour as the summary values for this
-			#  section and the minutely section
-			output['hourly']['summary'] = hourly_data[0]['summary']
-			output['hourly']['icon'] = hourly_data[0]['icon']
-			output['minutely']['summary'] = hourly_data[0]['summary']
-			output['minutely']['icon'] = hourly_data[0]['icon']
+		#  Use data from the first hour as the summary values for this
+		#  section and the minutely section
+		if hourly_data:
+			output['hourly']['summary'] = hourly_data[0].get('summary')
+			output['hourly']['icon'] = hourly_data[0].get('icon')
+			output['minutely']['summary'] = hourly_data[0].get('summary')
+			output['minutely']['icon'] = hourly_data[0].get('icon')
 		
 		#  Put the hourly data into the output dictionary
 		output['hourly']['data'] = hourly_data
 
 	#------------------------------   D a i l y   ------------------------------#
 
+	timer.section('daily')
+
 	#  Add the daily data from Climacell to the output directory
 	if cc_daily_obj:
 		daily_data = functions.getKeyValue(output, ['daily', 'data'])
@@ -371,7 +725,7 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 		#  with just a timestamp for each day
 		if not daily_data or len(daily_data) == 0:
 			daily_data = []
-			d = datetime.datetime.utcnow()
+			d = functions.utcnow()
 			timestamp = int(datetime.datetime(d.year, d.month, d.day, 0, 0, 0, tzinfo=datetime.timezone.utc).timestamp())
 			for timestamp in range(timestamp, timestamp + (86400 * 8), 86400):
 				daily_data.append({
@@ -390,12 +744,14 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 				
 		#  Align the dates in the two arrays
 		ctr = 0
-		for i in range(len(cc_daily_obj)):
-			if _dailyEpochTime(cc_daily_obj[ctr]['observation_time']['value']) < daily_data[0]['time']:
-				ctr = ctr + 1
+		while ctr < len(cc_daily_obj) and _dailyEpochTime(cc_daily_obj[ctr]['observation_time']['value']) < daily_data[0]['time']:
+			ctr = ctr + 1
 				
-		#  Update the data for each day
+		#  Update the data for each day.  Data from an earlier call may not
+		#  reach as far as the last day.
 		for i in range(len(daily_data)):
+			if ctr >= len(cc_daily_obj):
+				break
 			day = daily_data[i]
 			cc_day = cc_daily_obj[ctr]
 			daily_data[i] = {
@@ -502,23 +858,25 @@ def get(latitude, longitude, apikey, input_dictionary=None, flask_app=None):
 			
 		#  Use data from the first day as the summary values for this
 		#  section
-		output['daily']['summary'] = daily_data[0]['summary']
-		output['daily']['icon'] = daily_data[0]['icon']
+		output['daily']['summary'] = daily_data[0].get('summary')
+		output['daily']['icon'] = daily_data[0].get('icon')
 		
 		#  Put the daily data into the output dictionary
 		output['daily']['data'] = daily_data
 	
+	timer.stop()
+
 	#-----------------------------   A l e r t s   -----------------------------#
 	
-	'''
+	"""
 	Climacell's alerts are a proprietary messaging system, not weather
 	alerts. If the input data structure included NOAA weather alerts,
 	those will be passed through untouched.
-	'''
+	"""
 
 	#  Add a source flag for this source
 	sources = []
-	if functions.getKeyValue(input_dictionary, ['flags', 'sources']):
+	if input_dictionary and functions.getKeyValue(input_dictionary, ['flags', 'sources']):
 		for source in functions.getKeyValue(input_dictionary, ['flags', 'sources']):
 			sources.append(source)
 	sources.append('climacell')
@@ -0,0 +1,521 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Persistent caches shared by all of the worker processes that are running
+the application
+"""
+
+import atexit
+import collections
+import concurrent.futures
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+#  The SQLite database file that holds the caches.  Like the log file, it
+#  is written into the application's current directory.
+cache_filename = 'darksky-api.cache'
+
+#  The directory that holds the lock files used to coordinate work
+#  between processes
+lock_directory = 'darksky-api.locks'
+
+#  SingleFlight hashes its keys into this many lock files for each name,
+#  so the directory doesn't grow with every key.  Keys that share a file
+#  only wait on each other when they are worked on at the same time.
+lock_stripes = 256
+
+class PersistentCache:
+	"""
+	A key/value store kept in a table in an SQLite database file.  Values
+	are anything that can be converted to JSON and each one has its own
+	expiration time.  The database is opened in WAL mode so that all of
+	the uwsgi worker processes, and all of their threads, can read and
+	write it at the same time.
+	"""
+
+	def __init__(self, table, filename=None):
+		"""
+		table: the name of the table in the database that holds this
+		       cache's entries
+		filename: the database file, defaults to cache_filename
+		"""
+		self.table = table
+		self.filename = filename
+		self._local = threading.local()
+
+	def _connection(self):
+		"""
+		Return this thread's connection to the database, opening it if
+		necessary.  Connections are never shared between threads or
+		carried across a fork.
+		"""
+		conn = getattr(self._local, 'conn', None)
+		if conn is None or self._local.pid != os.getpid():
+			conn = sqlite3.connect(self.filename or cache_filename, timeout=5)
+			conn.execute('PRAGMA journal_mode=WAL')
+			conn.execute('PRAGMA synchronous=NORMAL')
+			conn.execute('CREATE TABLE IF NOT EXISTS "{}" (key TEXT PRIMARY KEY, value TEXT, expires REAL)'.format(self.table))
+			self._local.conn = conn
+			self._local.pid = os.getpid()
+		return conn
+
+	def get(self, key, stale=False):
+		"""
+		Look up an entry in the cache
+
+		key: a string
+		stale: if True, return the entry even if it has expired
+
+		Returns the cached value or None if there is no (unexpired) entry
+		"""
+		try:
+			row = self._connection().execute('SELECT value, expires FROM "{}" WHERE key = ?'.format(self.table), (key,)).fetchone()
+		except sqlite3.Error as e:
+			print('Unable to read "{}" from the {} cache: {}'.format(key, self.table, e))
+			return None
+		if row is None or (row[1] < time.time() and not stale):
+			return None
+		return json.loads(row[0])
+
+	def items(self):
+		"""
+		Read every unexpired entry in the cache
+
+		Returns a list of (key, value) tuples
+		"""
+		try:
+			rows = self._connection().execute('SELECT key, value FROM "{}" WHERE expires >= ?'.format(self.table), (time.time(),)).fetchall()
+		except sqlite3.Error as e:
+			print('Unable to read the {} cache: {}'.format(self.table, e))
+			return []
+		return [(key, json.loads(value)) for key, value in rows]
+
+	def put(self, key, value, ttl):
+		"""
+		Add or replace an entry in the cache
+
+		key: a string
+		value: anything that can be converted to JSON
+		ttl: the number of seconds the entry is good for
+		"""
+		try:
+			with self._connection() as conn:
+				conn.execute('INSERT OR REPLACE INTO "{}" (key, value, expires) VALUES (?, ?, ?)'.format(self.table), (key, json.dumps(value), time.time() + ttl))
+		except sqlite3.Error as e:
+			print('Unable to write "{}" into the {} cache: {}'.format(key, self.table, e))
+
+	def putMany(self, items, ttl):
+		"""
+		Add or replace several entries in the cache in one transaction
+
+		items: a list of (key, value) tuples
+		ttl: the number of seconds the entries are good for
+		"""
+		expires = time.time() + ttl
+		try:
+			with self._connection() as conn:
+				conn.executemany('INSERT OR REPLACE INTO "{}" (key, value, expires) VALUES (?, ?, ?)'.format(self.table), [(key, json.dumps(value), expires) for key, value in items])
+		except sqlite3.Error as e:
+			print('Unable to write {} entries into the {} cache: {}'.format(len(items), self.table, e))
+
+	def increment(self, key, amount, ttl):
+		"""
+		Add to a count kept in the cache, in one transaction so that
+		increments made by different processes at the same time are all
+		counted.  An entry that doesn't exist, or has expired, starts at
+		zero and is good for ttl seconds.
+
+		key: a string
+		amount: an integer
+		ttl: the number of seconds a new entry is good for
+
+		Returns the new count, or None if the cache couldn't be updated
+		"""
+		now = time.time()
+		try:
+			with self._connection() as conn:
+				conn.execute('INSERT INTO "{0}" (key, value, expires) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET value = CASE WHEN "{0}".expires < ? THEN excluded.value ELSE CAST(CAST("{0}".value AS INTEGER) + ? AS TEXT) END, expires = CASE WHEN "{0}".expires < ? THEN excluded.expires ELSE "{0}".expires END'.format(self.table), (key, json.dumps(amount), now + ttl, now, amount, now))
+				row = conn.execute('SELECT value FROM "{}" WHERE key = ?'.format(self.table), (key,)).fetchone()
+		except sqlite3.Error as e:
+			print('Unable to increment "{}" in the {} cache: {}'.format(key, self.table, e))
+			return None
+		return json.loads(row[0])
+
+	def claim(self, key, ttl):
+		"""
+		Take out a lease on a key.  Only one caller, in any process, can
+		hold the lease at a time.  The lease ends after ttl seconds or
+		when it is deleted.
+
+		key: a string
+		ttl: the number of seconds the lease is good for
+
+		Returns True if the lease was granted
+		"""
+		now = time.time()
+		try:
+			with self._connection() as conn:
+				cursor = conn.execute('INSERT INTO "{0}" (key, value, expires) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires WHERE "{0}".expires < ?'.format(self.table), (key, json.dumps(os.getpid()), now + ttl, now))
+				return cursor.rowcount == 1
+		except sqlite3.Error as e:
+			print('Unable to claim "{}" in the {} cache: {}'.format(key, self.table, e))
+			return False
+
+	def expire(self, key):
+		"""
+		Mark an entry as expired, without removing it, so that it is only
+		returned to callers that will accept stale entries
+		"""
+		try:
+			with self._connection() as conn:
+				conn.execute('UPDATE "{}" SET expires = 0 WHERE key = ?'.format(self.table), (key,))
+		except sqlite3.Error as e:
+			print('Unable to expire "{}" in the {} cache: {}'.format(key, self.table, e))
+
+	def delete(self, key):
+		"""
+		Remove an entry from the cache
+		"""
+		try:
+			with self._connection() as conn:
+				conn.execute('DELETE FROM "{}" WHERE key = ?'.format(self.table), (key,))
+		except sqlite3.Error as e:
+			print('Unable to delete "{}" from the {} cache: {}'.format(key, self.table, e))
+
+	def clear(self):
+		"""
+		Remove every entry from the cache
+		"""
+		try:
+			with self._connection() as conn:
+				conn.execute('DELETE FROM "{}"'.format(self.table))
+		except sqlite3.Error as e:
+			print('Unable to clear the {} cache: {}'.format(self.table, e))
+
+class ResponseCache:
+	"""
+	A cache of finished responses.  Each process keeps the entries it has
+	used recently in memory, in front of a PersistentCache that all of the
+	processes share.  Entries are fresh until the expiration time given
+	when they were added and are then kept, stale, for stale_ttl seconds
+	more so that they can be served while they are being refreshed.
+	"""
+
+	def __init__(self, table, memory_size=256, stale_ttl=3600, filename=None):
+		"""
+		table: the name of the table in the database that holds the cache
+		memory_size: the number of entries each process keeps in memory
+		stale_ttl: the number of seconds stale entries are kept
+		filename: the database file, defaults to cache_filename
+		"""
+		self.shared = PersistentCache(table, filename)
+		self.leases = PersistentCache(table + '_leases', filename)
+		self.memory_size = memory_size
+		self.stale_ttl = stale_ttl
+		self._memory = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		"""
+		Look up a response
+
+		key: a string
+
+		Returns a (value, fresh) tuple.  value is None if there is no entry
+		at all, fresh is False if the entry has expired.
+		"""
+		now = time.time()
+		with self._lock:
+			entry = self._memory.get(key)
+			if entry is not None:
+				if entry[1] > now:
+					self._memory.move_to_end(key)
+				else:
+					del self._memory[key]
+					entry = None
+		if entry is None:
+			shared = self.shared.get(key)
+			if shared is None:
+				return (None, False)
+			entry = (shared['expires'], shared['expires'] + self.stale_ttl, shared['value'])
+			self._remember(key, entry)
+		return (entry[2], entry[0] > now)
+
+	def put(self, key, value, expires):
+		"""
+		Add or replace a response
+
+		key: a string
+		value: anything that can be converted to JSON
+		expires: the UNIX timestamp at which the entry goes stale
+		"""
+		entry = (expires, expires + self.stale_ttl, value)
+		self._remember(key, entry)
+		self.shared.put(key, {'expires': expires, 'value': value}, expires + self.stale_ttl - time.time())
+
+	def claimRefresh(self, key, ttl=60):
+		"""
+		Make sure that only one process refreshes a stale entry.  The
+		caller that gets True back should refresh the entry and then call
+		releaseRefresh.
+		"""
+		return self.leases.claim(key, ttl)
+
+	def releaseRefresh(self, key):
+		"""
+		Give up the lease taken out by claimRefresh
+		"""
+		self.leases.delete(key)
+
+	def _remember(self, key, entry):
+		"""
+		Keep an entry in this process's memory
+		"""
+		with self._lock:
+			self._memory[key] = entry
+			self._memory.move_to_end(key)
+			while len(self._memory) > self.memory_size:
+				self._memory.popitem(last=False)
+
+class ExpiringCache:
+	"""
+	A cache of values that each expire at their own time.  Each process
+	keeps up to memory_bytes of them in memory, dropping the least
+	recently used first.  They can also be kept in a PersistentCache that
+	all of the processes share, behind the memory.  Values are shared
+	with every caller that gets them, so callers must not change them.
+	"""
+
+	def __init__(self, table, memory_bytes, disk=False, filename=None):
+		"""
+		table: the name of the table in the database that holds the cache,
+		       if it is kept on disk
+		memory_bytes: roughly how much memory each process uses for the
+		              cache, measured by the sizes given to put
+		disk: if True, the entries are also kept in the database file
+		filename: the database file, defaults to cache_filename
+		"""
+		self.shared = PersistentCache(table, filename) if disk else None
+		self.memory_bytes = memory_bytes
+		self._memory = collections.OrderedDict()
+		self._size = 0
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		"""
+		Look up an entry
+
+		key: a string
+
+		Returns the value or None if there is no unexpired entry
+		"""
+		now = time.time()
+		with self._lock:
+			entry = self._memory.get(key)
+			if entry is not None:
+				if entry[0] > now:
+					self._memory.move_to_end(key)
+					return entry[2]
+				del self._memory[key]
+				self._size = self._size - entry[1]
+		if self.shared is None:
+			return None
+		shared = self.shared.get(key)
+		if shared is None:
+			return None
+		self._remember(key, (shared['expires'], shared['size'], shared['value']))
+		return shared['value']
+
+	def put(self, key, value, ttl, size):
+		"""
+		Add or replace an entry
+
+		key: a string
+		value: anything that can be converted to JSON
+		ttl: the number of seconds the entry is good for
+		size: roughly how many bytes of memory the value takes up, the
+		      length of the JSON it was decoded from will do
+		"""
+		expires = time.time() + ttl
+		self._remember(key, (expires, size, value))
+		if self.shared is not None:
+			self.shared.put(key, {'expires': expires, 'size': size, 'value': value}, ttl)
+
+	def _remember(self, key, entry):
+		"""
+		Keep an entry in this process's memory, unless it is too big
+		"""
+		with self._lock:
+			previous = self._memory.pop(key, None)
+			if previous is not None:
+				self._size = self._size - previous[1]
+			if entry[1] > self.memory_bytes:
+				return
+			self._memory[key] = entry
+			self._size = self._size + entry[1]
+			while self._size > self.memory_bytes:
+				dropped_key, dropped = self._memory.popitem(last=False)
+				self._size = self._size - dropped[1]
+
+class LastKnownGoodStore:
+	"""
+	The last good response for each location, for use when the backend
+	data services can't be reached.  Writes are queued and written to a
+	PersistentCache in batches by a background thread so that requests
+	never wait for the disk.  Reads are a single lookup by key.
+	"""
+
+	#  Entries are never expired, they are only ever replaced
+	ttl = 10 * 365 * 86400
+
+	def __init__(self, table, flush_interval=5, filename=None):
+		"""
+		table: the name of the table in the database that holds the store
+		flush_interval: the number of seconds between batched writes
+		filename: the database file, defaults to cache_filename
+		"""
+		self.shared = PersistentCache(table, filename)
+		self.flush_interval = flush_interval
+		self._pending = {}
+		self._lock = threading.Lock()
+		self._writer_pid = None
+		atexit.register(self.flush)
+
+	def get(self, key):
+		"""
+		Look up the last good response for a key
+
+		Returns the response or None if there isn't one
+		"""
+		with self._lock:
+			if key in self._pending:
+				return self._pending[key]
+		return self.shared.get(key, stale=True)
+
+	def put(self, key, value):
+		"""
+		Queue a response to be written to the store
+		"""
+		with self._lock:
+			self._pending[key] = value
+			#  Start the writer thread in each process the first time it
+			#  is needed, i.e. after uwsgi has forked the workers
+			if self._writer_pid != os.getpid():
+				self._writer_pid = os.getpid()
+				threading.Thread(target=self._writer, daemon=True).start()
+
+	def flush(self):
+		"""
+		Write all of the queued responses to the store now
+		"""
+		with self._lock:
+			items = list(self._pending.items())
+		if items:
+			self.shared.putMany(items, self.ttl)
+			#  Only forget the responses that haven't been replaced while
+			#  they were being written
+			with self._lock:
+				for key, value in items:
+					if self._pending.get(key) is value:
+						del self._pending[key]
+
+	def _writer(self):
+		"""
+		Write the queued responses every flush_interval seconds
+		"""
+		while True:
+			time.sleep(self.flush_interval)
+			self.flush()
+
+class SingleFlight:
+	"""
+	Make sure that only one request at a time, in any process, does the
+	work for a key.  Other requests for the same key wait for that work
+	to finish and share its result.  Requests in the same process wait on
+	the first request's result directly.  Requests in other processes
+	wait on a lock file and then look for the result in a shared cache.
+	"""
+
+	def __init__(self, name, timeout=30):
+		"""
+		name: a name for the lock files, which are kept in lock_directory
+		timeout: the number of seconds to wait for another request before
+		         giving up and doing the work ourselves
+		"""
+		self.name = name
+		self.timeout = timeout
+		self._inflight = {}
+		self._lock = threading.Lock()
+
+	def do(self, key, work, check):
+		"""
+		Do the work for a key, or wait for another request to do it
+
+		key: a string
+		work: a function that does the work and returns its result
+		check: a function that returns the result of the work if another
+		       process has already done it, or None
+
+		Returns the result of the work
+		"""
+		with self._lock:
+			future = self._inflight.get(key)
+			leader = future is None
+			if leader:
+				future = concurrent.futures.Future()
+				self._inflight[key] = future
+		if not leader:
+			try:
+				return future.result(timeout=self.timeout)
+			except concurrent.futures.TimeoutError:
+				return work()
+
+		try:
+			result = self._doLocked(key, work, check)
+			future.set_result(result)
+			return result
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		finally:
+			with self._lock:
+				del self._inflight[key]
+
+	def _doLocked(self, key, work, check):
+		"""
+		Do the work while holding the key's lock file.  If another process
+		holds the lock, wait for it and then use its result if it left one.
+		"""
+		os.makedirs(lock_directory, exist_ok=True)
+		stripe = int(hashlib.sha1(key.encode()).hexdigest(), 16) % lock_stripes
+		filename = os.path.join(lock_directory, '{}.{}.lock'.format(self.name, stripe))
+		with open(filename, 'a') as lock_file:
+			waited = False
+			deadline = time.time() + self.timeout
+			while True:
+				try:
+					fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+					locked = True
+					break
+				except BlockingIOError:
+					waited = True
+					if time.time() > deadline:
+						locked = False
+						break
+					time.sleep(0.05)
+			try:
+				if waited:
+					result = check()
+					if result is not None:
+						return result
+				return work()
+			finally:
+				if locked:
+					fcntl.flock(lock_file, fcntl.LOCK_UN)
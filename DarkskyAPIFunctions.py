@@ -2,29 +2,980 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-'''
+"""
 Common functions used by both the NOAAWeatherAPI and Climacell modules
-'''
+"""
+
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import datetime
+import email.utils
+import functools
+import glob
+import gzip
+import json
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
 #  isodate may be available in distro packages, or may need to be
 #  installed with pip
 import isodate
 
-def getURL(url, headers=None, flask_app=None):
+#  aiohttp is only needed by the asynchronous entry point,
+#  darksky-api-async.py
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
+
+#  Application modules
+import DarkskyAPICache
+import DarkskyAPIMetrics as metrics
+
+#  Size of the keep-alive connection pool kept for each upstream host.
+#  These match the number of calls that NOAAWeatherAPI.get and
+#  ClimacellWeatherAPI.get make in parallel for a single request.  Hosts
+#  that aren't listed get the default size.  A process never has more
+#  calls to a host in flight than there are connections in its pool,
+#  calls beyond that wait for a connection to become free.
+pool_sizes = {
+	'api.weather.gov': 8,
+	'api.climacell.co': 4
+}
+default_pool_size = 4
+
+#  The number of threads in the executor that each process uses to make
+#  upstream API calls
+executor_max_workers = 16
+
+#  The connect and read timeouts, in seconds, for calls to each upstream
+#  endpoint, keyed by the endpoint names that DarkskyAPIMetrics uses.
+#  NOAA builds the gridpoint forecasts on demand and they can take a
+#  while.  Endpoints that aren't listed get the default timeouts.
+upstream_timeouts = {
+	'points': (3.05, 10),
+	'stations': (3.05, 10),
+	'observations': (3.05, 8),
+	'forecastHourly': (3.05, 20),
+	'forecast': (3.05, 20),
+	'gridData': (3.05, 20),
+	'alerts': (3.05, 8),
+	'zones': (3.05, 15)
+}
+default_timeout = (3.05, 10)
+
+#  Each process has a circuit breaker for each upstream host.  After
+#  breaker_failure_threshold calls to a host in a row time out, can't
+#  connect or get one of the breaker_failure_statuses, the breaker opens
+#  and calls to that host fail immediately, so requests go straight to
+#  the cached data instead of tying up a worker.  After
+#  breaker_open_seconds one call is let through to probe the host.  The
+#  breaker closes again if it succeeds and stays open if it doesn't.
+breaker_failure_threshold = 5
+breaker_failure_statuses = [502, 503, 504]
+breaker_open_seconds = 30
+
+#  The asynchronous entry point makes its upstream calls with aiohttp.
+#  Each upstream host gets up to async_connections_per_host connections,
+#  many more than the threads get, because a call no longer ties up a
+#  thread while it waits.
+async_connections_per_host = 32
+
+#  The asynchronous entry point runs the work that would hold up its
+#  event loop, reading and writing the caches and turning the upstream
+#  data into DarkSky blocks, on an executor of its own with this many
+#  threads
+blocking_max_workers = 8
+
+#  Calls to the retry_hosts that time out, can't connect or get one of
+#  the retry_statuses are tried again, up to retry_attempts more times.
+#  Before each retry we wait a random time of up to retry_backoff
+#  seconds, doubled for each retry, so that the retries from many
+#  requests don't all arrive together.  Climacell calls aren't retried
+#  because every call counts against the API key's quota.
+retry_hosts = ['api.weather.gov']
+retry_statuses = [502, 503, 504]
+retry_attempts = 2
+retry_backoff = 0.25
+
+#  Calls to the hedge_endpoints that haven't answered within the 90th
+#  percentile of the endpoint's recent latencies, counted from when the
+#  call is sent, get a second, hedged call.  The first good answer from
+#  either call is used.  The latencies of the last hedge_window
+#  successful calls to each endpoint are kept, and hedging starts once
+#  there are hedge_min_samples of them.  Both calls are made by an
+#  executor of their own, with hedge_max_workers threads or two for each
+#  of the executor_max_workers, whichever is more, so a call never waits
+#  for a thread.  Set hedge_endpoints to an empty list to turn hedging off.
+hedge_endpoints = ['gridData', 'forecastHourly', 'forecast', 'observations']
+hedge_percentile = 90
+hedge_window = 200
+hedge_min_samples = 20
+hedge_min_delay = 0.05
+hedge_max_workers = 8
+
+#  Retries and hedged calls come out of two budgets.  Each request can
+#  make request_retry_budget of them, however many upstream calls it
+#  makes.  Each process earns retry_budget_ratio of a retry for every
+#  upstream call, and can save up to retry_budget_max of them, so that
+#  when a host is struggling retries add no more than a tenth to the
+#  load on it.
+request_retry_budget = 4
+retry_budget_ratio = 0.1
+retry_budget_max = 10
+
+#  The responses from the url_cache_ttls endpoints are cached, by URL, for
+#  as long as their Cache-Control or Expires headers allow or, if they
+#  have neither, for the number of seconds given here.  Responses that
+#  say they mustn't be cached aren't.  The endpoints that NOAAWeatherAPI
+#  and ClimacellWeatherAPI keep in caches of their own aren't listed: a
+#  second cache here would keep serving a location's old grid after
+#  NOAAWeatherAPI expires it, hold back new gridpoint forecasts and waste
+#  the Climacell API key's quota.  The cached responses are shared by
+#  every caller, which must not change them.
+url_cache_ttls = {
+	'observations': 600,
+	'alerts': 60
+}
+
+#  Each process keeps up to url_cache_memory_bytes of cached responses in
+#  memory, measured by the length of their JSON, and drops the least
+#  recently used first.  Set url_cache_disk to True to also keep them in
+#  the darksky-api.cache file, where every worker process can use them.
+url_cache_memory_bytes = 32 * 1024 * 1024
+url_cache_disk = False
+
+#  For testing, all upstream calls can be sent to a stand-in server
+#  instead of the real services by setting the DARKSKY_API_UPSTREAM
+#  environment variable to the stand-in's base URL.  The stand-in gets
+#  the original host as the first part of the path, i.e.
+#  https://api.weather.gov/points/... is sent to
+#  <DARKSKY_API_UPSTREAM>/api.weather.gov/points/...
+upstream_override = os.environ.get('DARKSKY_API_UPSTREAM')
+
+#  Upstream responses can be recorded, for load testing, by setting the
+#  DARKSKY_API_RECORD environment variable to a directory.  Each process
+#  appends its responses, with their URLs, status codes, headers and
+#  latencies, to its own gzip compressed JSON lines file in that
+#  directory.  Setting DARKSKY_API_REPLAY to one of those files, or to
+#  the whole directory, serves the recorded responses instead of calling
+#  the upstream services, without any network access.  Replayed
+#  responses come back immediately unless DARKSKY_API_REPLAY_LATENCY is
+#  set to 1, in which case each one takes as long as it did when it was
+#  recorded.
+record_directory = os.environ.get('DARKSKY_API_RECORD')
+replay_archive = os.environ.get('DARKSKY_API_REPLAY')
+replay_latency = os.environ.get('DARKSKY_API_REPLAY_LATENCY') == '1'
+
+#  The query parameters that hold the current time, and so are different
+#  in every recorded URL.  They are ignored when a URL is looked up in a
+#  replay archive.
+replay_ignored_parameters = ['start_time', 'end_time']
+
+#  The time that the forecasts are built for can be pinned, so that
+#  replayed responses are always turned into the same output, by setting
+#  DARKSKY_API_CLOCK to a UNIX timestamp or an ISO8601 date string.  When
+#  replaying, the clock is pinned to the time of the first recorded
+#  response unless DARKSKY_API_CLOCK says otherwise.
+clock = os.environ.get('DARKSKY_API_CLOCK')
+
+#  One requests.Session and one concurrency limit per upstream host, and
+#  one executor, shared by all threads in this process.  These are
+#  created lazily and are thrown away if we find ourselves in a new
+#  process, i.e. after uwsgi forks its workers, so that workers never
+#  share sockets or threads with their parent.
+_sessions = {}
+_upstreams = {}
+_breakers = {}
+_latencies = {}
+_executor = None
+_hedge_executor = None
+_blocking_executor = None
+_retry_tokens = retry_budget_max
+_executor_stats = {
+	'submitted': 0,
+	'running': 0,
+	'completed': 0
+}
+_process_pid = None
+_process_lock = threading.Lock()
+
+#  The number of retries and hedged calls that the request being handled
+#  has left.  Tasks that submit runs in the background share their
+#  caller's budget.
+_request_retries = contextvars.ContextVar('request_retries', default=None)
+
+#  The deadlines of the response being built, as time.perf_counter
+#  values, keyed by section with the deadline of the whole response
+#  under None.  Tasks that submit runs in the background share their
+#  caller's deadlines.
+_deadlines = contextvars.ContextVar('deadlines', default=None)
+
+#  The recording file that this process is writing and the responses
+#  loaded from the replay archive, keyed by _replayKey
+_recording = None
+_recording_pid = None
+_recording_lock = threading.Lock()
+_replays = None
+_replay_lock = threading.Lock()
+_clock_timestamp = None
+
+#  The cache of upstream responses, created the first time it is used
+_url_cache = None
+_url_cache_lock = threading.Lock()
+
+def _checkProcess():
 	"""
-	Get the results of an API call to the NOAA or Climacell weather APIs
-	and handle any errors which might occur.
-	
+	Throw away the sessions, limits, circuit breakers and executor
+	inherited from a parent process.  Must be called with _process_lock
+	held.
+	"""
+	global _process_pid, _executor, _hedge_executor, _blocking_executor, _retry_tokens
+	if _process_pid != os.getpid():
+		_sessions.clear()
+		_upstreams.clear()
+		_breakers.clear()
+		_latencies.clear()
+		_executor = None
+		_hedge_executor = None
+		_blocking_executor = None
+		_retry_tokens = retry_budget_max
+		for key in _executor_stats:
+			_executor_stats[key] = 0
+		_process_pid = os.getpid()
+
+def getSession(url):
+	"""
+	Return the pooled, keep-alive requests.Session used for calls to the
+	host named in a URL.
+
 	url: a string
-	headers: a "requests"-style dictionary array of header names and values
-	flask_app : an object containing a Flask application's details.  Used
-	            to allow us to write into the application log.
-	
-	Returns a JSON object or "False" if an error occurred
+
+	Returns a requests.Session object
+	"""
+	host = urlsplit(url).netloc.lower()
+	with _process_lock:
+		_checkProcess()
+		session = _sessions.get(host)
+		if session is None:
+			pool_size = pool_sizes.get(host, default_pool_size)
+			adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+			session = requests.Session()
+			session.mount('https://', adapter)
+			session.mount('http://', adapter)
+			_sessions[host] = session
+	return session
+
+@contextlib.contextmanager
+def _upstreamSlot(url):
+	"""
+	Wait for a free slot in the concurrency limit of the host named in a
+	URL and hold it for the duration of a "with" block
+	"""
+	host = urlsplit(url).netloc.lower()
+	with _process_lock:
+		_checkProcess()
+		upstream = _upstreams.get(host)
+		if upstream is None:
+			limit = pool_sizes.get(host, default_pool_size)
+			upstream = {
+				'semaphore': threading.BoundedSemaphore(limit),
+				'limit': limit,
+				'active': 0,
+				'waiting': 0
+			}
+			_upstreams[host] = upstream
+		upstream['waiting'] = upstream['waiting'] + 1
+	upstream['semaphore'].acquire()
+	with _process_lock:
+		upstream['waiting'] = upstream['waiting'] - 1
+		upstream['active'] = upstream['active'] + 1
+	try:
+		yield
+	finally:
+		with _process_lock:
+			upstream['active'] = upstream['active'] - 1
+		upstream['semaphore'].release()
+
+class CircuitBreaker:
+	"""
+	Track the health of an upstream host.  The breaker is "closed" while
+	calls are getting through, "open" while calls fail fast and
+	"half-open" while a single probe call finds out whether the host has
+	recovered.
+	"""
+
+	def __init__(self, host):
+		"""
+		host: the upstream host name
+		"""
+		self.host = host
+		self.state = 'closed'
+		self.failures = 0
+		self.opened = 0
+		self._lock = threading.Lock()
+		self._report()
+
+	def allow(self, flask_app=None):
+		"""
+		Decide whether a call to the host can be made
+
+		Returns True if the call should go ahead, False if it should fail
+		fast
+		"""
+		with self._lock:
+			if self.state == 'closed':
+				return True
+			if self.state == 'open' and time.monotonic() - self.opened >= breaker_open_seconds:
+				#  Let this call through as the probe
+				self._change('half-open', flask_app)
+				return True
+			return False
+
+	def record(self, failed, flask_app=None):
+		"""
+		Record the result of a call to the host
+
+		failed: True if the call timed out, couldn't connect or got one of
+		        the breaker_failure_statuses
+		"""
+		with self._lock:
+			if not failed:
+				self.failures = 0
+				if self.state != 'closed':
+					self._change('closed', flask_app)
+				return
+			self.failures = self.failures + 1
+			if self.state == 'half-open' or (self.state == 'closed' and self.failures >= breaker_failure_threshold):
+				self.opened = time.monotonic()
+				self._change('open', flask_app)
+
+	def _change(self, state, flask_app):
+		"""
+		Move to a new state, logging the change and recording it in the
+		metrics.  Must be called with _lock held.
+		"""
+		self.state = state
+		if state == 'open':
+			message_text = 'Circuit breaker for {} is open after {} failed calls, failing fast for {} seconds'.format(self.host, self.failures, breaker_open_seconds)
+		elif state == 'half-open':
+			message_text = 'Circuit breaker for {} is half-open, probing the host'.format(self.host)
+		else:
+			message_text = 'Circuit breaker for {} is closed, the host has recovered'.format(self.host)
+		if flask_app:
+			if state == 'closed':
+				flask_app.logger.info(message_text)
+			else:
+				flask_app.logger.warning(message_text)
+		print(message_text)
+		metrics.inc('darksky_circuit_breaker_transitions_total', {'host': self.host, 'state': state})
+		self._report()
+
+	def _report(self):
+		"""
+		Set the metrics gauges to this process's breaker state
+		"""
+		for state in ['closed', 'half-open', 'open']:
+			metrics.setGauge('darksky_circuit_breakers', {'host': self.host, 'state': state}, 1 if state == self.state else 0)
+
+def getBreaker(url):
 	"""
-	response = requests.get(url, headers=headers)
+	Return the circuit breaker for the host named in a URL
+
+	url: a string
+
+	Returns a CircuitBreaker object
+	"""
+	host = urlsplit(url).netloc.lower()
+	with _process_lock:
+		_checkProcess()
+		breaker = _breakers.get(host)
+		if breaker is None:
+			breaker = CircuitBreaker(host)
+			_breakers[host] = breaker
+	return breaker
+
+def startRequest():
+	"""
+	Give the request being handled its own budget of retries and hedged
+	calls.  Calls made outside of a request are only limited by the
+	process's budget.
+	"""
+	_request_retries.set({'remaining': request_retry_budget})
+
+def _earnRetries():
+	"""
+	Add to the process's retry budget for an upstream call
+	"""
+	global _retry_tokens
+	with _process_lock:
+		_checkProcess()
+		_retry_tokens = min(retry_budget_max, _retry_tokens + retry_budget_ratio)
+
+def _spendRetry():
+	"""
+	Take one retry or hedged call out of the request's and the process's
+	budgets
+
+	Returns True if both budgets allowed it
+	"""
+	global _retry_tokens
+	request_budget = _request_retries.get()
+	with _process_lock:
+		_checkProcess()
+		if request_budget is not None and request_budget['remaining'] < 1:
+			metrics.inc('darksky_upstream_retries_denied_total', {'budget': 'request'})
+			return False
+		if _retry_tokens < 1:
+			metrics.inc('darksky_upstream_retries_denied_total', {'budget': 'process'})
+			return False
+		if request_budget is not None:
+			request_budget['remaining'] = request_budget['remaining'] - 1
+		_retry_tokens = _retry_tokens - 1
+	return True
+
+def _observeLatency(endpoint, seconds):
+	"""
+	Remember the latency of a successful call to an endpoint, for hedging
+	"""
+	with _process_lock:
+		_checkProcess()
+		latencies = _latencies.get(endpoint)
+		if latencies is None:
+			latencies = _latencies[endpoint] = collections.deque(maxlen=hedge_window)
+		latencies.append(seconds)
+
+def _hedgeDelay(endpoint):
+	"""
+	Return the number of seconds to wait for a call to an endpoint before
+	hedging it, or None if it shouldn't be hedged
+	"""
+	if endpoint not in hedge_endpoints:
+		return None
+	with _process_lock:
+		_checkProcess()
+		latencies = sorted(_latencies.get(endpoint, ()))
+	if len(latencies) < hedge_min_samples:
+		return None
+	return max(hedge_min_delay, latencies[int((len(latencies) - 1) * hedge_percentile / 100)])
+
+def _submitHedge(fn, *args):
+	"""
+	Run a call on the executor kept for hedged calls
+	"""
+	global _hedge_executor
+	with _process_lock:
+		_checkProcess()
+		if _hedge_executor is None:
+			_hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(hedge_max_workers, 2 * executor_max_workers), thread_name_prefix='hedge')
+		executor = _hedge_executor
+	return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def _runTask(fn, args, kwargs):
+	"""
+	Run a task that was submitted to the executor, keeping count of the
+	tasks that are running
+	"""
+	with _process_lock:
+		_executor_stats['running'] = _executor_stats['running'] + 1
+	try:
+		return fn(*args, **kwargs)
+	finally:
+		with _process_lock:
+			_executor_stats['running'] = _executor_stats['running'] - 1
+			_executor_stats['completed'] = _executor_stats['completed'] + 1
+
+def submit(fn, *args, **kwargs):
+	"""
+	Run a function in the background using the executor shared by the
+	whole process.  Use this instead of creating a ThreadPoolExecutor for
+	each request.
+
+	The function runs in a copy of the caller's context so that it can
+	see the caller's context variables, like the timings collected for
+	the request being handled.
+
+	fn: the function to run
+	args, kwargs: the arguments to pass to the function
+
+	Returns a concurrent.futures.Future object
+	"""
+	global _executor
+	with _process_lock:
+		_checkProcess()
+		if _executor is None:
+			_executor = concurrent.futures.ThreadPoolExecutor(max_workers=executor_max_workers, thread_name_prefix='upstream')
+		_executor_stats['submitted'] = _executor_stats['submitted'] + 1
+		executor = _executor
+	return executor.submit(contextvars.copy_context().run, _runTask, fn, args, kwargs)
+
+@contextlib.contextmanager
+def deadline(seconds, budgets=None):
+	"""
+	Set the deadline for building a response, for the duration of a
+	"with" block.  waitFor won't wait past it.
+
+	seconds: the number of seconds the whole response can take, or None
+	         for no deadline
+	budgets: a dictionary of the number of seconds that each section of
+	         the response, like "alerts", can take.  No section is given
+	         longer than the whole response.
+	"""
+	if seconds is None:
+		yield
+		return
+	start = time.perf_counter()
+	deadlines = {section: start + min(seconds, budget) for section, budget in (budgets or {}).items()}
+	deadlines[None] = start + seconds
+	token = _deadlines.set(deadlines)
+	try:
+		yield
+	finally:
+		_deadlines.reset(token)
+
+def waitFor(future, section=None):
+	"""
+	Wait for a task started by submit to finish, but not past the
+	deadline for a section of the response being built, if it has one
+
+	future: a concurrent.futures.Future object
+	section: the name of the section that the result is needed for
+
+	Returns the task's result.  Raises concurrent.futures.TimeoutError if
+	the deadline passes first, the task carries on in the background.
+	"""
+	deadlines = _deadlines.get()
+	if deadlines is None:
+		return future.result()
+	return future.result(timeout=max(0, deadlines.get(section, deadlines[None]) - time.perf_counter()))
+
+async def waitForAsync(task, section=None):
+	"""
+	The asynchronous version of waitFor, for asyncio tasks
+
+	Returns the task's result.  Raises asyncio.TimeoutError if the
+	deadline passes first, the task carries on in the background.
+	"""
+	deadlines = _deadlines.get()
+	if deadlines is None:
+		return await task
+	return await asyncio.wait_for(asyncio.shield(task), max(0, deadlines.get(section, deadlines[None]) - time.perf_counter()))
+
+async def runBlocking(fn, *args):
+	"""
+	Run a function that would hold up the event loop, like a cache lookup
+	or the conversion of upstream data, on the executor kept for them.  It
+	runs in the caller's context, so it shares the request's deadlines,
+	retry budget and timings.
+
+	Returns the function's result
+	"""
+	global _blocking_executor
+	with _process_lock:
+		_checkProcess()
+		if _blocking_executor is None:
+			_blocking_executor = concurrent.futures.ThreadPoolExecutor(max_workers=blocking_max_workers, thread_name_prefix='blocking')
+		executor = _blocking_executor
+	return await asyncio.get_running_loop().run_in_executor(executor, contextvars.copy_context().run, fn, *args)
+
+def flagPartial(output, sections):
+	"""
+	List sections of a DarkSky JSON structure in its "partial" flag,
+	because the data for them could not all be obtained in time
+	"""
+	if sections:
+		partial = output['flags'].setdefault('partial', [])
+		for section in sections:
+			if section not in partial:
+				partial.append(section)
+
+def executorStats():
+	"""
+	Report on the executor shared by the process and on the calls in
+	flight to each upstream host
+
+	Returns a dictionary
+	"""
+	with _process_lock:
+		_checkProcess()
+		stats = dict(_executor_stats)
+		stats['max_workers'] = executor_max_workers
+		#  Tasks that have been submitted but haven't started yet
+		stats['queued'] = stats['submitted'] - stats['running'] - stats['completed']
+		stats['upstreams'] = {}
+		for host, upstream in _upstreams.items():
+			stats['upstreams'][host] = {
+				'limit': upstream['limit'],
+				'active': upstream['active'],
+				'waiting': upstream['waiting']
+			}
+	return stats
+
+def _replayKey(url):
+	"""
+	Return the key that a URL's response is kept under in a replay
+	archive, the URL without the query parameters that change with time
+	"""
+	parts = urlsplit(url)
+	query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True) if name not in replay_ignored_parameters]
+	return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path, urlencode(query), ''))
+
+def _loadReplays():
+	"""
+	Read the replay archive, once per process.  Only the first recorded
+	response for each URL is kept so that a replay always serves the same
+	responses, no matter which order the requests come in.
+	"""
+	global _replays, _clock_timestamp
+	with _replay_lock:
+		if _replays is not None:
+			return _replays
+		if os.path.isdir(replay_archive):
+			filenames = sorted(glob.glob(os.path.join(replay_archive, '*.jsonl.gz')))
+		else:
+			filenames = [replay_archive]
+		records = []
+		for filename in filenames:
+			with gzip.open(filename, 'rt') as archive:
+				try:
+					for line in archive:
+						try:
+							records.append(json.loads(line))
+						except ValueError:
+							#  The last line of a file that was still being
+							#  written when it was copied
+							continue
+				except EOFError:
+					#  The file of a process that was killed, everything up
+					#  to its last flush is there
+					pass
+		records.sort(key=lambda record: record['time'])
+		replays = {}
+		for record in records:
+			replays.setdefault(_replayKey(record['url']), record)
+		if clock is None and records:
+			_clock_timestamp = records[0]['time']
+		print('Loaded {} recorded responses for {} URLs from {}'.format(len(records), len(replays), replay_archive))
+		_replays = replays
+		return _replays
+
+class _BufferedResponse:
+	"""
+	A response that has been read into memory, either a recorded one or
+	one received by aiohttp, that stands in for a requests.Response
+	"""
+
+	def __init__(self, status_code, headers, text, latency=0):
+		self.status_code = status_code
+		self.headers = headers
+		self.text = text
+		self.latency = latency
+
+	def json(self):
+		return json.loads(self.text)
+
+def _replay(url):
+	"""
+	Look up the recorded response to a URL
+
+	Returns a _BufferedResponse object.  URLs that weren't recorded get a
+	404 response.
+	"""
+	record = _loadReplays().get(_replayKey(url))
+	if record is None:
+		return _BufferedResponse(404, {}, 'Not in the replay archive')
+	return _BufferedResponse(record['status'], record['headers'], record['body'], record['latency'])
+
+def _record(url, response, latency):
+	"""
+	Append an upstream response to this process's recording file
+	"""
+	global _recording, _recording_pid
+	line = json.dumps({
+		'time': time.time(),
+		'url': url,
+		'status': response.status_code,
+		'headers': dict(response.headers),
+		'body': response.text,
+		'latency': round(latency, 4)
+	}, separators=(',', ':'))
+	with _recording_lock:
+		if _recording_pid != os.getpid():
+			os.makedirs(record_directory, exist_ok=True)
+			_recording = gzip.open(os.path.join(record_directory, '{}.{}.jsonl.gz'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid())), 'at')
+			_recording_pid = os.getpid()
+			atexit.register(_recording.close)
+		_recording.write(line + '\n')
+		#  Make sure that each response is complete on disk, in case the
+		#  process is killed rather than shut down
+		_recording.flush()
+
+def _clockTimestamp():
+	"""
+	Return the UNIX timestamp the clock is pinned to, or None if it isn't
+	"""
+	global _clock_timestamp
+	if _clock_timestamp is None and clock is not None:
+		try:
+			_clock_timestamp = float(clock)
+		except ValueError:
+			_clock_timestamp = _parseDatetime(clock)
+	if _clock_timestamp is None and replay_archive:
+		_loadReplays()
+	return _clock_timestamp
+
+def now(tz=None):
+	"""
+	Return the current time, like datetime.datetime.now, or the pinned
+	time if DARKSKY_API_CLOCK is set or responses are being replayed.  Use
+	this for anything that decides what goes into a forecast.
+
+	tz: a tzinfo object, or None for the local time without a time zone
+
+	Returns a datetime.datetime object
+	"""
+	timestamp = _clockTimestamp()
+	if timestamp is None:
+		return datetime.datetime.now(tz)
+	return datetime.datetime.fromtimestamp(timestamp, tz)
+
+def utcnow():
+	"""
+	Return the current (or pinned) UTC time without a time zone, like
+	datetime.datetime.utcnow
+	"""
+	return now(datetime.timezone.utc).replace(tzinfo=None)
+
+def _call(url, request_url, headers, flask_app, sending=None):
+	"""
+	Make one call to an upstream API, unless the host's circuit breaker
+	is open
+
+	sending: a function to call once the call has a slot in the host's
+	         concurrency limit and is about to be sent, or None
+
+	Returns a (response, error) tuple.  The response is None if no
+	response was received, in which case error describes what went wrong,
+	or is None if the call wasn't made because the breaker was open.
+	"""
+	breaker = getBreaker(url)
+	endpoint = metrics.classifyURL(url)
+	if not breaker.allow(flask_app):
+		metrics.inc('darksky_upstream_rejected_total', {'endpoint': endpoint})
+		return (None, None)
+	with _upstreamSlot(url):
+		if sending:
+			sending()
+		start = time.perf_counter()
+		try:
+			response = getSession(url).get(request_url, headers=headers, timeout=upstream_timeouts.get(endpoint, default_timeout))
+		except requests.exceptions.RequestException as e:
+			return _callFailed(url, breaker, time.perf_counter() - start, isinstance(e, requests.exceptions.Timeout), e, flask_app)
+		except:
+			metrics.observeUpstream(url, time.perf_counter() - start, 'error')
+			breaker.record(True, flask_app)
+			raise
+	return _callFinished(url, breaker, response, time.perf_counter() - start, flask_app)
+
+def _callFailed(url, breaker, latency, timed_out, exception, flask_app):
+	"""
+	Record a call to an upstream API that got no response
+
+	Returns a (response, error) tuple like _call
+	"""
+	metrics.observeUpstream(url, latency, 'timeout' if timed_out else 'error')
+	breaker.record(True, flask_app)
+	return (None, '{} calling {}: {}'.format('Timed out' if timed_out else 'Unable to connect', url, exception))
+
+def _callFinished(url, breaker, response, latency, flask_app):
+	"""
+	Record a call to an upstream API that got a response
+
+	Returns a (response, error) tuple like _call
+	"""
+	metrics.observeUpstream(url, latency, response.status_code)
+	breaker.record(response.status_code in breaker_failure_statuses, flask_app)
+	if response.status_code == 200:
+		_observeLatency(metrics.classifyURL(url), latency)
+	if record_directory:
+		_record(url, response, latency)
+	return (response, None)
+
+async def _callAsync(session, url, request_url, headers, flask_app):
+	"""
+	The asynchronous version of _call, using an aiohttp.ClientSession
+	"""
+	breaker = getBreaker(url)
+	endpoint = metrics.classifyURL(url)
+	if not breaker.allow(flask_app):
+		metrics.inc('darksky_upstream_rejected_total', {'endpoint': endpoint})
+		return (None, None)
+	connect_timeout, read_timeout = upstream_timeouts.get(endpoint, default_timeout)
+	start = time.perf_counter()
+	try:
+		async with session.get(request_url, headers=headers, timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)) as reply:
+			response = _BufferedResponse(reply.status, dict(reply.headers), await reply.text())
+	except asyncio.TimeoutError as e:
+		return _callFailed(url, breaker, time.perf_counter() - start, True, e, flask_app)
+	except aiohttp.ClientError as e:
+		return _callFailed(url, breaker, time.perf_counter() - start, False, e, flask_app)
+	except:
+		metrics.observeUpstream(url, time.perf_counter() - start, 'error')
+		breaker.record(True, flask_app)
+		raise
+	return _callFinished(url, breaker, response, time.perf_counter() - start, flask_app)
+
+def _failed(result):
+	"""
+	Decide whether the result of a call is worth retrying
+	"""
+	response, error = result
+	if response is None:
+		return error is not None
+	return response.status_code in retry_statuses
+
+def _hedgedCall(url, request_url, headers, flask_app, delay):
+	"""
+	Make a call to an upstream API and, if it hasn't answered within
+	delay seconds of being sent, a second one.  The first good answer
+	from either call is used.  A call that isn't needed is left to finish
+	in the background.
+
+	Returns a (response, error) tuple like _call, the first call's if
+	both of them fail
+	"""
+	endpoint = metrics.classifyURL(url)
+	sent = threading.Event()
+	calls = [_submitHedge(_call, url, request_url, headers, flask_app, sent.set)]
+	calls[0].add_done_callback(lambda call: sent.set())
+
+	#  The delay is counted from when the call is sent, not from when it
+	#  started waiting for a connection to the host
+	sent.wait()
+	done, pending = concurrent.futures.wait(calls, timeout=delay)
+	if not done and _spendRetry():
+		metrics.inc('darksky_upstream_retries_total', {'endpoint': endpoint, 'kind': 'hedge'})
+		calls.append(_submitHedge(_call, url, request_url, headers, flask_app))
+	pending = set(calls)
+	while pending:
+		done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+		for call in done:
+			result = call.result()
+			if not _failed(result):
+				if call is not calls[0]:
+					metrics.inc('darksky_upstream_hedges_won_total', {'endpoint': endpoint})
+				return result
+	return calls[0].result()
+
+async def _hedgedCallAsync(session, url, request_url, headers, flask_app, delay):
+	"""
+	The asynchronous version of _hedgedCall
+	"""
+	endpoint = metrics.classifyURL(url)
+	calls = [asyncio.ensure_future(_callAsync(session, url, request_url, headers, flask_app))]
+	done, pending = await asyncio.wait(calls, timeout=delay)
+	if not done and _spendRetry():
+		metrics.inc('darksky_upstream_retries_total', {'endpoint': endpoint, 'kind': 'hedge'})
+		calls.append(asyncio.ensure_future(_callAsync(session, url, request_url, headers, flask_app)))
+	pending = set(calls)
+	while pending:
+		done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+		for call in done:
+			result = call.result()
+			if not _failed(result):
+				if call is not calls[0]:
+					metrics.inc('darksky_upstream_hedges_won_total', {'endpoint': endpoint})
+				return result
+	return calls[0].result()
+
+def _retryDelay(url, attempt, result, flask_app):
+	"""
+	Log a retry and work out how long to wait before making it
+
+	Returns a number of seconds
+	"""
+	response, error = result
+	backoff = random.uniform(0, retry_backoff * (2 ** attempt))
+	message_text = 'Retrying {} in {:.2f} seconds after {}'.format(url, backoff, error or '[{}]'.format(response.status_code))
+	if flask_app:
+		flask_app.logger.warning(message_text)
+	print(message_text)
+	metrics.inc('darksky_upstream_retries_total', {'endpoint': metrics.classifyURL(url), 'kind': 'retry'})
+	return backoff
+
+def _retryingCall(url, request_url, headers, flask_app):
+	"""
+	Call an upstream API, hedging and retrying the call as the budgets
+	allow
+
+	Returns a (response, error) tuple like _call
+	"""
+	endpoint = metrics.classifyURL(url)
+	retry = urlsplit(url).netloc.lower() in retry_hosts
+	_earnRetries()
+	attempt = 0
+	while True:
+		delay = _hedgeDelay(endpoint)
+		if delay is None:
+			result = _call(url, request_url, headers, flask_app)
+		else:
+			result = _hedgedCall(url, request_url, headers, flask_app, delay)
+		if not retry or attempt >= retry_attempts or not _failed(result) or not _spendRetry():
+			return result
+		attempt = attempt + 1
+		time.sleep(_retryDelay(url, attempt, result, flask_app))
+
+async def _retryingCallAsync(session, url, request_url, headers, flask_app):
+	"""
+	The asynchronous version of _retryingCall
+	"""
+	endpoint = metrics.classifyURL(url)
+	retry = urlsplit(url).netloc.lower() in retry_hosts
+	_earnRetries()
+	attempt = 0
+	while True:
+		delay = _hedgeDelay(endpoint)
+		if delay is None:
+			result = await _callAsync(session, url, request_url, headers, flask_app)
+		else:
+			result = await _hedgedCallAsync(session, url, request_url, headers, flask_app, delay)
+		if not retry or attempt >= retry_attempts or not _failed(result) or not _spendRetry():
+			return result
+		attempt = attempt + 1
+		await asyncio.sleep(_retryDelay(url, attempt, result, flask_app))
+
+def _requestURL(url):
+	"""
+	Return the URL that a call is sent to, which is the stand-in's if
+	DARKSKY_API_UPSTREAM is set
+	"""
+	if not upstream_override:
+		return url
+	parts = urlsplit(url)
+	return '{}/{}{}'.format(upstream_override.rstrip('/'), parts.netloc, url[url.index(parts.netloc) + len(parts.netloc):])
+
+def _result(url, response, error, flask_app):
+	"""
+	Turn the response to an upstream call into the result of getURL,
+	logging anything that went wrong
+	"""
+	if response is None:
+		if error:
+			if flask_app:
+				flask_app.logger.error(error)
+			print(error)
+		return False
 	if response.status_code == 200:
 		return response.json()
 	elif response.status_code == 403:
@@ -39,6 +990,148 @@ def getURL(url, headers=None, flask_app=None):
 	print(message_text)
 	return False
 
+def _urlCache():
+	"""
+	Returns the DarkskyAPICache.ExpiringCache that upstream responses are
+	cached in
+	"""
+	global _url_cache
+	with _url_cache_lock:
+		if _url_cache is None:
+			_url_cache = DarkskyAPICache.ExpiringCache('upstream_responses', url_cache_memory_bytes, url_cache_disk)
+		return _url_cache
+
+def _cachedURL(url):
+	"""
+	Look up the cached response to a URL
+
+	Returns the decoded JSON, or None if the URL's endpoint isn't cached
+	or there is no unexpired response for it
+	"""
+	if not url_cache_ttls.get(metrics.classifyURL(url)):
+		return None
+	result = _urlCache().get(url)
+	metrics.cacheLookup('upstream', 'miss' if result is None else 'hit')
+	return result
+
+def _cacheTTL(response, default):
+	"""
+	Work out how long a response can be cached for from its Cache-Control
+	or Expires header
+
+	default: the number of seconds to use if it has neither
+
+	Returns a number of seconds, 0 if it mustn't be cached
+	"""
+	response_headers = {name.lower(): value for name, value in response.headers.items()}
+	directives = {}
+	for directive in response_headers.get('cache-control', '').split(','):
+		name, _, value = directive.strip().partition('=')
+		directives[name.lower()] = value.strip('"')
+	if 'no-store' in directives or 'no-cache' in directives:
+		return 0
+	max_age = directives.get('s-maxage', directives.get('max-age'))
+	if max_age is not None:
+		try:
+			return int(max_age) - int(response_headers.get('age', 0))
+		except ValueError:
+			return 0
+	if 'expires' in response_headers:
+		#  An Expires date that can't be read means that the response has
+		#  already expired
+		try:
+			expires = email.utils.parsedate_to_datetime(response_headers['expires']).timestamp()
+			date = email.utils.parsedate_to_datetime(response_headers['date']).timestamp() if 'date' in response_headers else time.time()
+		except (TypeError, ValueError):
+			return 0
+		return expires - date
+	return default
+
+def _cacheURL(url, response, result):
+	"""
+	Cache a good response to a URL, if its endpoint is cached
+	"""
+	default = url_cache_ttls.get(metrics.classifyURL(url))
+	if not default or not result or response.status_code != 200:
+		return
+	ttl = _cacheTTL(response, default)
+	if ttl > 0:
+		_urlCache().put(url, result, ttl, len(response.text))
+
+def getURL(url, headers=None, flask_app=None, statuses=None):
+	"""
+	Get the results of an API call to the NOAA or Climacell weather APIs
+	and handle any errors which might occur.
+	
+	url: a string
+	headers: a "requests"-style dictionary array of header names and values
+	flask_app : an object containing a Flask application's details.  Used
+	            to allow us to write into the application log.
+	statuses: if given, a dictionary that the HTTP status of the response
+	          is added to, keyed by URL, so that the caller can tell why
+	          the call failed
+	
+	Returns a JSON object or "False" if an error occurred.  Responses
+	that come from the cache are shared and must not be changed.
+	"""
+	cached = _cachedURL(url)
+	if cached is not None:
+		return cached
+	if replay_archive:
+		start = time.perf_counter()
+		response = _replay(url)
+		if replay_latency:
+			time.sleep(response.latency)
+		metrics.observeUpstream(url, time.perf_counter() - start, response.status_code)
+		error = None
+	else:
+		response, error = _retryingCall(url, _requestURL(url), headers, flask_app)
+	if statuses is not None and response is not None:
+		statuses[url] = response.status_code
+	result = _result(url, response, error, flask_app)
+	_cacheURL(url, response, result)
+	return result
+
+def createAsyncSession():
+	"""
+	Create the aiohttp.ClientSession that getURLAsync uses.  It must be
+	created, used and closed on the same event loop.
+
+	Returns an aiohttp.ClientSession object
+	"""
+	connector = aiohttp.TCPConnector(limit=0, limit_per_host=async_connections_per_host)
+	return aiohttp.ClientSession(connector=connector)
+
+async def getURLAsync(session, url, headers=None, flask_app=None, statuses=None):
+	"""
+	The asynchronous version of getURL
+
+	session: the aiohttp.ClientSession returned by createAsyncSession
+
+	Returns a JSON object or "False" if an error occurred
+	"""
+	#  Only the disk tier of the cache has to be read on another thread
+	cached = await runBlocking(_cachedURL, url) if url_cache_disk else _cachedURL(url)
+	if cached is not None:
+		return cached
+	if replay_archive:
+		start = time.perf_counter()
+		response = _replay(url)
+		if replay_latency:
+			await asyncio.sleep(response.latency)
+		metrics.observeUpstream(url, time.perf_counter() - start, response.status_code)
+		error = None
+	else:
+		response, error = await _retryingCallAsync(session, url, _requestURL(url), headers, flask_app)
+	if statuses is not None and response is not None:
+		statuses[url] = response.status_code
+	result = await runBlocking(_result, url, response, error, flask_app)
+	if url_cache_disk:
+		await runBlocking(_cacheURL, url, response, result)
+	else:
+		_cacheURL(url, response, result)
+	return result
+
 def getKeyValue(dictionary_element, key_list, func=None):
 	"""
 	Returns a specific value from a dictionary array, in this case from
@@ -73,6 +1166,63 @@ def getKeyValue(dictionary_element, key_list, func=None):
 	else:
 		return dictionary_element
 
+#  The shapes of the ISO8601 date and duration strings that NOAA uses,
+#  for example 2020-04-10T16:00:00+00:00 and P6DT22H.  These are parsed
+#  directly, anything else is handed to isodate.
+_datetime_pattern = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:Z|([+-])(\d\d):?(\d\d))')
+_duration_pattern = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?')
+
+#  The number of parsed time strings that parseInterval remembers
+interval_cache_size = 8192
+
+def _parseDatetime(dt_str):
+	"""
+	Convert an ISO8601 date string to a UNIX timestamp
+	"""
+	match = _datetime_pattern.fullmatch(dt_str)
+	if match:
+		year, month, day, hour, minute, second, sign, offset_hours, offset_minutes = match.groups()
+		try:
+			timestamp = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), tzinfo=datetime.timezone.utc).timestamp()
+		except ValueError:
+			timestamp = None
+		if timestamp is not None:
+			if sign:
+				offset = (int(offset_hours) * 3600) + (int(offset_minutes) * 60)
+				timestamp = timestamp - offset if sign == '+' else timestamp + offset
+			return int(timestamp)
+	return int(isodate.parse_datetime(dt_str).timestamp())
+
+def _parseDuration(duration_str):
+	"""
+	Convert an ISO8601 duration string to a number of seconds
+	"""
+	match = _duration_pattern.fullmatch(duration_str)
+	if match and duration_str not in ('P', 'PT') and not duration_str.endswith('T'):
+		days, hours, minutes, seconds = [int(x) if x else 0 for x in match.groups()]
+		return (days * 86400) + (hours * 3600) + (minutes * 60) + seconds
+	return None
+
+@functools.lru_cache(maxsize=interval_cache_size)
+def _parseInterval(time_str):
+	"""
+	Parse a time string for parseInterval.  Results are cached because
+	NOAA repeats the same strings over and over again.
+
+	Returns a (start, end) tuple, end is None if time_str doesn't include
+	a duration
+	"""
+	split_time_str = time_str.split('/')
+	start = _parseDatetime(split_time_str[0])
+	if len(split_time_str) != 2:
+		return (start, None)
+	seconds = _parseDuration(split_time_str[1])
+	if seconds is not None:
+		return (start, start + seconds)
+	#  Leave durations measured in weeks, months or years to isodate
+	start_dt = isodate.parse_datetime(split_time_str[0])
+	return (start, int((start_dt + isodate.parse_duration(split_time_str[1])).timestamp()))
+
 def parseInterval(time_str, tz_string=None):
 	"""
 	Parse the ISO8601 date strings with interval/duration specs that NOAA
@@ -89,11 +1239,8 @@ def parseInterval(time_str, tz_string=None):
 	was specified in the time_str, then only a "start" timestamp element
 	will be returned.
 	"""
-	interval = {}
-	split_time_str = time_str.split('/')
-	start = isodate.parse_datetime(split_time_str[0])
-	interval['start'] = int(start.timestamp())
-	if len(split_time_str) == 2:
-		end = start + isodate.parse_duration(split_time_str[1])
-		interval['end'] = int(end.timestamp())
+	start, end = _parseInterval(time_str)
+	interval = {'start': start}
+	if end is not None:
+		interval['end'] = end
 	return interval
@@ -0,0 +1,426 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Counters, gauges and histograms describing the application's work, in
+the Prometheus text format.  Each worker process keeps its own metrics
+and writes them to a file of its own every few seconds.  The /metrics
+endpoint adds up the files from all of the workers.
+"""
+
+import contextvars
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+#  The directory that holds each process's metrics file.  Like the log
+#  file, it is written into the application's current directory.
+metrics_directory = 'darksky-api.metrics'
+
+#  The number of seconds between writes of each process's metrics file
+metrics_flush_interval = 5
+
+#  The counters and histograms of processes that have exited are added to
+#  this file in the metrics directory, and their own files are removed
+metrics_archive = 'archive.json'
+
+#  Histogram buckets, in seconds
+upstream_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+request_buckets = [0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+#  The metrics that we keep.  Each entry is (type, help text, histogram
+#  buckets).
+_metrics = {
+	'darksky_requests_total': ('counter', 'Requests handled, by route and HTTP status', None),
+	'darksky_request_seconds': ('histogram', 'Time taken to handle requests, by route', request_buckets),
+	'darksky_requests_in_flight': ('gauge', 'Requests being handled right now, by route', None),
+	'darksky_upstream_requests_total': ('counter', 'Calls to the NOAA and Climacell APIs, by endpoint and HTTP status', None),
+	'darksky_upstream_request_seconds': ('histogram', 'Time taken by calls to the NOAA and Climacell APIs, by endpoint', upstream_buckets),
+	'darksky_transform_cpu_seconds': ('summary', 'CPU time spent converting upstream data to DarkSky blocks, by source and section', None),
+	'darksky_cache_requests_total': ('counter', 'Cache lookups, by cache and result', None),
+	'darksky_cache_hit_ratio': ('gauge', 'Fraction of cache lookups that were answered from the cache, by cache', None),
+	'darksky_fallback_responses_total': ('counter', 'Responses built from the last known good store because no fresh data could be obtained', None),
+	'darksky_executor_tasks': ('gauge', 'Tasks in the shared upstream executor, by state', None),
+	'darksky_upstream_calls_in_flight': ('gauge', 'Calls in flight or waiting for a connection, by upstream host and state', None),
+	'darksky_upstream_rejected_total': ('counter', 'Calls to the NOAA and Climacell APIs that failed fast because the circuit breaker for the host was open, by endpoint', None),
+	'darksky_circuit_breakers': ('gauge', 'Processes whose circuit breaker for an upstream host is in each state, by host and state', None),
+	'darksky_circuit_breaker_transitions_total': ('counter', 'Changes of state of the upstream circuit breakers, by host and the state changed to', None),
+	'darksky_upstream_retries_total': ('counter', 'Retried and hedged calls to the NOAA and Climacell APIs, by endpoint and kind', None),
+	'darksky_upstream_hedges_won_total': ('counter', 'Hedged calls that answered before the call they were hedging, by endpoint', None),
+	'darksky_upstream_retries_denied_total': ('counter', 'Retries and hedged calls that were not made because a retry budget was spent, by budget', None),
+	'darksky_prefetches_total': ('counter', 'Responses built ahead of time for hot locations, by result', None),
+	'darksky_prefetch_locations': ('gauge', 'Locations being prefetched', None),
+	'darksky_prefetch_leaders': ('gauge', 'Processes doing the prefetching', None),
+	'darksky_climacell_budget_total': ('counter', 'Climacell data used for responses, by endpoint and whether it was called, cached or skipped to save the quota', None)
+}
+
+#  The rules that sort upstream URLs into endpoints.  Each entry is a
+#  (host, path regular expression, endpoint) tuple, the first match wins.
+_endpoint_rules = [
+	('api.weather.gov', r'/points/', 'points'),
+	('api.weather.gov', r'/gridpoints/[^/]+/[^/]+/stations$', 'stations'),
+	('api.weather.gov', r'/stations/[^/]+/observations', 'observations'),
+	('api.weather.gov', r'/gridpoints/[^/]+/[^/]+/forecast/hourly$', 'forecastHourly'),
+	('api.weather.gov', r'/gridpoints/[^/]+/[^/]+/forecast$', 'forecast'),
+	('api.weather.gov', r'/gridpoints/[^/]+/[^/]+$', 'gridData'),
+	('api.weather.gov', r'/alerts', 'alerts'),
+	('api.weather.gov', r'/zones', 'zones'),
+	('api.climacell.co', r'/weather/realtime', 'climacell_realtime'),
+	('api.climacell.co', r'/weather/nowcast', 'climacell_nowcast'),
+	('api.climacell.co', r'/weather/forecast/hourly', 'climacell_hourly'),
+	('api.climacell.co', r'/weather/forecast/daily', 'climacell_daily')
+]
+_endpoint_rules = [(host, re.compile(pattern), endpoint) for host, pattern, endpoint in _endpoint_rules]
+
+#  This process's metrics, keyed by (name, labels) where labels is a
+#  tuple of (label, value) tuples.  Counters and gauges hold a number,
+#  histograms a list of bucket counts followed by the sum and the count,
+#  and summaries a [sum, count] list.
+_values = {}
+_values_pid = None
+_lock = threading.Lock()
+_writer_pid = None
+
+#  Functions that are called to update gauges before the metrics are
+#  written
+_collectors = []
+
+#  The timings of the request being handled, for its Server-Timing
+#  header.  Tasks that DarkskyAPIFunctions.submit runs in the background
+#  share their caller's timings.
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+def _labels(labels):
+	return tuple(sorted((labels or {}).items()))
+
+def _checkProcess():
+	"""
+	Throw away the metrics inherited from a parent process and start
+	writing this process's metrics file.  Must be called with _lock held.
+	"""
+	global _values_pid, _writer_pid
+	if _values_pid != os.getpid():
+		_values.clear()
+		_values_pid = os.getpid()
+	if _writer_pid != os.getpid():
+		_writer_pid = os.getpid()
+		threading.Thread(target=_writer, daemon=True).start()
+
+def inc(name, labels=None, value=1):
+	"""
+	Add to a counter, or to a gauge
+	"""
+	key = (name, _labels(labels))
+	with _lock:
+		_checkProcess()
+		_values[key] = _values.get(key, 0) + value
+
+def setGauge(name, labels=None, value=0):
+	"""
+	Set a gauge
+	"""
+	with _lock:
+		_checkProcess()
+		_values[(name, _labels(labels))] = value
+
+def observe(name, labels=None, value=0):
+	"""
+	Record a value in a histogram or a summary
+	"""
+	kind, description, buckets = _metrics[name]
+	key = (name, _labels(labels))
+	with _lock:
+		_checkProcess()
+		entry = _values.get(key)
+		if kind == 'histogram':
+			if entry is None:
+				entry = _values[key] = [0] * (len(buckets) + 2)
+			for i, bound in enumerate(buckets):
+				if value <= bound:
+					entry[i] = entry[i] + 1
+					break
+		elif entry is None:
+			entry = _values[key] = [0, 0]
+		entry[-2] = entry[-2] + value
+		entry[-1] = entry[-1] + 1
+
+def classifyURL(url):
+	"""
+	Return the name of the upstream endpoint that a URL calls, like
+	"points" or "climacell_hourly", or "other"
+	"""
+	parts = urlsplit(url)
+	host = parts.netloc.lower()
+	for rule_host, pattern, endpoint in _endpoint_rules:
+		if host == rule_host and pattern.search(parts.path):
+			return endpoint
+	return 'other'
+
+def observeUpstream(url, seconds, status):
+	"""
+	Record a call to an upstream API
+
+	url: the URL that was called
+	seconds: the time the call took
+	status: the HTTP status code, "timeout" if the call timed out or
+	        "error" if no response was received for another reason
+	"""
+	endpoint = classifyURL(url)
+	inc('darksky_upstream_requests_total', {'endpoint': endpoint, 'status': str(status)})
+	observe('darksky_upstream_request_seconds', {'endpoint': endpoint}, seconds)
+	_addTiming('upstream-' + endpoint, seconds)
+
+def cacheLookup(cache, result):
+	"""
+	Record a cache lookup
+
+	cache: the name of the cache
+	result: "hit", "stale" or "miss"
+	"""
+	inc('darksky_cache_requests_total', {'cache': cache, 'result': result})
+
+class TransformTimer:
+	"""
+	Measure the CPU time spent on each section of a transform.  Call
+	section() at the start of each section and stop() at the end of the
+	last one.  Only the calling thread's CPU time is counted, not the
+	time spent waiting for other threads.
+	"""
+
+	def __init__(self, source):
+		"""
+		source: the name of the upstream service, like "noaa"
+		"""
+		self.source = source
+		self.current = None
+		self.started = None
+
+	def section(self, name):
+		"""
+		End the current section, if there is one, and start another
+		"""
+		self.stop()
+		self.current = name
+		self.started = time.thread_time()
+
+	def stop(self):
+		"""
+		End the current section
+		"""
+		if self.current is not None:
+			seconds = time.thread_time() - self.started
+			observe('darksky_transform_cpu_seconds', {'source': self.source, 'section': self.current}, seconds)
+			_addTiming('cpu-{}-{}'.format(self.source, self.current), seconds)
+			self.current = None
+
+def startRequest():
+	"""
+	Start collecting the timings for a request's Server-Timing header
+	"""
+	_request_timings.set({})
+
+def _addTiming(name, seconds):
+	timings = _request_timings.get()
+	if timings is not None:
+		#  Several threads can add to the same request's timings
+		with _lock:
+			timings[name] = timings.get(name, 0) + seconds
+
+def serverTiming(total_seconds):
+	"""
+	Return the value of the Server-Timing header for the request being
+	handled.  Upstream calls run in parallel so their times can add up to
+	more than the total.
+	"""
+	timings = dict(_request_timings.get() or {})
+	entries = ['total;dur={:.1f}'.format(total_seconds * 1000)]
+	for name in sorted(timings):
+		entries.append('{};dur={:.1f}'.format(name, timings[name] * 1000))
+	return ', '.join(entries)
+
+def addCollector(collector):
+	"""
+	Register a function that updates gauges.  It is called before the
+	metrics are written.
+	"""
+	_collectors.append(collector)
+
+def flush():
+	"""
+	Write this process's metrics file now
+	"""
+	for collector in _collectors:
+		try:
+			collector()
+		except Exception as e:
+			print('Unable to collect metrics: {}'.format(e))
+	with _lock:
+		_checkProcess()
+		values = [[name, labels, value] for (name, labels), value in _values.items()]
+	try:
+		os.makedirs(metrics_directory, exist_ok=True)
+		filename = os.path.join(metrics_directory, '{}.json'.format(os.getpid()))
+		with open(filename + '.tmp', 'w') as f:
+			json.dump(values, f)
+		os.replace(filename + '.tmp', filename)
+	except OSError as e:
+		print('Unable to write the metrics file: {}'.format(e))
+
+def _writer():
+	"""
+	Write this process's metrics file every metrics_flush_interval seconds
+	"""
+	while True:
+		time.sleep(metrics_flush_interval)
+		flush()
+
+def _alive(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
+
+def _read(filename):
+	"""
+	Read a metrics file
+
+	Returns the file's [name, labels, value] entries, or None if it
+	couldn't be read
+	"""
+	try:
+		with open(os.path.join(metrics_directory, filename), 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError) as e:
+		print('Unable to read the metrics file {}: {}'.format(filename, e))
+		return None
+
+def _add(merged, values, gauges):
+	"""
+	Add the entries of a metrics file to a dictionary like _values,
+	leaving out the gauges unless gauges is True
+	"""
+	for name, labels, value in values:
+		if name not in _metrics or (_metrics[name][0] == 'gauge' and not gauges):
+			continue
+		key = (name, tuple(tuple(label) for label in labels))
+		if isinstance(value, list):
+			total = merged.setdefault(key, [0] * len(value))
+			merged[key] = [a + b for a, b in zip(total, value)]
+		else:
+			merged[key] = merged.get(key, 0) + value
+
+def _archive():
+	"""
+	Add the metrics files of processes that have exited to the archive
+	file and remove them, so that the directory doesn't grow with every
+	worker that is restarted.  The processes take turns, by a lock on the
+	archive, so no file is added twice.
+	"""
+	try:
+		with open(os.path.join(metrics_directory, metrics_archive + '.lock'), 'w') as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			dead = [f for f in os.listdir(metrics_directory) if f.endswith('.json') and f != metrics_archive and not _alive(int(f.split('.')[0]))]
+			if not dead:
+				return
+			archived = {}
+			if os.path.exists(os.path.join(metrics_directory, metrics_archive)):
+				values = _read(metrics_archive)
+				if values is None:
+					return
+				_add(archived, values, False)
+			for filename in dead:
+				#  The files are replaced whole, so one that can't be read
+				#  never will be
+				values = _read(filename)
+				if values is not None:
+					_add(archived, values, False)
+			filename = os.path.join(metrics_directory, metrics_archive)
+			with open(filename + '.tmp', 'w') as f:
+				json.dump([[name, labels, value] for (name, labels), value in archived.items()], f)
+			os.replace(filename + '.tmp', filename)
+			for filename in dead:
+				os.remove(os.path.join(metrics_directory, filename))
+	except OSError as e:
+		print('Unable to archive the metrics files: {}'.format(e))
+
+def _merged():
+	"""
+	Add up the metrics files of all of the processes, and the archive of
+	the ones that have exited.  Gauges are only taken from processes that
+	are still running.
+
+	Returns a dictionary like _values
+	"""
+	_archive()
+	merged = {}
+	try:
+		filenames = [f for f in os.listdir(metrics_directory) if f.endswith('.json')]
+	except OSError:
+		filenames = []
+	for filename in filenames:
+		values = _read(filename)
+		if values is None:
+			continue
+		alive = filename != metrics_archive and _alive(int(filename.split('.')[0]))
+		_add(merged, values, alive)
+	return merged
+
+def _formatLabels(labels, extra=()):
+	labels = list(labels) + list(extra)
+	if not labels:
+		return ''
+	return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+def render():
+	"""
+	Write this process's metrics and then add up the metrics of all of
+	the processes
+
+	Returns the metrics in the Prometheus text format
+	"""
+	flush()
+	merged = _merged()
+
+	#  The cache hit ratios are worked out from the lookup counts
+	lookups = {}
+	for (name, labels), value in merged.items():
+		if name == 'darksky_cache_requests_total':
+			labels = dict(labels)
+			totals = lookups.setdefault(labels['cache'], [0, 0])
+			totals[1] = totals[1] + value
+			if labels['result'] != 'miss':
+				totals[0] = totals[0] + value
+	for cache, (hits, total) in lookups.items():
+		if total:
+			merged[('darksky_cache_hit_ratio', (('cache', cache),))] = hits / total
+
+	lines = []
+	for name, (kind, description, buckets) in _metrics.items():
+		entries = sorted((labels, value) for (n, labels), value in merged.items() if n == name)
+		if not entries:
+			continue
+		lines.append('# HELP {} {}'.format(name, description))
+		lines.append('# TYPE {} {}'.format(name, kind))
+		for labels, value in entries:
+			if kind == 'histogram':
+				cumulative = 0
+				for bound, count in zip(buckets, value):
+					cumulative = cumulative + count
+					lines.append('{}_bucket{} {}'.format(name, _formatLabels(labels, [('le', bound)]), cumulative))
+				lines.append('{}_bucket{} {}'.format(name, _formatLabels(labels, [('le', '+Inf')]), value[-1]))
+				lines.append('{}_sum{} {}'.format(name, _formatLabels(labels), value[-2]))
+				lines.append('{}_count{} {}'.format(name, _formatLabels(labels), value[-1]))
+			elif kind == 'summary':
+				lines.append('{}_sum{} {}'.format(name, _formatLabels(labels), value[0]))
+				lines.append('{}_count{} {}'.format(name, _formatLabels(labels), value[1]))
+			else:
+				lines.append('{}{} {}'.format(name, _formatLabels(labels), value))
+	return '\n'.join(lines) + '\n'
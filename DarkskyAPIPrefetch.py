@@ -0,0 +1,251 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+Keep the responses for the locations that are requested most often, or
+that are listed in the configuration, built ahead of time in the
+response cache so that requests for them never wait on NOAA or
+Climacell.  Every worker process counts the locations it is asked for.
+One of them, the leader, does the prefetching.
+"""
+
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+#  Application modules
+import DarkskyAPICache
+import DarkskyAPIMetrics as metrics
+
+#  Prefetching can be turned off, for benchmarks for example, by setting
+#  the DARKSKY_API_PREFETCH environment variable to 0
+prefetch_enabled = os.environ.get('DARKSKY_API_PREFETCH', '1') != '0'
+
+#  The number of seconds between the leader's passes over the locations,
+#  and between each process's attempts to become the leader
+prefetch_interval = 30
+
+#  A location is refreshed prefetch_lead seconds before its response
+#  goes out of date, so that requests for it never find a stale one.  It
+#  is more than prefetch_interval so that a pass always comes in time,
+#  and a location is never refreshed more than once a pass.
+prefetch_lead = 60
+
+#  Locations that are requested at least hot_location_min_requests times
+#  in hot_location_window seconds are prefetched, hot_location_count of
+#  them at most
+hot_location_count = 20
+hot_location_min_requests = 3
+hot_location_window = 6 * 3600
+
+class Prefetcher:
+	"""
+	A background thread, in each process, that shares the process's
+	request counts and, in the leader, refreshes the hot locations.  The
+	leader is the process that holds an exclusive lock on a file in
+	DarkskyAPICache.lock_directory.  It keeps the lock until it exits and
+	then another process takes over.
+
+	Only the hashes of the API keys are written to the shared table.
+	Each process keeps the keys themselves, for the locations it has been
+	asked for and the configured ones, in memory, so the leader only
+	prefetches the hot locations whose keys it has seen.
+	"""
+
+	def __init__(self, name, build, response_cache):
+		"""
+		name: a name for the leader's lock file and the table that holds
+		      the request counts
+		build: a function that takes a location's latitude, longitude,
+		       API key, exclude and extend, builds its response and
+		       returns a (DarkSky JSON structure, expiration time) tuple.
+		       The structure is "False" if no data could be obtained.
+		response_cache: the DarkskyAPICache.ResponseCache that requests
+		                are answered from
+		"""
+		self.name = name
+		self.build = build
+		self.response_cache = response_cache
+		self.requests = DarkskyAPICache.PersistentCache(name + '_requests')
+		self._configured = {}
+		self._apikeys = {}
+		self._counts = {}
+		self._schedule = {}
+		self._lock = threading.Lock()
+		self._thread_pid = None
+		self._lock_file = None
+
+	def add(self, key, latitude, longitude, apikey, exclude=(), extend=None):
+		"""
+		Always prefetch a location, however often it is requested
+
+		key: the location's response cache key
+		"""
+		self._configured[key] = self._location(latitude, longitude, apikey, exclude, extend)
+		self._apikeys[self._apikeyHash(apikey)] = apikey
+
+	def recordRequest(self, key, latitude, longitude, apikey, exclude=(), extend=None):
+		"""
+		Count a request for a location.  The counts are written to the
+		shared table by the background thread.
+
+		key: the location's response cache key
+		"""
+		if not prefetch_enabled:
+			return
+		self._start()
+		with self._lock:
+			self._apikeys[self._apikeyHash(apikey)] = apikey
+			count = self._counts.get(key)
+			if count is None:
+				count = self._location(latitude, longitude, apikey, exclude, extend)
+				count['requests'] = 0
+				self._counts[key] = count
+			count['requests'] = count['requests'] + 1
+
+	def _location(self, latitude, longitude, apikey, exclude, extend):
+		return {
+			'latitude': latitude,
+			'longitude': longitude,
+			'apikey_hash': self._apikeyHash(apikey),
+			'exclude': list(exclude),
+			'extend': extend
+		}
+
+	def _start(self):
+		"""
+		Start the background thread in each process when it handles its
+		first request, i.e. after uwsgi has forked the workers.  A thread
+		started in the uwsgi master process could make it the leader.
+		"""
+		if not prefetch_enabled:
+			return
+		with self._lock:
+			if self._thread_pid == os.getpid():
+				return
+			self._thread_pid = os.getpid()
+			self._lock_file = None
+			self._counts = {}
+			self._schedule = {}
+		threading.Thread(target=self._run, daemon=True).start()
+
+	def _run(self):
+		while True:
+			time.sleep(prefetch_interval)
+			try:
+				self._flushCounts()
+				if self._lead():
+					self._prefetch()
+			except Exception as e:
+				print('Prefetching failed: {}'.format(e))
+
+	def _flushCounts(self):
+		"""
+		Write this process's request counts for the current hour to the
+		shared table.  Each process and hour has its own entries, so no
+		other process writes them, and they expire at the end of the
+		window.
+		"""
+		with self._lock:
+			counts = self._counts
+			self._counts = {}
+		if not counts:
+			return
+		hour = int(time.time() // 3600)
+		items = []
+		for key, count in counts.items():
+			entry_key = '{}|{}|{}'.format(hour, os.getpid(), key)
+			previous = self.requests.get(entry_key)
+			if previous:
+				count['requests'] = count['requests'] + previous['requests']
+			items.append((entry_key, count))
+		self.requests.putMany(items, hot_location_window)
+
+	def _lead(self):
+		"""
+		Try to become the leader, if this process isn't already
+
+		Returns True if this process is the leader
+		"""
+		if self._lock_file is not None:
+			return True
+		os.makedirs(DarkskyAPICache.lock_directory, exist_ok=True)
+		lock_file = open(os.path.join(DarkskyAPICache.lock_directory, '{}.leader.lock'.format(self.name)), 'a')
+		try:
+			fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except BlockingIOError:
+			lock_file.close()
+			return False
+		self._lock_file = lock_file
+		metrics.setGauge('darksky_prefetch_leaders', None, 1)
+		print('Process {} is prefetching the hot locations'.format(os.getpid()))
+		return True
+
+	def hotLocations(self):
+		"""
+		Returns a dictionary of the configured locations and the most
+		requested ones, keyed by response cache key
+		"""
+		totals = {}
+		for entry_key, count in self.requests.items():
+			if 'apikey_hash' not in count:
+				continue
+			key = entry_key.split('|', 2)[2]
+			total = totals.setdefault(key, dict(count, requests=0))
+			total['requests'] = total['requests'] + count['requests']
+		hot = sorted([(total['requests'], key) for key, total in totals.items() if total['requests'] >= hot_location_min_requests], reverse=True)
+		locations = {key: totals[key] for requests, key in hot[:hot_location_count]}
+		locations.update(self._configured)
+		return locations
+
+	def _prefetch(self):
+		"""
+		Refresh the hot locations whose responses are due
+		"""
+		now = time.time()
+		locations = {key: location for key, location in self.hotLocations().items() if location['apikey_hash'] in self._apikeys}
+		metrics.setGauge('darksky_prefetch_locations', None, len(locations))
+
+		for key in list(self._schedule):
+			if key not in locations:
+				del self._schedule[key]
+
+		for key, location in sorted(locations.items(), key=lambda item: self._due(item[0])):
+			if self._due(key) > now:
+				continue
+			started = time.time()
+			try:
+				output, expires = self.build(location['latitude'], location['longitude'], self._apikeys[location['apikey_hash']], tuple(location['exclude']), location['extend'])
+			except Exception as e:
+				print('Unable to prefetch {}: {}'.format(key, e))
+				output = False
+			if not output:
+				metrics.inc('darksky_prefetches_total', {'result': 'failed'})
+				self._schedule[key] = started + prefetch_interval
+				continue
+
+			#  Refresh it again before it goes out of date.  The Climacell
+			#  calls are kept within the key's quota by ClimacellWeatherAPI,
+			#  which uses the data from earlier calls when it has to.
+			self._schedule[key] = max(expires - prefetch_lead, started + prefetch_interval)
+			self.response_cache.put(key, output, expires)
+			metrics.inc('darksky_prefetches_total', {'result': 'ok'})
+
+	def _due(self, key):
+		"""
+		Returns the time a location is due to be refreshed.  Locations
+		that the leader hasn't refreshed yet are due prefetch_lead seconds
+		before their cached response, if any, goes stale.
+		"""
+		due = self._schedule.get(key)
+		if due is None:
+			cached = self.response_cache.shared.get(key)
+			due = cached['expires'] - prefetch_lead if cached else 0
+			self._schedule[key] = due
+		return due
+
+	def _apikeyHash(self, apikey):
+		return hashlib.sha256(apikey.encode()).hexdigest()[:16]
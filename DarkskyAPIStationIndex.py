@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+A spatial index used to find the observation stations nearest to a
+location
+"""
+
+import collections
+import heapq
+import math
+import threading
+
+#  geopy may be available in distro packages, or may need to be installed
+#  with pip
+from geopy.distance import great_circle
+
+#  The number of station indexes that each process keeps in memory
+index_cache_size = 256
+
+_indexes = collections.OrderedDict()
+_indexes_lock = threading.Lock()
+
+def _unitVector(latitude, longitude):
+	"""
+	Convert a latitude and longitude to a point on the unit sphere.  The
+	straight-line distance between two of these points always sorts the
+	same way as the great circle distance between the two locations.
+	"""
+	lat = math.radians(latitude)
+	lon = math.radians(longitude)
+	return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+class StationIndex:
+	"""
+	A KD-tree of observation stations built on their unit sphere
+	coordinates.  Nearest neighbor queries take logarithmic time.
+	"""
+
+	def __init__(self, stations):
+		"""
+		stations: a list of [station id, latitude, longitude] lists
+		"""
+		self.stations = stations
+		points = [(_unitVector(s[1], s[2]), i) for i, s in enumerate(stations)]
+		self.root = self._build(points, 0)
+
+	def _build(self, points, depth):
+		"""
+		Build the tree recursively, splitting on x, y and z in turn.  Each
+		node is a (point, station number, axis, left, right) tuple.
+		"""
+		if not points:
+			return None
+		axis = depth % 3
+		points.sort(key=lambda p: p[0][axis])
+		median = len(points) // 2
+		return (
+			points[median][0],
+			points[median][1],
+			axis,
+			self._build(points[:median], depth + 1),
+			self._build(points[median + 1:], depth + 1)
+		)
+
+	def nearest(self, latitude, longitude, k=1):
+		"""
+		Find the stations nearest to a location
+
+		latitude
+		longitude: the location
+		k: the number of stations to return
+
+		Returns a list of up to k (station, miles) tuples, nearest first,
+		where station is the [station id, latitude, longitude] list that
+		the index was built from
+		"""
+		target = _unitVector(latitude, longitude)
+		#  A max-heap, by way of negated distances, of the best k found
+		best = []
+		stack = [self.root]
+		while stack:
+			node = stack.pop()
+			if node is None:
+				continue
+			point, number, axis, left, right = node
+			distance = sum((a - b) ** 2 for a, b in zip(point, target))
+			if len(best) < k:
+				heapq.heappush(best, (-distance, number))
+			elif distance < -best[0][0]:
+				heapq.heapreplace(best, (-distance, number))
+			#  Search the side of the split that holds the target first,
+			#  and the other side only if it could hold something closer
+			difference = target[axis] - point[axis]
+			near, far = (left, right) if difference < 0 else (right, left)
+			if len(best) < k or difference ** 2 < -best[0][0]:
+				stack.append(far)
+			stack.append(near)
+
+		results = []
+		for distance, number in sorted(best, reverse=True):
+			station = self.stations[number]
+			results.append((station, great_circle((latitude, longitude), (station[1], station[2])).miles))
+		return results
+
+def getIndex(key, stations):
+	"""
+	Return the index for a list of stations, building it if this process
+	hasn't already done so
+
+	key: a string that identifies the list of stations, like the URL it
+	     came from
+	stations: a list of [station id, latitude, longitude] lists
+
+	Returns a StationIndex object
+	"""
+	with _indexes_lock:
+		index = _indexes.get(key)
+		if index is not None and index.stations == stations:
+			_indexes.move_to_end(key)
+			return index
+	index = StationIndex(stations)
+	with _indexes_lock:
+		_indexes[key] = index
+		while len(_indexes) > index_cache_size:
+			_indexes.popitem(last=False)
+	return index
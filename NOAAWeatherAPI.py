@@ -2,16 +2,19 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import datetime
+import asyncio
+import collections
 import concurrent.futures
+import datetime
 import sys
 import re
+import threading
 
 #  These may be available in distro packages, or may need to be installed
 #  with pip
 import isodate
+import numpy
 import pytz
-from geopy.distance import great_circle
 
 #  Astral v2.1 is used to calculate moon phase, sunset and sunrise times. 
 #  It probably needs to be installed with pip, the distro packaged version
@@ -20,8 +23,68 @@ from astral import moon
 from astral import LocationInfo
 from astral.sun import sun
 
-#  Application module
+#  Application modules
 import DarkskyAPIFunctions as functions
+import DarkskyAPICache
+import DarkskyAPIMetrics
+import DarkskyAPIStationIndex
+
+#  How long, in seconds, the NOAA grid, forecast URLs and observation
+#  stations for a location are kept in the cache.  NOAA very rarely
+#  changes these, and when it does its old forecast URLs answer with a
+#  404, which makes us look the location up again.
+location_ttl = 7 * 86400
+
+_location_cache = DarkskyAPICache.PersistentCache('noaa_locations')
+
+#  The number of observation stations, nearest first, that we will try
+#  when getting the current conditions, and the age, in seconds, beyond
+#  which a station's latest observation is considered out of date
+station_candidates = 3
+station_max_age = 2 * 3600
+
+#  How long, in seconds, the names of the counties and forecast zones in a
+#  state are kept before they are downloaded from NOAA again.  These only
+#  change a few times a year.
+zone_names_ttl = 30 * 86400
+
+_zone_names_cache = DarkskyAPICache.PersistentCache('noaa_zone_names')
+
+#  Each process also keeps the zone names that it has loaded in memory,
+#  as a dictionary of (expiration time, names) tuples keyed by state.
+#  Each state has a lock so that only one request loads its names.
+_zone_names = {}
+_zone_names_locks = {}
+_zone_names_lock = threading.Lock()
+#  The asyncio entry point waits on asyncio locks instead, so that it
+#  doesn't block its event loop
+_zone_names_async_locks = {}
+
+#  The forecasts for a grid cell are shared by every location in the cell.
+#  Each process keeps the forecasts for gridpoint_cache_size cells in
+#  memory.  NOAA updates them about once an hour, so they are downloaded
+#  again gridpoint_update_interval seconds after their update time, but
+#  never kept for less than gridpoint_min_ttl or more than
+#  gridpoint_max_ttl seconds.
+gridpoint_cache_size = 64
+gridpoint_update_interval = 3600
+gridpoint_min_ttl = 60
+gridpoint_max_ttl = 3600
+
+_gridpoints = collections.OrderedDict()
+_gridpoints_lock = threading.Lock()
+_gridpoint_async_locks = {}
+
+#  The downloads in progress, as (forecast names, concurrent.futures.Future)
+#  tuples keyed by grid cell, so that requests for the same cell share
+#  them
+_gridpoint_downloads = {}
+
+#  The grid cells whose forecast URLs NOAA answered with a 404, which
+#  means that the cell has moved and the locations that were given it
+#  have to be looked up again.  A cell is forgotten when its forecasts
+#  are downloaded again, or after gridpoint_cache_size newer ones.
+_moved_grids = collections.OrderedDict()
 
 def _mapIcons(icon, flask_app=None):
 	"""
@@ -114,18 +177,871 @@ def _mapIcons(icon, flask_app=None):
 
 	return ''
 
+#  The NOAA gridpoint properties that are added to the hourly forecast.
+#  Each entry is a (gridpoint property, DarkSky field, conversion) tuple.
+#  The conversion function is passed the property's value and the length
+#  of the interval that the value covers, in hours.
+_hourly_griddata_fields = [
+	('quantitativePrecipitation', 'precipIntensity', lambda value, hours: round(value / 25.4 / hours, 2)),
+	('snowfallAmount', 'precipIntensity', lambda value, hours: round(value / 25.4 / hours, 2)),
+	('probabilityOfPrecipitation', 'precipProbability', lambda value, hours: round(value / 100, 2)),
+	('temperature', 'temperature', lambda value, hours: round((value * 9 / 5) + 32, 2)),
+	('apparentTemperature', 'apparentTemperature', lambda value, hours: round((value * 9 / 5) + 32, 2)),
+	('dewpoint', 'dewPoint', lambda value, hours: round((value * 9 / 5) + 32, 2)),
+	('relativeHumidity', 'humidity', lambda value, hours: round(value / 100, 2)),
+	('windSpeed', 'windSpeed', lambda value, hours: round(value * 2.23694, 2)),
+	('windGust', 'windGust', lambda value, hours: round(value * 2.23694, 2)),
+	('windDirection', 'windBearing', lambda value, hours: round(value)),
+	('skyCover', 'cloudCover', lambda value, hours: round(value / 100, 2)),
+	('visibility', 'visibility', lambda value, hours: round(value / 1609.34, 2))
+]
+
+def _joinIntervals(times, values):
+	"""
+	Match a list of timestamps up with the NOAA gridpoint values whose
+	validTime intervals contain them.  Both lists are in time order, and
+	NOAA's intervals don't overlap, so this is done in a single pass
+	through the two lists.
+
+	times: a sorted list of UNIX timestamps
+	values: the "values" list of a NOAA gridpoint property
+
+	Yields a (position in times, value, interval length in hours) tuple
+	for each timestamp that falls within an interval that has a value
+	"""
+	i = 0
+	for value in values:
+		interval = functions.parseInterval(value['validTime'])
+		start = interval['start']
+		end = interval.get('end', start)
+		while i < len(times) and times[i] < start:
+			i = i + 1
+		if i == len(times):
+			break
+		while i < len(times) and times[i] < end:
+			if value['value'] is not None:
+				yield (i, value['value'], (end - start) / 3600)
+			i = i + 1
+
+#  The NOAA gridpoint properties that are averaged over each day of the
+#  daily forecast.  Each entry is a (gridpoint property, DarkSky field,
+#  conversion) tuple.  The conversion is applied to the day's average.
+_daily_griddata_averages = [
+	('dewpoint', 'dewPoint', lambda value: round((value * 9 / 5) + 32, 2)),
+	('relativeHumidity', 'humidity', lambda value: round(value / 100, 2)),
+	('skyCover', 'cloudCover', lambda value: round(value / 100, 2)),
+	('windDirection', 'windBearing', lambda value: round(value)),
+	('windSpeed', 'windSpeed', lambda value: round(value * 2.23694, 2)),
+	('probabilityOfPrecipitation', 'precipProbability', lambda value: round(value / 100, 2)),
+	#  Remember that NOAA only provides visibility for the first 2 days
+	('visibility', 'visibility', lambda value: round(value / 1609.34, 2))
+]
+
+#  The NOAA gridpoint properties whose daily highs and lows are added to
+#  the daily forecast.  Each entry is a (gridpoint property, DarkSky high
+#  fields, DarkSky low fields, conversion) tuple.  Each field also gets a
+#  "Time" field holding the start of the interval where the value was
+#  found.  The conversion is applied to every value before comparing.
+_daily_griddata_extremes = [
+	('temperature', ['temperatureHigh', 'temperatureMax'], ['temperatureLow', 'temperatureMin'], lambda value: round((value * 9 / 5) + 32, 2)),
+	('apparentTemperature', ['apparentTemperatureHigh', 'apparentTemperatureMax'], ['apparentTemperatureLow', 'apparentTemperatureMin'], lambda value: round((value * 9 / 5) + 32, 2)),
+	('windGust', ['windGust'], [], lambda value: round(value * 2.23694, 2))
+]
+
+def _intervalArrays(values, convert=None):
+	"""
+	Convert the "values" list of a NOAA gridpoint property into NumPy
+	arrays of interval start times, interval end times and values.
+	Intervals without a value are left out.
+
+	values: the "values" list of a NOAA gridpoint property
+	convert: a function to apply to each value, optional
+
+	Returns a (starts, ends, values) tuple of arrays
+	"""
+	starts = []
+	ends = []
+	converted = []
+	for value in values:
+		if value['value'] is None:
+			continue
+		interval = functions.parseInterval(value['validTime'])
+		starts.append(interval['start'])
+		ends.append(interval.get('end', interval['start']))
+		converted.append(convert(value['value']) if convert else value['value'])
+	return (numpy.array(starts, dtype=numpy.int64), numpy.array(ends, dtype=numpy.int64), numpy.array(converted, dtype=numpy.float64))
+
+def _aggregateDaily(daily_data, props):
+	"""
+	Fill in the daily forecast with the time-weighted averages, highs and
+	lows of NOAA's gridpoint properties.  All of the days are computed at
+	once, for each property, using NumPy arrays.
+
+	daily_data: the daily forecast array, in time order.  Each day's
+	            "time" is the start of that day.
+	props: the "properties" of a NOAA gridpoint forecast
+	"""
+	day_starts = numpy.array([day['time'] for day in daily_data], dtype=numpy.int64)[:, numpy.newaxis]
+	day_ends = day_starts + (3600 * 24)
+
+	for prop_name, field, convert in _daily_griddata_averages:
+		values = functions.getKeyValue(props, [prop_name, 'values'])
+		if not values:
+			continue
+		starts, ends, values = _intervalArrays(values)
+		#  The number of hours of each interval that fall within each day
+		hours = numpy.clip(numpy.minimum(ends, day_ends) - numpy.maximum(starts, day_starts), 0, None) / 3600
+		total_hours = hours.sum(axis=1)
+		totals = hours @ values
+		for i in numpy.flatnonzero(total_hours > 0):
+			daily_data[i][field] = convert(totals[i] / total_hours[i])
+
+	for prop_name, high_fields, low_fields, convert in _daily_griddata_extremes:
+		values = functions.getKeyValue(props, [prop_name, 'values'])
+		if not values:
+			continue
+		starts, ends, values = _intervalArrays(values, convert)
+		#  Values belong to the day in which their interval starts
+		in_day = (starts >= day_starts) & (starts < day_ends)
+		highs = numpy.where(in_day, values, -numpy.inf).argmax(axis=1)
+		lows = numpy.where(in_day, values, numpy.inf).argmin(axis=1)
+		for i in numpy.flatnonzero(in_day.any(axis=1)):
+			for field in high_fields:
+				daily_data[i][field] = float(values[highs[i]])
+				daily_data[i][field + 'Time'] = int(starts[highs[i]])
+			for field in low_fields:
+				daily_data[i][field] = float(values[lows[i]])
+				daily_data[i][field + 'Time'] = int(starts[lows[i]])
+
 def _dailyEpochTime(dt_str):
-	'''
+	"""
 	Convert NOAA daily date string to UNIX epoch timestamp.  This ignores
 	the time portion of the string and returns the timestamp as it would
 	have been at 00:00:00 on the date specified
-	'''
+	"""
 	d = datetime.datetime.strptime(dt_str, '%Y-%m-%dT%H:%M:%S%z')
 	d = datetime.datetime.combine(datetime.date(d.year, d.month, d.day), datetime.time())
 	return int(d.timestamp())
 
-def get(latitude, longitude, useragent_string, flask_app=None):
-	'''
+def _locationKey(latitude, longitude):
+	"""
+	Return the cache key for a location.  NOAA's points service rounds
+	latitude and longitude to 4 decimal places so we do the same.
+	"""
+	return '{:.4f},{:.4f}'.format(latitude, longitude)
+
+def _getLocation(latitude, longitude, noaa_headers, flask_app=None):
+	"""
+	Get NOAA's information about a location: its forecast grid, the URLs
+	of its forecast services, its timezone and state, and the list of
+	nearby observation stations.  The information comes from the cache if
+	we have looked this location up before.
+	
+	Latitude
+	longitude: geolocation obtained from the request URL
+	noaa_headers: the headers to send with the NOAA API calls
+	flask_app : an object containing a Flask application's details.  Used
+                to allow us to write into the application log.
+	
+	Returns a dictionary or "False" if the information could not be
+	obtained
+	"""
+	key = _locationKey(latitude, longitude)
+	location = _location_cache.get(key)
+	if location:
+		DarkskyAPIMetrics.cacheLookup('location', 'hit')
+		return location
+	DarkskyAPIMetrics.cacheLookup('location', 'miss')
+
+	#  Get the NOAA grid coordinates, timezone and URL links for this 
+	#  location from their "points" service, based on the lat/long.  If
+	#  NOAA doesn't answer, use an expired cache entry if there is one.
+	url = 'https://api.weather.gov/points/{},{}'.format(latitude, longitude)
+	noaa_points_obj = functions.getURL(url, noaa_headers, flask_app)
+	if noaa_points_obj is False:
+		return _location_cache.get(key, stale=True) or False
+	props = functions.getKeyValue(noaa_points_obj, ['properties'])
+
+	#  Get the list of observation stations for this location
+	stations_url = functions.getKeyValue(props, ['observationStations'])
+	noaa_stations_obj = functions.getURL(stations_url, noaa_headers, flask_app)
+	if noaa_stations_obj is False:
+		return _location_cache.get(key, stale=True) or False
+	location = _parseLocation(props, stations_url, noaa_stations_obj)
+	_location_cache.put(key, location, location_ttl)
+	return location
+
+async def _getLocationAsync(session, latitude, longitude, noaa_headers, flask_app=None):
+	"""
+	The asynchronous version of _getLocation
+
+	Returns a dictionary or "False" if the information could not be
+	obtained
+	"""
+	key = _locationKey(latitude, longitude)
+	location = await functions.runBlocking(_location_cache.get, key)
+	if location:
+		DarkskyAPIMetrics.cacheLookup('location', 'hit')
+		return location
+	DarkskyAPIMetrics.cacheLookup('location', 'miss')
+
+	url = 'https://api.weather.gov/points/{},{}'.format(latitude, longitude)
+	noaa_points_obj = await functions.getURLAsync(session, url, noaa_headers, flask_app)
+	if noaa_points_obj is False:
+		return await functions.runBlocking(_location_cache.get, key, True) or False
+	props = functions.getKeyValue(noaa_points_obj, ['properties'])
+
+	stations_url = functions.getKeyValue(props, ['observationStations'])
+	noaa_stations_obj = await functions.getURLAsync(session, stations_url, noaa_headers, flask_app)
+	if noaa_stations_obj is False:
+		return await functions.runBlocking(_location_cache.get, key, True) or False
+
+	location = _parseLocation(props, stations_url, noaa_stations_obj)
+	await functions.runBlocking(_location_cache.put, key, location, location_ttl)
+	return location
+
+def _parseLocation(props, stations_url, noaa_stations_obj):
+	"""
+	Pick the information that we keep about a location out of NOAA's
+	points and stations responses
+
+	Returns a dictionary
+	"""
+	stations = []
+	for feature in functions.getKeyValue(noaa_stations_obj, ['features']):
+		coordinates = functions.getKeyValue(feature, ['geometry', 'coordinates'])
+		stations.append([functions.getKeyValue(feature, ['id']), coordinates[1], coordinates[0]])
+
+	return {
+		'gridId': functions.getKeyValue(props, ['gridId']),
+		'gridX': functions.getKeyValue(props, ['gridX']),
+		'gridY': functions.getKeyValue(props, ['gridY']),
+		'timeZone': functions.getKeyValue(props, ['timeZone']),
+		'state': functions.getKeyValue(props, ['relativeLocation', 'properties', 'state']),
+		'forecast': functions.getKeyValue(props, ['forecast']),
+		'forecastHourly': functions.getKeyValue(props, ['forecastHourly']),
+		'forecastGridData': functions.getKeyValue(props, ['forecastGridData']),
+		'observationStations': stations_url,
+		'stations': stations
+	}
+
+def _downloadZoneNames(state, noaa_headers, flask_app=None):
+	"""
+	Download the ids and names of all of the counties and forecast zones
+	in a state from NOAA.  Only the id and name are kept from each zone.
+	We ask NOAA to leave out the zone boundaries, they are by far the
+	largest part of the response and we have no use for them.
+
+	Returns a dictionary of zone names keyed by zone id, or "False" if the
+	download failed
+	"""
+	names = {}
+	#  Alerts use both county codes and forecast zone codes
+	for zone_type in ['county', 'forecast']:
+		url = 'https://api.weather.gov/zones?type={}&area={}&include_geometry=false'.format(zone_type, state)
+		noaa_zones_obj = functions.getURL(url, noaa_headers, flask_app)
+		if noaa_zones_obj is False:
+			return False
+		_parseZoneNames(noaa_zones_obj, names)
+	return names
+
+async def _downloadZoneNamesAsync(session, state, noaa_headers, flask_app=None):
+	"""
+	The asynchronous version of _downloadZoneNames
+	"""
+	names = {}
+	for zone_type in ['county', 'forecast']:
+		url = 'https://api.weather.gov/zones?type={}&area={}&include_geometry=false'.format(zone_type, state)
+		noaa_zones_obj = await functions.getURLAsync(session, url, noaa_headers, flask_app)
+		if noaa_zones_obj is False:
+			return False
+		_parseZoneNames(noaa_zones_obj, names)
+	return names
+
+def _parseZoneNames(noaa_zones_obj, names):
+	"""
+	Add the id and name of each zone in a NOAA zones response to the names
+	dictionary
+	"""
+	for feature in functions.getKeyValue(noaa_zones_obj, ['features']):
+		names[functions.getKeyValue(feature, ['properties', 'id'])] = functions.getKeyValue(feature, ['properties', 'name'])
+
+def getZoneNames(state, noaa_headers, flask_app=None):
+	"""
+	Return the names of the counties and forecast zones in a state.  These
+	are loaded from NOAA the first time that they are needed and then
+	kept, in memory and in the cache shared by all of the workers, until
+	they are zone_names_ttl seconds old.
+	
+	state: a two-letter state abbreviation
+	noaa_headers: the headers to send with the NOAA API calls
+	flask_app : an object containing a Flask application's details.  Used
+                to allow us to write into the application log.
+
+	Returns a dictionary of zone names keyed by zone id.  The dictionary
+	is empty if the names could not be obtained.
+	"""
+	names = _rememberedZoneNames(state)
+	if names is not None:
+		return names
+	with _zone_names_lock:
+		lock = _zone_names_locks.setdefault(state, threading.Lock())
+
+	with lock:
+		#  Another request may have loaded the names while we waited
+		names = _rememberedZoneNames(state)
+		if names is not None:
+			return names
+
+		names = _zone_names_cache.get(state)
+		if names is None:
+			names = _downloadZoneNames(state, noaa_headers, flask_app)
+			if names is False:
+				#  Keep using the old names, if there are any, until NOAA
+				#  answers again
+				return _zone_names_cache.get(state, stale=True) or {}
+			_zone_names_cache.put(state, names, zone_names_ttl)
+		return _rememberZoneNames(state, names)
+
+async def getZoneNamesAsync(session, state, noaa_headers, flask_app=None):
+	"""
+	The asynchronous version of getZoneNames.  Only one task downloads the
+	names for a state, others wait for it on an asyncio lock.
+
+	Returns a dictionary of zone names keyed by zone id
+	"""
+	names = _rememberedZoneNames(state)
+	if names is not None:
+		return names
+	lock = _zone_names_async_locks.setdefault(state, asyncio.Lock())
+
+	async with lock:
+		names = _rememberedZoneNames(state)
+		if names is not None:
+			return names
+
+		names = await functions.runBlocking(_zone_names_cache.get, state)
+		if names is None:
+			names = await _downloadZoneNamesAsync(session, state, noaa_headers, flask_app)
+			if names is False:
+				return await functions.runBlocking(_zone_names_cache.get, state, True) or {}
+			await functions.runBlocking(_zone_names_cache.put, state, names, zone_names_ttl)
+		return _rememberZoneNames(state, names)
+
+def _rememberedZoneNames(state):
+	"""
+	Returns the names of the zones in a state that this process has in
+	memory, or None if it has none or they are too old
+	"""
+	with _zone_names_lock:
+		if state in _zone_names and _zone_names[state][0] > datetime.datetime.now().timestamp():
+			return _zone_names[state][1]
+	return None
+
+def _rememberZoneNames(state, names):
+	"""
+	Keep the names of the zones in a state in memory
+
+	Returns the names
+	"""
+	with _zone_names_lock:
+		_zone_names[state] = (datetime.datetime.now().timestamp() + zone_names_ttl, names)
+	return names
+
+def _getCurrentObservation(stations, noaa_headers, flask_app=None):
+	"""
+	Get the latest observation from the nearest station that has a recent
+	one.  Stations that fail to answer, or whose latest observation is
+	more than station_max_age seconds old, are skipped.
+	
+	stations: a list of (station, miles) tuples, nearest first, as
+	          returned by DarkskyAPIStationIndex.StationIndex.nearest
+	noaa_headers: the headers to send with the NOAA API calls
+	flask_app : an object containing a Flask application's details.  Used
+                to allow us to write into the application log.
+
+	Returns a (observation, miles) tuple.  If no station has a recent
+	observation then the most recent one that we got is returned, or
+	(False, None) if we got none at all.
+	"""
+	fallback = (False, None)
+	for station, miles in stations:
+		url = '{}/observations/latest'.format(station[0])
+		noaa_current_obj = functions.getURL(url, noaa_headers, flask_app)
+		if not noaa_current_obj:
+			continue
+		if _recentObservation(noaa_current_obj):
+			return (noaa_current_obj, miles)
+		if not fallback[0]:
+			fallback = (noaa_current_obj, miles)
+	return fallback
+
+async def _getCurrentObservationAsync(session, stations, noaa_headers, flask_app=None):
+	"""
+	The asynchronous version of _getCurrentObservation
+
+	Returns a (observation, miles) tuple
+	"""
+	fallback = (False, None)
+	for station, miles in stations:
+		url = '{}/observations/latest'.format(station[0])
+		noaa_current_obj = await functions.getURLAsync(session, url, noaa_headers, flask_app)
+		if not noaa_current_obj:
+			continue
+		if _recentObservation(noaa_current_obj):
+			return (noaa_current_obj, miles)
+		if not fallback[0]:
+			fallback = (noaa_current_obj, miles)
+	return fallback
+
+def _recentObservation(noaa_current_obj):
+	"""
+	Returns True if an observation is less than station_max_age seconds
+	old
+	"""
+	timestamp = functions.getKeyValue(noaa_current_obj, ['properties', 'timestamp'], lambda x: functions.parseInterval(x)['start'])
+	return bool(timestamp and timestamp > functions.now().timestamp() - station_max_age)
+
+def _getAlerts(latitude, longitude, state, noaa_headers, flask_app=None):
+	"""
+	Get the alerts for a location and, if there are any, the names of the
+	counties and forecast zones that they refer to, so that both are
+	ready before the alerts section is built
+
+	Returns an (alerts, zone names) tuple.  The alerts are False if the
+	call failed.
+	"""
+	url = 'https://api.weather.gov/alerts?point={},{}'.format(latitude, longitude)
+	noaa_alerts_obj = functions.getURL(url, noaa_headers, flask_app)
+	if noaa_alerts_obj and functions.getKeyValue(noaa_alerts_obj, ['features']):
+		return (noaa_alerts_obj, getZoneNames(state, noaa_headers, flask_app))
+	return (noaa_alerts_obj, {})
+
+async def _getAlertsAsync(session, latitude, longitude, state, noaa_headers, flask_app=None):
+	"""
+	The asynchronous version of _getAlerts
+
+	Returns an (alerts, zone names) tuple
+	"""
+	url = 'https://api.weather.gov/alerts?point={},{}'.format(latitude, longitude)
+	noaa_alerts_obj = await functions.getURLAsync(session, url, noaa_headers, flask_app)
+	if noaa_alerts_obj and functions.getKeyValue(noaa_alerts_obj, ['features']):
+		return (noaa_alerts_obj, await getZoneNamesAsync(session, state, noaa_headers, flask_app))
+	return (noaa_alerts_obj, {})
+
+def invalidateLocation(latitude, longitude):
+	"""
+	Remove NOAA's information about a location from the cache so that it
+	is looked up again on the next request for that location
+	"""
+	_location_cache.delete(_locationKey(latitude, longitude))
+
+def _gridpointKey(location):
+	"""
+	Return the key for a location's grid cell
+	"""
+	return '{}/{},{}'.format(location['gridId'], location['gridX'], location['gridY'])
+
+def _buildHourly(noaa_hourly_obj, noaa_griddata_obj, flask_app=None):
+	"""
+	Build the hourly forecast for a grid cell from NOAA's hourly forecast
+	and completing it with the gridpoint forecast.  Every period that NOAA
+	provides is included, the caller picks out the ones it needs.
+
+	Returns a list of (end time, hour) tuples in time order
+	"""
+	hours = functions.getKeyValue(noaa_hourly_obj, ['properties', 'periods'])
+	if not hours:
+		return []
+	hourly_data = []
+	ends = []
+	for hour in hours:
+		hourly_data.append({
+			'time': functions.parseInterval(hour['startTime'])['start'],
+			'summary': functions.getKeyValue(hour, ['shortForecast'], lambda x: x.capitalize()),
+			'icon': functions.getKeyValue(hour, ['icon'], lambda x: _mapIcons(x, flask_app)),
+			#'pressure': None,
+			#'uvIndex': None,
+			#'ozone': None
+		})
+		ends.append(functions.parseInterval(hour['endTime'])['start'])
+
+	#  Use NOAA's grid forecast to complete the hourly data array
+	times = [hour['time'] for hour in hourly_data]
+	for prop_name, field, convert in _hourly_griddata_fields:
+		values = functions.getKeyValue(noaa_griddata_obj, ['properties', prop_name, 'values'])
+		if not values:
+			continue
+		for i, value, hours in _joinIntervals(times, values):
+			value = convert(value, hours)
+			#  When more than one property feeds the same field, like
+			#  rain and snow amounts do, the largest value wins
+			if field not in hourly_data[i] or value > hourly_data[i][field]:
+				hourly_data[i][field] = value
+
+	return list(zip(ends, hourly_data))
+
+def _buildDaily(noaa_daily_obj, noaa_griddata_obj, timestamp, flask_app=None):
+	"""
+	Build the daily forecast for a grid cell from NOAA's daily forecast,
+	completing it with the gridpoint forecast.  NOAA provides seperate
+	daytime and nighttime forecasts for each day, we focus on the daytime
+	forecasts.  The sun and moon times depend on the exact location so
+	they are left empty, for the caller to fill in.
+
+	timestamp: the UNIX Epoch timestamp of the start of the first day
+
+	Returns a list of days in time order
+	"""
+	daily_data = []
+	periods = functions.getKeyValue(noaa_daily_obj, ['properties', 'periods'])
+	
+	#  Build an array to hold the daily forecasts
+	for i in range(len(periods)):
+		if _dailyEpochTime(periods[i]['startTime']) == timestamp:
+			daily_data.append({
+				'time': timestamp,
+				'summary': functions.getKeyValue(periods, [i, 'shortForecast']),
+				'icon': functions.getKeyValue(periods, [i, 'icon'], lambda x: _mapIcons(x, flask_app)),
+				'sunriseTime': None,
+				'sunsetTime': None,
+				'moonPhase': None,
+				#'precipIntensity', None,
+				#'precipIntensityMax',
+				#'precipIntensityMaxTiome',
+				'precipProbability': None,
+				#'precipType': None,
+				'temperatureHigh': None,
+				'temperatureHighTime': None,
+				'temperatureLow': None,
+				'temperatureLowTime': None,
+				'apparentTemperatureHigh': None,
+				'apparentTemperatureHighTime': None,
+				'apparentTemperatureLow': None,
+				'apparentTemperatureLowTime': None,
+				'dewPoint': None,
+				'humidity': None,
+				#'pressure': None,
+				'windSpeed': None,
+				'windGust': None,
+				'windGustTime': None,
+				'windBearing': None,
+				'cloudCover': None,
+				#'uvIndex': None,
+				#'uvIndexTime', None,
+				'visibility': None,
+				#'ozone': None,
+				'temperatureMin': None,
+				'temperatureMinTime': None,
+				'temperatureMax': None,
+				'temperatureMaxTime': None,
+				'apparentTemperatureMin': None,
+				'apparentTemperatureMinTime': None,
+				'apparentTemperatureMax': None,
+				'apparentTemperatureMaxTime': None
+			})
+			timestamp = timestamp + (3600 * 24)
+			
+	#  Fill in remaining daily data using the NOAA gridpoint forecast query
+	if daily_data:
+		_aggregateDaily(daily_data, functions.getKeyValue(noaa_griddata_obj, ['properties']))
+
+	return daily_data
+
+def _downloadForecasts(location, names, noaa_headers, flask_app=None):
+	"""
+	Start downloading some of the forecasts for a location's grid cell,
+	all at the same time.  The calls are submitted to the shared executor
+	by the caller's thread, so nothing ever waits on the executor from
+	inside it.
+
+	names: a list of the forecasts to download, any of "forecast",
+	       "forecastHourly" and "forecastGridData"
+
+	Returns a concurrent.futures.Future whose result is a dictionary of
+	the forecasts keyed by name, or "False" if any of the downloads failed
+	"""
+	result = concurrent.futures.Future()
+	downloads = {}
+	statuses = {}
+	for name in names:
+		downloads[name] = functions.submit(functions.getURL, location[name], noaa_headers, flask_app, statuses)
+
+	def finished(download):
+		if not all(download.done() for download in downloads.values()) or result.done():
+			return
+		_checkMoved(location, statuses)
+		forecasts = {}
+		for name, download in downloads.items():
+			try:
+				forecasts[name] = download.result()
+			except:
+				if flask_app:
+					flask_app.logger.error('Exception occurred during NOAA {} API call: {}'.format(name, sys.exc_info()[0]))
+				forecasts[name] = None
+			if not forecasts[name]:
+				forecasts = False
+				break
+		try:
+			result.set_result(forecasts)
+		except concurrent.futures.InvalidStateError:
+			#  Another download's callback got there first
+			pass
+
+	for download in downloads.values():
+		download.add_done_callback(finished)
+	return result
+
+async def _downloadForecastsAsync(session, location, names, noaa_headers, flask_app=None):
+	"""
+	The asynchronous version of _downloadForecasts
+
+	Returns a dictionary of the forecasts keyed by name, or "False" if any
+	of the downloads failed
+	"""
+	statuses = {}
+	results = await asyncio.gather(*[functions.getURLAsync(session, location[name], noaa_headers, flask_app, statuses) for name in names], return_exceptions=True)
+	_checkMoved(location, statuses)
+	forecasts = {}
+	for name, result in zip(names, results):
+		if isinstance(result, Exception):
+			if flask_app:
+				flask_app.logger.error('Exception occurred during NOAA {} API call: {}'.format(name, type(result)))
+			return False
+		if not result:
+			return False
+		forecasts[name] = result
+	return forecasts
+
+def _checkMoved(location, statuses):
+	"""
+	Remember that a location's grid cell has moved if NOAA answered any of
+	its forecast URLs with a 404
+
+	statuses: the HTTP statuses of the forecast downloads, keyed by URL
+	"""
+	if 404 not in statuses.values():
+		return
+	key = _gridpointKey(location)
+	with _gridpoints_lock:
+		_moved_grids[key] = True
+		_moved_grids.move_to_end(key)
+		while len(_moved_grids) > gridpoint_cache_size:
+			_moved_grids.popitem(last=False)
+
+def _gridMoved(location):
+	"""
+	Returns True if NOAA has said that a location's grid cell has moved
+	"""
+	with _gridpoints_lock:
+		return _gridpointKey(location) in _moved_grids
+
+def _getGridpoint(location, names, noaa_headers, flask_app=None):
+	"""
+	Get the forecasts for a location's grid cell.  Only one request in
+	each process downloads the forecasts for a cell, others for the same
+	cell share its download and then share the result until it expires.
+	This doesn't wait for anything, so it can be called while a response
+	is being built without holding up the other calls.
+	
+	location: the dictionary returned by _getLocation
+	names: a list of the forecasts that are needed, any of "forecast",
+	       "forecastHourly" and "forecastGridData"
+	noaa_headers: the headers to send with the NOAA API calls
+	flask_app : an object containing a Flask application's details.  Used
+                to allow us to write into the application log.
+
+	Returns a concurrent.futures.Future whose result is a gridpoint
+	dictionary holding NOAA's forecasts, keyed by name, and the time they
+	were updated, or "False" if the forecasts could not be obtained
+	"""
+	key = _gridpointKey(location)
+	gridpoint = _cachedGridpoint(key)
+	now = datetime.datetime.now().timestamp()
+	fresh = gridpoint is not None and gridpoint['expires'] > now
+	if fresh and all(name in gridpoint for name in names):
+		DarkskyAPIMetrics.cacheLookup('gridpoint', 'hit')
+		result = concurrent.futures.Future()
+		result.set_result(gridpoint)
+		return result
+	DarkskyAPIMetrics.cacheLookup('gridpoint', 'miss')
+
+	with _gridpoints_lock:
+		download = _gridpoint_downloads.get(key)
+		if download is not None and set(names) <= download[0]:
+			return download[1]
+
+		#  Earlier requests may not have needed all of the forecasts that
+		#  this one does.  Add the missing ones to the cell.  Otherwise the
+		#  gridpoint forecast is always downloaded, it holds NOAA's update
+		#  time.
+		if fresh:
+			names = [name for name in names if name not in gridpoint]
+		else:
+			names = sorted(set(names) | {'forecastGridData'})
+		result = concurrent.futures.Future()
+		_gridpoint_downloads[key] = (set(names) | (set(gridpoint) if fresh else set()), result)
+
+	def finished(forecasts):
+		try:
+			forecasts = forecasts.result()
+			if not fresh:
+				gridpoint_result = _storeGridpoint(key, gridpoint, names, forecasts, now, flask_app)
+			elif forecasts is False:
+				gridpoint_result = False
+			else:
+				gridpoint.update(forecasts)
+				gridpoint_result = gridpoint
+		except Exception as e:
+			if flask_app:
+				flask_app.logger.error('Unable to store the NOAA forecasts for grid {}: {}'.format(key, e))
+			gridpoint_result = False
+		with _gridpoints_lock:
+			if _gridpoint_downloads.get(key, (None, None))[1] is result:
+				del _gridpoint_downloads[key]
+		result.set_result(gridpoint_result)
+
+	_downloadForecasts(location, names, noaa_headers, flask_app).add_done_callback(finished)
+	return result
+
+async def _getGridpointAsync(session, location, names, noaa_headers, flask_app=None):
+	"""
+	The asynchronous version of _getGridpoint.  Only one task downloads
+	the forecasts for a cell, others wait for it on an asyncio lock.
+
+	Returns a gridpoint dictionary or "False", like _getGridpoint
+	"""
+	key = _gridpointKey(location)
+	lock = _gridpoint_async_locks.setdefault(key, asyncio.Lock())
+
+	async with lock:
+		gridpoint = _cachedGridpoint(key)
+		now = datetime.datetime.now().timestamp()
+
+		if gridpoint is not None and gridpoint['expires'] > now:
+			missing = [name for name in names if name not in gridpoint]
+			DarkskyAPIMetrics.cacheLookup('gridpoint', 'miss' if missing else 'hit')
+			if missing:
+				forecasts = await _downloadForecastsAsync(session, location, missing, noaa_headers, flask_app)
+				if forecasts is False:
+					return False
+				gridpoint.update(forecasts)
+			return gridpoint
+
+		DarkskyAPIMetrics.cacheLookup('gridpoint', 'miss')
+
+		names = sorted(set(names) | {'forecastGridData'})
+		forecasts = await _downloadForecastsAsync(session, location, names, noaa_headers, flask_app)
+		return _storeGridpoint(key, gridpoint, names, forecasts, now, flask_app)
+
+def _cachedGridpoint(key):
+	"""
+	Returns the cached gridpoint for a grid cell, even if it has expired,
+	or None if there isn't one
+	"""
+	with _gridpoints_lock:
+		gridpoint = _gridpoints.get(key)
+		if gridpoint is not None:
+			_gridpoints.move_to_end(key)
+	return gridpoint
+
+def _storeGridpoint(key, gridpoint, names, forecasts, now, flask_app=None):
+	"""
+	Cache the forecasts that were downloaded for a grid cell
+
+	gridpoint: the cell's expired gridpoint, or None
+	forecasts: the result of _downloadForecasts
+
+	Returns the new gridpoint, or the expired one if the download failed
+	and it holds the forecasts that are needed, or "False"
+	"""
+	if forecasts is False:
+		#  Keep using the old forecasts, if there are any, until NOAA
+		#  answers again
+		if gridpoint is not None and all(name in gridpoint for name in names):
+			if flask_app:
+				flask_app.logger.warning('Using out of date NOAA forecasts for grid {}'.format(key))
+			return gridpoint
+		return False
+
+	#  Record when NOAA last updated its forecast so that callers know
+	#  how fresh the output is
+	fresh = forecasts
+	fresh['updateTime'] = functions.getKeyValue(fresh['forecastGridData'], ['properties', 'updateTime'], lambda x: functions.parseInterval(x)['start'])
+	expires = now + gridpoint_max_ttl
+	if fresh['updateTime']:
+		expires = min(expires, fresh['updateTime'] + gridpoint_update_interval)
+	fresh['expires'] = max(now + gridpoint_min_ttl, expires)
+
+	with _gridpoints_lock:
+		_moved_grids.pop(key, None)
+		_gridpoints[key] = fresh
+		_gridpoints.move_to_end(key)
+		while len(_gridpoints) > gridpoint_cache_size:
+			old_key, _ = _gridpoints.popitem(last=False)
+			if old_key != key:
+				_gridpoint_async_locks.pop(old_key, None)
+	return fresh
+
+def _gridpointHourly(gridpoint, flask_app=None):
+	"""
+	Return the hourly forecast for a grid cell.  It is built the first
+	time that it is needed.
+
+	Returns a list of (end time, hour) tuples in time order
+	"""
+	hourly = gridpoint.get('hourly')
+	if hourly is None:
+		hourly = _buildHourly(gridpoint['forecastHourly'], gridpoint['forecastGridData'], flask_app)
+		gridpoint['hourly'] = hourly
+	return hourly
+
+def _gridpointDaily(gridpoint, time_zone, flask_app=None):
+	"""
+	Return the daily forecast for a grid cell, starting today.  It is
+	built the first time that it is needed each day.
+
+	Returns a list of days in time order
+	"""
+	#  Calculate UNIX Epoch timestamp for the first day in the daily
+	#  forecast array
+	d = functions.now()
+	d = datetime.datetime.combine(datetime.date(d.year, d.month, d.day), datetime.time())
+	d = pytz.timezone(time_zone).localize(d)
+	timestamp = int(d.timestamp())
+
+	daily = gridpoint.get('daily', (None, []))
+	if daily[0] != timestamp:
+		daily = (timestamp, _buildDaily(gridpoint['forecast'], gridpoint['forecastGridData'], timestamp, flask_app))
+		gridpoint['daily'] = daily
+	return daily[1]
+
+def getGridCell(latitude, longitude, useragent_string, flask_app=None):
+	"""
+	Find the NOAA forecast grid cell that a location is in.  Locations in
+	the same cell share their forecasts so callers that have several
+	locations to look up can use this to group them.
+	
+	Latitude
+	longitude: geolocation obtained from the request URL
+	useragent_string: required by NOAA to identify the caller
+	flask_app : an object containing a Flask application's details.  Used
+                to allow us to write into the application log.
+
+	Returns a string that identifies the state and grid cell, or None if
+	the location could not be looked up
+	"""
+	noaa_headers = {
+		'User-Agent': useragent_string,
+		'Accept': 'application/geo+json'
+	}
+	location = _getLocation(latitude, longitude, noaa_headers, flask_app)
+	if location is False:
+		return None
+	return '{}/{}'.format(location['state'], _gridpointKey(location))
+
+def get(latitude, longitude, useragent_string, flask_app=None, exclude=(), extend=None):
+	"""
 	Use the weather data from the NOAA Weather API.
 	
 	Latitude
@@ -134,29 +1050,208 @@ def get(latitude, longitude, useragent_string, flask_app=None):
 	                  https://www.weather.gov/documentation/services-web-api
 	flask_app : an object containing a Flask application's details.  Used
                 to allow us to write into the application log.
+	exclude: the DarkSky blocks, like "currently" and "alerts", to leave
+	         out of the output.  The NOAA API calls that are only needed
+	         for those blocks are skipped.
+	extend: "hourly" to return 168 hours of hourly data instead of 48
 	                   
 	Returns a DarkSky JSON structure that can be the output of this web
-	service	
-	'''
+	service.  Sections whose data couldn't be obtained before the
+	response's deadline, see DarkskyAPIFunctions.deadline, are left out
+	and listed in the "partial" flag.  Returns "False" if none of the
+	current conditions and forecasts could be obtained.
+	"""
 	
-	#  Get the NOAA grid coordinates, timezone and URL links for this 
-	#  location from their "points" service, based on the lat/long
+	#  Get the NOAA grid coordinates, timezone, URL links and observation
+	#  stations for this location
 	noaa_headers = {
 		'User-Agent': useragent_string,
 		'Accept': 'application/geo+json'
 	}
-	url = 'https://api.weather.gov/points/{},{}'.format(latitude, longitude)
-	noaa_points_obj = functions.getURL(url, noaa_headers, flask_app)
-	if noaa_points_obj is False:
-		flask_app.logger.critical('NOAA request for location information on this latitude and longitude failed: {},{}'.format(latitude, longitude))
+	location = _getLocation(latitude, longitude, noaa_headers, flask_app)
+	if location is False:
+		if flask_app:
+			flask_app.logger.critical('NOAA request for location information on this latitude and longitude failed: {},{}'.format(latitude, longitude))
+		return False
+
+	#  Get the current conditions and the alerts, which are particular to
+	#  this location, in seperate threads while we get the forecasts that
+	#  are shared by the whole grid cell
+	if 'currently' not in exclude:
+		get_current = functions.submit(_getCurrentObservation, _nearestStations(latitude, longitude, location), noaa_headers, flask_app)
+
+	#  Get the alerts, and the names of the places that they refer to
+	if 'alerts' not in exclude:
+		get_alerts = functions.submit(_getAlerts, latitude, longitude, location['state'], noaa_headers, flask_app)
+
+	#  Only download the forecasts that the requested blocks are built
+	#  from.  This is done in the background too so that we don't wait
+	#  for it past the response's deadline.  If the deadline passes, the
+	#  download carries on and the next request for the grid cell gets it.
+	forecast_names = _forecastNames(exclude)
+	if forecast_names:
+		get_gridpoint = _getGridpoint(location, forecast_names, noaa_headers, flask_app)
+
+	#  The sections that we couldn't get the data for, because a call
+	#  failed or didn't finish before the deadline.  These are left out
+	#  and listed in the "partial" flag.  If NOAA says that the grid cell
+	#  has moved, our cached location information is out of date so make
+	#  sure it is refreshed on the next request.
+	fetched = {
+		'current': (None, None),
+		'gridpoint': None,
+		'alerts': (None, {}),
+		'moved': False
+	}
+
+	if 'currently' not in exclude:
+		try:
+			fetched['current'] = functions.waitFor(get_current, 'currently')
+		except concurrent.futures.TimeoutError:
+			if flask_app:
+				flask_app.logger.warning('NOAA observations for {},{} were not ready in time'.format(latitude, longitude))
+		except:
+			if flask_app:
+				flask_app.logger.error('Exception occurred during noaa_current_obj API call: {}'.format(sys.exc_info()[0]))
+
+	if forecast_names:
+		#  The hourly and daily sections are built from the same download
+		try:
+			fetched['gridpoint'] = functions.waitFor(get_gridpoint, 'hourly' if 'hourly' not in exclude else 'daily')
+		except concurrent.futures.TimeoutError:
+			if flask_app:
+				flask_app.logger.warning('NOAA forecasts for {},{} were not ready in time'.format(latitude, longitude))
+		except:
+			if flask_app:
+				flask_app.logger.error('Exception occurred during NOAA forecast API calls: {}'.format(sys.exc_info()[0]))
+		fetched['moved'] = _gridMoved(location)
+
+	if 'alerts' not in exclude:
+		try:
+			fetched['alerts'] = functions.waitFor(get_alerts, 'alerts')
+		except concurrent.futures.TimeoutError:
+			if flask_app:
+				flask_app.logger.warning('NOAA alerts for {},{} were not ready in time'.format(latitude, longitude))
+		except:
+			if flask_app:
+				flask_app.logger.error('Exception occurred during noaa_alerts_obj API call: {}'.format(sys.exc_info()[0]))
+
+	return _transform(latitude, longitude, location, fetched, flask_app, exclude, extend)
+
+async def getAsync(session, latitude, longitude, useragent_string, flask_app=None, exclude=(), extend=None):
+	"""
+	The asynchronous version of get.  The NOAA API calls are made with
+	aiohttp and the output is built by the same code.
+
+	session: the aiohttp.ClientSession returned by
+	         DarkskyAPIFunctions.createAsyncSession
+
+	Returns a DarkSky JSON structure, or "False", like get
+	"""
+	noaa_headers = {
+		'User-Agent': useragent_string,
+		'Accept': 'application/geo+json'
+	}
+	location = await _getLocationAsync(session, latitude, longitude, noaa_headers, flask_app)
+	if location is False:
+		if flask_app:
+			flask_app.logger.critical('NOAA request for location information on this latitude and longitude failed: {},{}'.format(latitude, longitude))
 		return False
 
+	if 'currently' not in exclude:
+		stations = await functions.runBlocking(_nearestStations, latitude, longitude, location)
+		get_current = asyncio.ensure_future(_getCurrentObservationAsync(session, stations, noaa_headers, flask_app))
+	if 'alerts' not in exclude:
+		get_alerts = asyncio.ensure_future(_getAlertsAsync(session, latitude, longitude, location['state'], noaa_headers, flask_app))
+	forecast_names = _forecastNames(exclude)
+	if forecast_names:
+		get_gridpoint = asyncio.ensure_future(_getGridpointAsync(session, location, forecast_names, noaa_headers, flask_app))
+
+	fetched = {
+		'current': (None, None),
+		'gridpoint': None,
+		'alerts': (None, {}),
+		'moved': False
+	}
+
+	if 'currently' not in exclude:
+		try:
+			fetched['current'] = await functions.waitForAsync(get_current, 'currently')
+		except asyncio.TimeoutError:
+			if flask_app:
+				flask_app.logger.warning('NOAA observations for {},{} were not ready in time'.format(latitude, longitude))
+		except Exception:
+			if flask_app:
+				flask_app.logger.error('Exception occurred during noaa_current_obj API call: {}'.format(sys.exc_info()[0]))
+
+	if forecast_names:
+		try:
+			fetched['gridpoint'] = await functions.waitForAsync(get_gridpoint, 'hourly' if 'hourly' not in exclude else 'daily')
+		except asyncio.TimeoutError:
+			if flask_app:
+				flask_app.logger.warning('NOAA forecasts for {},{} were not ready in time'.format(latitude, longitude))
+		except Exception:
+			if flask_app:
+				flask_app.logger.error('Exception occurred during NOAA forecast API calls: {}'.format(sys.exc_info()[0]))
+		fetched['moved'] = _gridMoved(location)
+
+	if 'alerts' not in exclude:
+		try:
+			fetched['alerts'] = await functions.waitForAsync(get_alerts, 'alerts')
+		except asyncio.TimeoutError:
+			if flask_app:
+				flask_app.logger.warning('NOAA alerts for {},{} were not ready in time'.format(latitude, longitude))
+		except Exception:
+			if flask_app:
+				flask_app.logger.error('Exception occurred during noaa_alerts_obj API call: {}'.format(sys.exc_info()[0]))
+
+	#  Building the output takes long enough to hold up the event loop
+	return await functions.runBlocking(_transform, latitude, longitude, location, fetched, flask_app, exclude, extend)
+
+def _nearestStations(latitude, longitude, location):
+	"""
+	Find the observation stations nearest to a location
+
+	Returns a list of (station, miles) tuples, nearest first
+	"""
+	index = DarkskyAPIStationIndex.getIndex(location.get('observationStations', location['forecastGridData']), location['stations'])
+	return index.nearest(latitude, longitude, station_candidates)
+
+def _forecastNames(exclude):
+	"""
+	Return the names of the forecasts that the requested blocks are built
+	from
+	"""
+	forecast_names = []
+	if 'hourly' not in exclude:
+		forecast_names.append('forecastHourly')
+	if 'daily' not in exclude:
+		forecast_names.append('forecast')
+	return forecast_names
+
+def _transform(latitude, longitude, location, fetched, flask_app=None, exclude=(), extend=None):
+	"""
+	Build the output from the data that get or getAsync collected
+
+	location: the dictionary returned by _getLocation
+	fetched: a dictionary holding the current observation, as an
+	         (observation, miles) tuple, the gridpoint, the alerts, as an
+	         (alerts, zone names) tuple, and whether NOAA said that the
+	         location's grid cell has moved
+
+	Returns a DarkSky JSON structure, or "False", like get
+	"""
+	noaa_current_obj, station_miles = fetched['current']
+	gridpoint = fetched['gridpoint']
+	noaa_alerts_obj, zone_names = fetched['alerts']
+	if fetched['moved']:
+		_location_cache.expire(_locationKey(latitude, longitude))
+
 	#  Create the output JSON structure using the location information
-	#  that came back from the service
 	output = {
 		'latitude': latitude,
 		'longitude': longitude,
-		'timezone': functions.getKeyValue(noaa_points_obj, ['properties', 'timeZone']),
+		'timezone': location['timeZone'],
 		'currently': {},
 		#  NOAA does not provide minutely data
 		'minutely': {},
@@ -171,129 +1266,46 @@ def get(latitude, longitude, useragent_string, flask_app=None):
 
 	#  Define a location for the astral functions that determine sunrise
 	#  and sunset for the "daily" section of the output
-	astral_location = LocationInfo('dummy_name', 'dummy_region', functions.getKeyValue(noaa_points_obj, ['properties', 'timeZone']), latitude, longitude)
+	astral_location = LocationInfo('dummy_name', 'dummy_region', location['timeZone'], latitude, longitude)
 	
 	#  Calculate the timezone's offset from UTC in hours and add that to the
 	#  output
-	tz_now = datetime.datetime.now(pytz.timezone(output['timezone']))
+	tz_now = functions.now(pytz.timezone(output['timezone']))
 	output['offset'] = tz_now.utcoffset().total_seconds() / 3600
 
-	#  Using the stations URL that we got from the NOAA points lookup, find
-	#  the nearest station and get its dstance away.  Add this to the output.
-	url = functions.getKeyValue(noaa_points_obj, ['properties', 'observationStations']);
-	noaa_stations_obj = functions.getURL(url, noaa_headers, flask_app)
-	if noaa_stations_obj is False:
-		flask.abort(501)
-	for feature in functions.getKeyValue(noaa_stations_obj,['features']):
-		miles = great_circle((latitude, longitude), (functions.getKeyValue(feature, ['geometry', 'coordinates'])[1], functions.getKeyValue(feature, ['geometry', 'coordinates'])[0])).miles
-		if 'nearest-station' not in output['flags'] or miles < output['flags']['nearest-station']:
-			noaa_station_url = functions.getKeyValue(feature, ['id'])
-			output['flags']['nearest-station'] = round(miles, 2)
-
-	#  Do all of the rest of the NOAA API calls simultaneously, in
-	#  seperate threads, to save time
-	with concurrent.futures.ThreadPoolExecutor() as executor:
-		#  Get the current conditions
-		url = '{}/observations/latest'.format(noaa_station_url)
-		get_current = executor.submit(functions.getURL, url, noaa_headers, flask_app)
-
-		url = functions.getKeyValue(noaa_points_obj, ['properties', 'forecastHourly']);
-		get_hourly = executor.submit(functions.getURL, url, noaa_headers, flask_app)
-
-		#  Get the grid forecast data
-		url = functions.getKeyValue(noaa_points_obj, ['properties', 'forecastGridData']);
-		get_griddata = executor.submit(functions.getURL, url, noaa_headers, flask_app)
-
-		#  Get the daily forecast data
-		url = functions.getKeyValue(noaa_points_obj, ['properties', 'forecast']);
-		get_daily = executor.submit(functions.getURL, url, noaa_headers, flask_app)
-		
-		#  Get the alerts
-		url = 'https://api.weather.gov/alerts?point={},{}'.format(latitude, longitude)
-		get_alerts = executor.submit(functions.getURL, url, noaa_headers, flask_app)
-		
-		#  Get the list of all the counties in this location's state
-		#  and their id codes.
-		url = 'https://api.weather.gov/zones?type=county&area={}'.format(functions.getKeyValue(noaa_points_obj, ['properties', 'relativeLocation', 'properties', 'state']))
-		get_counties = executor.submit(functions.getURL, url, noaa_headers, flask_app)
-
-		#  Get the list of forecast zones in this location's state
-		#  and their id codes
-		url = 'https://api.weather.gov/zones?type=forecast&area={}'.format(functions.getKeyValue(noaa_points_obj, ['properties', 'relativeLocation', 'properties', 'state']))
-		get_zones = executor.submit(functions.getURL, url, noaa_headers, flask_app)
-
-		try:
-			noaa_current_obj = get_current.result()
-		except:
-			flask_app.logger.error('Exception occurred during noaa_current_obj API call: {}'.format(sys.exc_info()[0]))
-			noaa_current_obj = None
-		#  If this request failed, return an empty dictionary
-		if not noaa_current_obj:
-			return False
-
-		try:
-			noaa_hourly_obj = get_hourly.result()
-		except:
-			flask_app.logger.error('Exception occurred during noaa_hourly_obj API call: {}'.format(sys.exc_info()[0]))
-			noaa_hourly_obj = None
-		#  If this request failed, return an empty dictionary
-		if not noaa_hourly_obj:
-			return False
-
-		try:
-			noaa_griddata_obj = get_griddata.result()
-		except:
-			flask_app.logger.error('Exception occurred during noaa_griddata_obj API call: {}'.format(sys.exc_info()[0]))
-			noaa_griddata_obj = None
-		#  If this request failed, return an empty dictionary
-		if not noaa_griddata_obj:
-			return False
-			
-		try:
-			noaa_daily_obj = get_daily.result()
-		except:
-			flask_app.logger.error('Exception occurred during noaa_daily_obj API call: {}'.format(sys.exc_info()[0]))
-			noaa_daily_obj = None
-		#  If this request failed, return an empty dictionary
-		if not noaa_daily_obj:
-			return False
-
-		try:
-			noaa_alerts_obj = get_alerts.result()
-		except:
-			flask_app.logger.error('Exception occurred during noaa_alerts_obj API call: {}'.format(sys.exc_info()[0]))
-			noaa_alerts_obj = None
-
-		try:
-			noaa_counties_obj = get_counties.result()
-		except:
-			flask_app.logger.error('Exception occurred during noaa_counties_obj API call: {}'.format(sys.exc_info()[0]))
-			noaa_counties_obj = None
+	#  List the sections that we couldn't get the data for
+	partial = []
+	if noaa_current_obj:
+		output['flags']['nearest-station'] = round(station_miles, 2)
+	elif 'currently' not in exclude:
+		partial.append('currently')
+	if gridpoint:
+		#  Record when NOAA last updated its forecast so that callers know
+		#  how fresh the output is
+		output['flags']['noaa-update-time'] = gridpoint['updateTime']
+	else:
+		partial.extend([section for section in ['hourly', 'daily'] if section not in exclude])
 
-		try:
-			noaa_zones_obj = get_zones.result()
-		except:
-			flask_app.logger.error('Exception occurred during noaa_counties_obj API call: {}'.format(sys.exc_info()[0]))
-			noaa_zones_obj = None
+	#  If we got none of the current conditions and forecasts that were
+	#  asked for, return an empty dictionary
+	wanted = [section for section in ['currently', 'hourly', 'daily'] if section not in exclude]
+	if wanted and all(section in partial for section in wanted):
+		return False
 
-	#  Put the county codes and their associated names into a dictionary.
-	noaa_county_list = {};
-	if noaa_counties_obj:
-		for feature in functions.getKeyValue(noaa_counties_obj, ['features']):
-			noaa_county_list[functions.getKeyValue(feature, ['properties', 'id'])] = functions.getKeyValue(feature, ['properties', 'name']);
+	if not noaa_alerts_obj and 'alerts' not in exclude:
+		partial.append('alerts')
+	functions.flagPartial(output, partial)
 
-	#  Append the list of forecast zones to the county list dictionary.
-	#  Sometimes they use these in alerts instead of county codes.
-	if noaa_zones_obj:
-		for feature in functions.getKeyValue(noaa_zones_obj, ['features']):
-			noaa_county_list[functions.getKeyValue(feature, ['properties', 'id'])] = functions.getKeyValue(feature, ['properties', 'name']);
+	#  Measure the CPU time spent building each section of the output
+	timer = DarkskyAPIMetrics.TransformTimer('noaa')
 
-			
 	#--------------------------   C u r r e n t l y   --------------------------#
 
+	timer.section('currently')
+
 	#  Populate the output dictionary with the current observations from
 	#  that station we just found
-	props = functions.getKeyValue(noaa_current_obj, ['properties'])
+	props = functions.getKeyValue(noaa_current_obj, ['properties']) if noaa_current_obj else None
 	if props:
 		output['currently'] = {
 			'time': functions.getKeyValue(props, ['timestamp'], lambda x: int(functions.parseInterval(x)['start'])),
@@ -319,412 +1331,45 @@ def get(latitude, longitude, useragent_string, flask_app=None):
 		}
 
 	#-----------------------------   H o u r l y   -----------------------------#
+
+	timer.section('hourly')
 	
-	#  Populate the output dictionary with the hourly data
-	hours = functions.getKeyValue(noaa_hourly_obj, ['properties', 'periods']);
-	if hours:
-		hourly_data = []
-		for hour in hours:
-			#  Break out of the loop once we've got 48 hours worth
-			if len(hourly_data) >= 48:
+	#  Populate the output dictionary with the next 48 hours, or 168 if
+	#  the hourly data was extended, of the grid cell's hourly data, i.e.
+	#  the periods whose end time is greater than the current time
+	hours = 168 if extend == 'hourly' else 48
+	now = functions.now().timestamp()
+	hourly_data = []
+	if 'hourly' not in exclude and gridpoint:
+		for end, hour in _gridpointHourly(gridpoint, flask_app):
+			#  Break out of the loop once we've got enough hours
+			if len(hourly_data) >= hours:
 				break
-			#  Include this period if its end time is greater than
-			#  the current time
-			if functions.parseInterval(hour['endTime'])['start'] > datetime.datetime.now().timestamp():
-				hourly_data.append({
-					'time': functions.parseInterval(hour['startTime'])['start'],
-					'summary': functions.getKeyValue(hour, ['shortForecast'], lambda x: x.capitalize()),
-					'icon': functions.getKeyValue(hour, ['icon'], lambda x: _mapIcons(x, flask_app)),
-					#'pressure': None,
-					#'uvIndex': None,
-					#'ozone': None
-				})
-
-		#  Use NOAA's grid forecast to complete the hourly data array
-		quantities = functions.getKeyValue(noaa_griddata_obj, ['properties', 'quantitativePrecipitation', 'values']);
-		if quantities:
-			for quantity in quantities:
-				interval = functions.parseInterval(quantity['validTime'])
-				hours = (interval['end'] - interval['start']) / 3600
-				perhour = round(quantity['value'] / 25.4 / hours, 2)
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['precipIntensity'] = perhour
-					if hourly_data[i]['time'] > interval['end']:
-						break
-
-		snowamounts = functions.getKeyValue(noaa_griddata_obj, ['properties', 'snowfallAmount', 'values']);
-		if snowamounts:
-			for snow in snowamounts:
-				interval = functions.parseInterval(snow['validTime'])
-				hours = (interval['end'] - interval['start']) / 3600
-				perhour = round(snow['value'] / 25.4 / hours, 2)
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						if 'precipIntensity' in hourly_data[i]:
-							if perhour > hourly_data[i]['precipIntensity']:
-								hourly_data[i]['precipIntensity'] = perhour
-						else:
-							hourly_data[i]['precipIntensity'] = perhour
-					if hourly_data[i]['time'] > interval['end']:
-						break
-
-		probabilities = functions.getKeyValue(noaa_griddata_obj, ['properties', 'probabilityOfPrecipitation', 'values']);
-		if probabilities:
-			for probability in probabilities:
-				interval = functions.parseInterval(probability['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['precipProbability'] = round(probability['value'] / 100, 2)
-					if hourly_data[i]['time'] > interval['end']:
-						break
-
-						
-		temperatures = functions.getKeyValue(noaa_griddata_obj, ['properties', 'temperature', 'values']);
-		if temperatures:
-			for temp in temperatures:
-				interval = functions.parseInterval(temp['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['temperature'] = round((temp['value'] * 9 / 5) + 32, 2)
-					if hourly_data[i]['time'] > interval['end']:
-						break
-						
-		apparents = functions.getKeyValue(noaa_griddata_obj, ['properties', 'apparentTemperature', 'values']);
-		if apparents:
-			for apparent in apparents:
-				interval = functions.parseInterval(apparent['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['apparentTemperature'] = round((apparent['value'] * 9 / 5) + 32, 2)
-					if hourly_data[i]['time'] > interval['end']:
-						break
-
-		dewpoints = functions.getKeyValue(noaa_griddata_obj, ['properties', 'dewpoint', 'values']);
-		if dewpoints:
-			for dewpoint in dewpoints:
-				interval = functions.parseInterval(dewpoint['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['dewpoint'] = round((dewpoint['value'] * 9 / 5) + 32, 2)
-					if hourly_data[i]['time'] > interval['end']:
-						break
-						
-		humidities = functions.getKeyValue(noaa_griddata_obj, ['properties', 'relativeHumidity', 'values']);
-		if humidities:
-			for humidity in humidities:
-				interval = functions.parseInterval(humidity['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['humdity'] = round(humidity['value'] / 100, 2)
-					if hourly_data[i]['time'] > interval['end']:
-						break
-						
-		windspeeds = functions.getKeyValue(noaa_griddata_obj, ['properties', 'windSpeed', 'values']);
-		if windspeeds:
-			for speed in windspeeds:
-				interval = functions.parseInterval(speed['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['windSpeed'] = round(speed['value'] * 2.23694, 2)
-					if hourly_data[i]['time'] > interval['end']:
-						break
-
-		windgusts = functions.getKeyValue(noaa_griddata_obj, ['properties', 'windGust', 'values']);
-		if windgusts:
-			for gust in windgusts:
-				interval = functions.parseInterval(gust['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['windGust'] = round(gust['value'] * 2.23694, 2)
-					if hourly_data[i]['time'] > interval['end']:
-						break
-
-		winddirections = functions.getKeyValue(noaa_griddata_obj, ['properties', 'windDirection', 'values']);
-		if winddirections:
-			for direction in winddirections:
-				interval = functions.parseInterval(direction['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['windBearing'] = round(direction['value'])
-					if hourly_data[i]['time'] > interval['end']:
-						break
-
-		skycovers = functions.getKeyValue(noaa_griddata_obj, ['properties', 'skyCover', 'values']);
-		if skycovers:
-			for skycover in skycovers:
-				interval = functions.parseInterval(skycover['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['cloudCover'] = round(skycover['value'] / 100, 2)
-					if hourly_data[i]['time'] > interval['end']:
-						break
-
-
-		visibilities = functions.getKeyValue(noaa_griddata_obj, ['properties', 'visibility', 'values']);
-		if visibilities:
-			for visibility in visibilities:
-				interval = functions.parseInterval(visibility['validTime'])
-				for i in range(len(hourly_data)):
-					if hourly_data[i]['time'] >= interval['start'] and hourly_data[i]['time'] < interval['end']:
-						hourly_data[i]['visibility'] = round(visibility['value'] / 1609.34, 2)
-					if hourly_data[i]['time'] > interval['end']:
-						break
-
-		#  Add the hourly data array to the output dictionary
-		if len(hourly_data) > 0:
-			output['hourly'] = {
-				'summary': hourly_data[0]['summary'],
-				'icon': hourly_data[0]['icon'],
-				'data': hourly_data
-			}
+			if end > now:
+				hourly_data.append(dict(hour))
+
+	#  Add the hourly data array to the output dictionary
+	if len(hourly_data) > 0:
+		output['hourly'] = {
+			'summary': hourly_data[0]['summary'],
+			'icon': hourly_data[0]['icon'],
+			'data': hourly_data
+		}
 			
 	#------------------------------   D a i l y   ------------------------------#
+
+	timer.section('daily')
 	
-	#  Populate the output dictionary with the hourly data.  NOAA
-	#  provides seperate daytime and nighttime forecasts for each day,
-	#  we focus on the daytime forecasts
+	#  Populate the output dictionary with the grid cell's daily data,
+	#  adding the sun and moon times for this location
 	daily_data = []
-	periods = functions.getKeyValue(noaa_daily_obj, ['properties', 'periods'])
-	
-	#  Calculate UNIX Epoch timestamp for the first day in the daily
-	#  forecast array
-	d = datetime.datetime.now()
-	d = datetime.datetime.combine(datetime.date(d.year, d.month, d.day), datetime.time())
-	d = pytz.timezone(functions.getKeyValue(noaa_points_obj, ['properties', 'timeZone'])).localize(d)
-	timestamp = int(d.timestamp())
-	
-	#  Build an array to hold the daily forecasts
-	for i in range(len(periods)):
-		if _dailyEpochTime(periods[i]['startTime']) == timestamp:
-			the_sun = sun(astral_location.observer, date=datetime.datetime.utcfromtimestamp(timestamp))
-			daily_data.append({
-				'time': timestamp,
-				'summary': functions.getKeyValue(periods, [i, 'shortForecast']),
-				'icon': functions.getKeyValue(periods, [i, 'icon'], lambda x: _mapIcons(x, flask_app)),
-				'sunriseTime': round(the_sun['sunrise'].timestamp()),
-				'sunsetTime': round(the_sun['sunset'].timestamp()),
-				'moonPhase': round(moon.phase(datetime.datetime.utcfromtimestamp(timestamp)) / 27.99, 2),
-				#'precipIntensity', None,
-				#'precipIntensityMax',
-				#'precipIntensityMaxTiome',
-				'precipProbability': None,
-				#'precipType': None,
-				'temperatureHigh': None,
-				'temperatureHighTime': None,
-				'temperatureLow': None,
-				'temperatureLowTime': None,
-				'apparentTemperatureHigh': None,
-				'apparentTemperatureHighTime': None,
-				'apparentTemperatureLow': None,
-				'apparentTemperatureLowTime': None,
-				'dewPoint': None,
-				'humidity': None,
-				#'pressure': None,
-				'windSpeed': None,
-				'windGust': None,
-				'windGustTime': None,
-				'windBearing': None,
-				'cloudCover': None,
-				#'uvIndex': None,
-				#'uvIndexTime', None,
-				'visibility': None,
-				#'ozone': None,
-				'temperatureMin': None,
-				'temperatureMinTime': None,
-				'temperatureMax': None,
-				'temperatureMaxTime': None,
-				'apparentTemperatureMin': None,
-				'apparentTemperatureMinTime': None,
-				'apparentTemperatureMax': None,
-				'apparentTemperatureMaxTime': None
-			})
-			timestamp = timestamp + (3600 * 24)
-			
-	#  Fill in remaining daily data using the NOAA gridpoint forecast query
-	props = functions.getKeyValue(noaa_griddata_obj, ['properties'])
-	for i in range(len(daily_data)):
-		start = daily_data[i]['time']
-		end = start + (3600 * 24)
-
-		#  Scan through each day's temperature data and get the highs and lows
-		for value in props['temperature']['values']:
-			timestamp = functions.getKeyValue(value, ['validTime'], lambda x: functions.parseInterval(x)['start'])
-			if timestamp >= end:
-				break;
-			temp = functions.getKeyValue(value, ['value']);
-			if temp != None:
-				temp = round((temp * 9 / 5) + 32, 2)
-				if timestamp >= start and timestamp < end:
-					if not daily_data[i]['temperatureHigh'] or temp > daily_data[i]['temperatureHigh']:
-						daily_data[i]['temperatureHigh'] = temp
-						daily_data[i]['temperatureHighTime'] = timestamp
-						daily_data[i]['temperatureMax'] = temp
-						daily_data[i]['temperatureMaxTime'] = timestamp
-					if not daily_data[i]['temperatureLow'] or temp < daily_data[i]['temperatureLow']:
-						daily_data[i]['temperatureLow'] = temp
-						daily_data[i]['temperatureLowTime'] = timestamp
-						daily_data[i]['temperatureMin'] = temp
-						daily_data[i]['temperatureMinTime'] = timestamp
-		for value in props['apparentTemperature']['values']:
-			timestamp = functions.getKeyValue(value, ['validTime'], lambda x: functions.parseInterval(x)['start'])
-			if timestamp >= end:
-				break;
-			temp = functions.getKeyValue(value, ['value']);
-			if temp != None:
-				temp = round((temp * 9 / 5) + 32, 2)
-				if timestamp >= start and timestamp < end:
-					if not daily_data[i]['apparentTemperatureHigh'] or temp > daily_data[i]['apparentTemperatureHigh']:
-						daily_data[i]['apparentTemperatureHigh'] = temp
-						daily_data[i]['apparentTemperatureHighTime'] = timestamp
-						daily_data[i]['apparentTemperatureMax'] = temp
-						daily_data[i]['apparentTemperatureMaxTime'] = timestamp
-					if not daily_data[i]['apparentTemperatureLow'] or temp < daily_data[i]['apparentTemperatureLow']:
-						daily_data[i]['apparentTemperatureLow'] = temp
-						daily_data[i]['apparentTemperatureLowTime'] = timestamp
-						daily_data[i]['apparentTemperatureMin'] = temp
-						daily_data[i]['apparentTemperatureMinTime'] = timestamp
-		
-		#  Calculate the average dewpoint temperature for the day
-		total = 0;
-		total_hours = 0;
-		for value in props['dewpoint']['values']:
-			interval = functions.parseInterval(functions.getKeyValue(value, ['validTime']))
-			if interval['end'] > start and interval['start'] <= end:
-				if interval['start'] < start:
-					interval['start'] = start
-				if interval['end'] > end:
-					interval['end'] = end
-				hours = (interval['end'] - interval['start']) / 3600;
-				dp = functions.getKeyValue(value, ['value'])
-				if dp != None:
-					total = total + (dp * hours);
-					total_hours = total_hours + hours;
-		if total_hours > 0:
-			daily_data[i]['dewPoint'] = round((total / total_hours * 9 / 5) + 32, 2);
-
-		#  Calculate the average humidity for the day
-		total = 0;
-		total_hours = 0;
-		for value in props['relativeHumidity']['values']:
-			interval = functions.parseInterval(functions.getKeyValue(value, ['validTime']))
-			if interval['end'] > start and interval['start'] <= end:
-				if interval['start'] < start:
-					interval['start'] = start
-				if interval['end'] > end:
-					interval['end'] = end
-				hours = (interval['end'] - interval['start']) / 3600;
-				hum = functions.getKeyValue(value, ['value'])
-				if hum != None:
-					total = total + (hum * hours);
-					total_hours = total_hours + hours;
-		if total_hours > 0:
-			daily_data[i]['humidity'] = round(total / total_hours / 100, 2);
-
-		#  Calculate the average cloudCover percentage for the day
-		total = 0;
-		total_hours = 0;
-		for value in props['skyCover']['values']:
-			interval = functions.parseInterval(functions.getKeyValue(value, ['validTime']))
-			if interval['end'] > start and interval['start'] <= end:
-				if interval['start'] < start:
-					interval['start'] = start
-				if interval['end'] > end:
-					interval['end'] = end
-				hours = (interval['end'] - interval['start']) / 3600;
-				clo = functions.getKeyValue(value, ['value'])
-				if clo != None:
-					total = total + (clo * hours);
-					total_hours = total_hours + hours;
-		if total_hours > 0:
-			daily_data[i]['cloudCover'] = round(total / total_hours / 100, 2);
-
-		#  Calculate the average windDirection for the day
-		total = 0;
-		total_hours = 0;
-		for value in props['windDirection']['values']:
-			interval = functions.parseInterval(functions.getKeyValue(value, ['validTime']))
-			if interval['end'] > start and interval['start'] <= end:
-				if interval['start'] < start:
-					interval['start'] = start
-				if interval['end'] > end:
-					interval['end'] = end
-				hours = (interval['end'] - interval['start']) / 3600;
-				dir = functions.getKeyValue(value, ['value'])
-				if dir != None:
-					total = total + (dir * hours);
-					total_hours = total_hours + hours;
-		if total_hours > 0:
-			daily_data[i]['windBearing'] = round(total / total_hours);
-
-		#  Calculate the average windSpeed for the day
-		total = 0;
-		total_hours = 0;
-		for value in props['windSpeed']['values']:
-			interval = functions.parseInterval(functions.getKeyValue(value, ['validTime']))
-			if interval['end'] > start and interval['start'] <= end:
-				if interval['start'] < start:
-					interval['start'] = start
-				if interval['end'] > end:
-					interval['end'] = end
-				hours = (interval['end'] - interval['start']) / 3600;
-				spe = functions.getKeyValue(value, ['value'])
-				if spe != None:
-					total = total + (spe * hours);
-					total_hours = total_hours + hours;
-				total_hours = total_hours + hours;
-		if total_hours > 0:
-			daily_data[i]['windSpeed'] = round(total / total_hours * 2.23694, 2);
-
-		#  Calculate the average precipitation probability for the day
-		total = 0;
-		total_hours = 0;
-		for value in props['probabilityOfPrecipitation']['values']:
-			interval = functions.parseInterval(functions.getKeyValue(value, ['validTime']))
-			if interval['end'] > start and interval['start'] <= end:
-				if interval['start'] < start:
-					interval['start'] = start
-				if interval['end'] > end:
-					interval['end'] = end
-				hours = (interval['end'] - interval['start']) / 3600;
-				pro = functions.getKeyValue(value, ['value'])
-				if pro != None:
-					total = total + (pro * hours);
-					total_hours = total_hours + hours;
-		if total_hours > 0:
-			daily_data[i]['precipProbability'] = round(total / total_hours / 100, 2);
-
-		#  Calculate the average visibility for the day (remember that
-		#  NOAA only provides this data for the first 24 hours (2 days.)
-		total = 0;
-		total_hours = 0;
-		for value in props['visibility']['values']:
-			interval = functions.parseInterval(functions.getKeyValue(value, ['validTime']))
-			if interval['end'] > start and interval['start'] <= end:
-				if interval['start'] < start:
-					interval['start'] = start
-				if interval['end'] > end:
-					interval['end'] = end
-				hours = (interval['end'] - interval['start']) / 3600;
-				vis = functions.getKeyValue(value, ['value'])
-				if vis != None:
-					total = total + (vis * hours);
-					total_hours = total_hours + hours;
-		if total_hours > 0:
-			daily_data[i]['visibility'] = round(total / total_hours / 1609.34, 2);
-
-		#  Get the maximum windGust for the day and its associated timestamp
-		for prop in props['windGust']['values']:
-			timestamp = functions.getKeyValue(prop, ['validTime'], lambda x: functions.parseInterval(x)['start']);
-			if timestamp >= end:
-				break
-			value = functions.getKeyValue(prop, ['value'])
-			if value != None:
-				value = round(value * 2.23694, 2)
-				if timestamp >= start and timestamp < end:
-					if not daily_data[i]['windGust'] or value > daily_data[i]['windGust']:
-						daily_data[i]['windGust'] = value
-						daily_data[i]['windGustTime'] = timestamp
+	for day in (_gridpointDaily(gridpoint, location['timeZone'], flask_app) if 'daily' not in exclude and gridpoint else []):
+		day = dict(day)
+		the_sun = sun(astral_location.observer, date=datetime.datetime.utcfromtimestamp(day['time']))
+		day['sunriseTime'] = round(the_sun['sunrise'].timestamp())
+		day['sunsetTime'] = round(the_sun['sunset'].timestamp())
+		day['moonPhase'] = round(moon.phase(datetime.datetime.utcfromtimestamp(day['time'])) / 27.99, 2)
+		daily_data.append(day)
 				
 	#  Add the daily data array to the output dictionary
 	if len(daily_data) > 0:
@@ -736,6 +1381,8 @@ def get(latitude, longitude, useragent_string, flask_app=None):
 				
 	#-----------------------------   A l e r t s   -----------------------------#
 
+	timer.section('alerts')
+
 	#  Popluate the output dictionary with any alerts that pertain to
 	#  this location.
 	if noaa_alerts_obj:
@@ -745,13 +1392,13 @@ def get(latitude, longitude, useragent_string, flask_app=None):
 			for alert in alerts:
 				props = functions.getKeyValue(alert, ['properties'])
 				#  Don't include expired alerts
-				if functions.getKeyValue(props, ['expires'], lambda x: functions.parseInterval(x)['start']) > datetime.datetime.now().timestamp():
-					#  Use the noaa_county_list dictionary we built at the
-					#  beginning to convert the county IDs listed in the
+				if functions.getKeyValue(props, ['expires'], lambda x: functions.parseInterval(x)['start']) > functions.now().timestamp():
+					#  Use the names of the counties and forecast zones in
+					#  this state to convert the county IDs listed in the
 					#  alert to county names.
 					regions = []
 					for county_id in functions.getKeyValue(props, ['geocode', 'UGC']):
-						regions.append(noaa_county_list[county_id])
+						regions.append(zone_names.get(county_id, county_id))
 					#  Populate the alert data array with the data from NOAA	
 					alert_data.append({
 						'title': functions.getKeyValue(props, ['event']),
@@ -766,6 +1413,8 @@ def get(latitude, longitude, useragent_string, flask_app=None):
 			#  Add the alerts data array to the output dictionary	
 			output['alerts'] = alert_data
 	
+	timer.stop()
+
 	#  Flag the output as including data from NOAA	
 	output['flags']['sources'] = 'noaa',
 
@@ -0,0 +1,224 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""
+An asyncio version of the darksky-api web service's /forecast and
+/metrics routes, served by aiohttp.  The NOAA and Climacell calls for
+every request are made on one event loop with aiohttp, instead of in
+threads, so one process can wait on many slow upstream calls at once.
+
+The responses are built by the same code as darksky-api.py's, from the
+same caches, and are the same JSON.  The cache lookups and the
+conversion of the upstream data, which would hold up the event loop, are
+run on a small executor by DarkskyAPIFunctions.runBlocking.  The
+configuration near the top of darksky-api.py applies here too.  Run it with:
+
+    $ python darksky-api-async.py --port 5081
+
+See the README.md for additional details
+"""
+
+import argparse
+import asyncio
+import datetime
+import functools
+import importlib
+import json
+import time
+
+#  These may be available in distro packages, or may need to be
+#  installed with pip
+from aiohttp import web
+
+#  Application modules.  The Flask application's module is imported for
+#  its caches, configuration and helpers, and its Flask object is only
+#  used for logging.
+api = importlib.import_module('darksky-api')
+import NOAAWeatherAPI
+import ClimacellWeatherAPI
+import DarkskyAPIFunctions as functions
+import DarkskyAPIMetrics as metrics
+
+app = api.app
+
+#  The responses being built, as asyncio tasks keyed by response cache
+#  key, so that requests for the same location that arrive at once share
+#  one build
+_flights = {}
+
+#  The background refreshes that are running.  asyncio only keeps weak
+#  references to tasks.
+_refreshes = set()
+
+async def _buildForecast(session, latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Collect the weather information for a location from the backend data
+	services, like darksky-api.py's _buildForecast
+
+	Returns a DarkSky JSON structure or "False" if no data could be
+	obtained
+	"""
+	#  Start the Climacell calls so that they run while we collect the
+	#  NOAA data
+	climacell_fetched = ClimacellWeatherAPI.fetchAsync(session, latitude, longitude, apikey, flask_app=app, exclude=exclude)
+
+	output = await NOAAWeatherAPI.getAsync(session, latitude, longitude, api.noaa_useragent_string, flask_app=app, exclude=exclude, extend=extend)
+	output = await ClimacellWeatherAPI.getAsync(session, latitude, longitude, apikey, input_dictionary=output, flask_app=app, fetched=climacell_fetched, exclude=exclude, extend=extend)
+	return await functions.runBlocking(api._finishForecast, latitude, longitude, output, exclude, extend)
+
+async def _build(session, key, latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Build a response that a client is waiting for, within the response
+	deadline, and cache it
+	"""
+	with functions.deadline(api.response_deadline, api.section_budgets):
+		output = await _buildForecast(session, latitude, longitude, apikey, exclude, extend)
+	if output:
+		await functions.runBlocking(_cacheForecast, key, output)
+	return output
+
+def _cacheForecast(key, output):
+	"""
+	Put a response in the response cache, on a thread of the executor for
+	blocking work
+	"""
+	api.response_cache.put(key, output, api._responseExpires(output))
+
+async def _refreshForecast(session, key, latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Replace a stale response in the cache, without a deadline, while the
+	stale response is served
+	"""
+	try:
+		output = await _buildForecast(session, latitude, longitude, apikey, exclude, extend)
+		if output:
+			await functions.runBlocking(_cacheForecast, key, output)
+	except Exception:
+		app.logger.exception('Failed to refresh the cached response for {},{}'.format(latitude, longitude))
+	finally:
+		await functions.runBlocking(api.response_cache.releaseRefresh, key)
+
+async def _getForecast(session, latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Get the weather information for a location from the response cache,
+	or build it if it isn't cached, like darksky-api.py's _getForecast
+
+	Returns a (DarkSky JSON structure, cache status) tuple
+	"""
+	key = api._responseKey(latitude, longitude, apikey, exclude, extend)
+	api.prefetcher.recordRequest(key, latitude, longitude, apikey, exclude, extend)
+	#  The response cache is in memory in front of SQLite, so it is read on
+	#  another thread like the other caches
+	output, fresh = await functions.runBlocking(api.response_cache.get, key)
+	cache_status = 'HIT' if fresh else 'STALE'
+	if output is None:
+		flight = _flights.get(key)
+		if flight is None:
+			flight = asyncio.ensure_future(_build(session, key, latitude, longitude, apikey, exclude, extend))
+			_flights[key] = flight
+			flight.add_done_callback(lambda task: _flights.pop(key, None))
+		#  A client that gives up doesn't cancel the build for the others
+		output = await asyncio.shield(flight)
+		metrics.cacheLookup('response', 'miss')
+		if not output:
+			return (output, 'MISS')
+		fresh = True
+		cache_status = 'MISS'
+	else:
+		metrics.cacheLookup('response', 'hit' if fresh else 'stale')
+
+	if not fresh and await functions.runBlocking(api.response_cache.claimRefresh, key):
+		refresh = asyncio.ensure_future(_refreshForecast(session, key, latitude, longitude, apikey, exclude, extend))
+		_refreshes.add(refresh)
+		refresh.add_done_callback(_refreshes.discard)
+
+	#  The response may have been built for a nearby location, and is
+	#  shared with other requests, so return a copy with our location
+	output = dict(output)
+	output['latitude'] = latitude
+	output['longitude'] = longitude
+	return (output, cache_status)
+
+@web.middleware
+async def _timeRequest(request, handler):
+	"""
+	Record the same request metrics and timing headers as the Flask
+	application's before_request and after_request functions
+	"""
+	start_time = time.perf_counter()
+	metrics.startRequest()
+	functions.startRequest()
+	route = request.match_info.route.name or 'unknown'
+	metrics.inc('darksky_requests_in_flight', {'route': route})
+	try:
+		response = await handler(request)
+		elapsed = time.perf_counter() - start_time
+		response.headers['X-Response-Time'] = '{:.3f}ms'.format(elapsed * 1000)
+		response.headers['Server-Timing'] = metrics.serverTiming(elapsed)
+		metrics.inc('darksky_requests_total', {'route': route, 'status': str(response.status)})
+		metrics.observe('darksky_request_seconds', {'route': route}, elapsed)
+		return response
+	finally:
+		metrics.inc('darksky_requests_in_flight', {'route': route}, -1)
+
+async def forecast(request):
+	#  We will log the time it takes to process each request
+	start_timestamp = datetime.datetime.now().timestamp()
+	apikey = request.match_info['apikey']
+
+	#  Parse and verify the latitude,longitude we received
+	try:
+		latitude, longitude = api._parseGeolocation(request.match_info['geolocation'])
+	except ValueError as e:
+		return web.Response(text=str(e), status=400)
+
+	#  Read the optional DarkSky query parameters
+	exclude, extend = api._parseOptions(request.query)
+
+	#  Get the weather information, from the cache if we can
+	output, cache_status = await _getForecast(request.app['session'], latitude, longitude, apikey, exclude, extend)
+	output, cache_status = await functions.runBlocking(api._finishResponse, latitude, longitude, output, cache_status, exclude)
+	if not output:
+		#  When all else fails, return nothing
+		app.logger.warning('Failed to obtain any weather data.  Sending error message with status code = 502,')
+		elapsed_time = round((datetime.datetime.now().timestamp() - start_timestamp) * 1000)
+		app.logger.warning('Processed request in {} ms'.format(elapsed_time))
+		return web.Response(text='Failed to obtain any weather data.', status=502)
+
+	#  Send the output response
+	r = web.Response(text=await functions.runBlocking(functools.partial(json.dumps, output, indent=4)), content_type='application/json')
+	r.headers['X-Cache'] = cache_status
+	elapsed_time = round((datetime.datetime.now().timestamp() - start_timestamp) * 1000)
+	app.logger.info('Processed request in {} ms'.format(elapsed_time))
+	return r
+
+#  Metrics for all of the worker processes, in the Prometheus text format
+async def metricsEndpoint(request):
+	return web.Response(body=metrics.render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+async def _openSession(web_app):
+	web_app['session'] = functions.createAsyncSession()
+
+async def _closeSession(web_app):
+	await web_app['session'].close()
+
+def createApp():
+	"""
+	Create the aiohttp application
+
+	Returns an aiohttp.web.Application object
+	"""
+	web_app = web.Application(middlewares=[_timeRequest])
+	web_app.router.add_get('/forecast/{apikey}/{geolocation}', forecast, name='forecast')
+	web_app.router.add_get('/metrics', metricsEndpoint, name='metricsEndpoint')
+	web_app.on_startup.append(_openSession)
+	web_app.on_cleanup.append(_closeSession)
+	return web_app
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Run the asyncio darksky-api web service')
+	parser.add_argument('--host', default='0.0.0.0', help='the address to listen on')
+	parser.add_argument('--port', type=int, default=5081, help='the port to listen on')
+	args = parser.parse_args()
+	web.run_app(createApp(), host=args.host, port=args.port, access_log=None)
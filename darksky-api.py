@@ -2,22 +2,26 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-'''
+"""
 This script provides a Python Flask web service which emulates the
 DarkSky weather API, returning a JSON object that matches the output of
 the DarkSky API.  This script uses free weather data web services
 provided by NOAA and Climacell as a replacement for DarkSky.
 
 See the README.md for additional details
-'''
+"""
 
 #  See https://www.weather.gov/documentation/services-web-api for info
 #  on what NOAA wants passed through in the UserAgent header:
 noaa_useragent_string = '(David King, dave@daveking.com)'
 
+import concurrent.futures
 import datetime
+import hashlib
 import json
-import os
+import threading
+import time
+import urllib.parse
 
 #  Flask modules
 import flask
@@ -27,6 +31,73 @@ from logging.config import dictConfig
 #  Application modules
 import NOAAWeatherAPI
 import ClimacellWeatherAPI
+import DarkskyAPICache
+import DarkskyAPIFunctions as functions
+import DarkskyAPIMetrics as metrics
+import DarkskyAPIPrefetch
+
+#  Responses are cached for each Climacell API key and location.  The
+#  latitude and longitude are rounded to this many decimal places, 3
+#  places is about 100 meters, so that nearby requests share an entry.
+location_precision = 3
+
+#  NOAA updates its gridpoint forecasts about once an hour.  Climacell's
+#  current conditions and minute-by-minute forecast are only good for a
+#  few minutes.  A cached response goes stale as soon as either of these
+#  is out of date, but never sooner than response_min_ttl or later than
+#  response_max_ttl seconds after it was built.  Stale responses are
+#  served while a fresh one is built in the background.
+noaa_update_interval = 3600
+climacell_ttl = 5 * 60
+response_min_ttl = 60
+response_max_ttl = 3600
+
+response_cache = DarkskyAPICache.ResponseCache('responses')
+
+#  A client waiting for a response that isn't in the cache gets it within
+#  response_deadline seconds.  Each section of the response has its own
+#  budget within that, the alerts aren't waited for as long as the
+#  forecasts for example.  Sections that aren't ready in time are filled
+#  in from the last good response for the location, if there is one,
+#  and listed in the response's "stale" flag, or left out and listed in
+#  its "partial" flag.  Responses like these are only cached for
+#  partial_response_ttl seconds.  Cached responses are refreshed in the
+#  background without a deadline.  Set response_deadline to None to
+#  always wait for everything.
+response_deadline = 1.5
+section_budgets = {
+	'currently': 1.0,
+	'minutely': 1.0,
+	'hourly': 1.5,
+	'daily': 1.5,
+	'alerts': 0.75
+}
+partial_response_ttl = 10
+
+#  The blocks of a DarkSky response that clients can leave out with the
+#  "exclude" query parameter
+darksky_blocks = ['currently', 'minutely', 'hourly', 'daily', 'alerts', 'flags']
+
+#  When several requests for the same location arrive at once, only one
+#  of them, in any of the worker processes, builds the response
+response_flights = DarkskyAPICache.SingleFlight('responses')
+
+#  The largest number of locations that a batch request can ask for, and
+#  the number of them that are worked on at the same time
+batch_max_locations = 100
+batch_workers = 8
+
+#  The responses for the locations that are requested most often are
+#  built ahead of time, see DarkskyAPIPrefetch.py.  These locations are
+#  always prefetched too.  Each entry is a (latitude, longitude, Climacell
+#  API key) tuple, with an optional fourth member holding the query
+#  string that the location is requested with, e.g. "exclude=minutely".
+prefetch_locations = []
+
+#  The last good response for each location, rounded as above, is kept
+#  for those occasions when we are completely unable to read any of the
+#  backend data services
+last_known_good = DarkskyAPICache.LastKnownGoodStore('last_known_good')
 
 #  Configure application logging
 dictConfig({
@@ -50,64 +121,514 @@ dictConfig({
 #  Initialize the app and set its name
 app = flask.Flask(__name__)
 
-#  Define the route and the routehandler function
-@app.route('/forecast/<apikey>/<geolocation>')
-def forecast(apikey, geolocation):
-	#  We will log the time it takes to process each request
-	start_timestamp = datetime.datetime.now().timestamp()
-	
-	#  Parse and verify the latitude,longitude we received
+def _responseKey(latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Return the response cache key for a location, API key and set of
+	query parameters.  The API key is hashed so that it isn't written
+	into the cache.
+	"""
+	key = '{:.{precision}f},{:.{precision}f},{}'.format(latitude, longitude, hashlib.sha256(apikey.encode()).hexdigest()[:16], precision=location_precision)
+	if exclude:
+		key = key + ',exclude=' + ','.join(exclude)
+	if extend:
+		key = key + ',extend=' + extend
+	return key
+
+def _parseOptions(args):
+	"""
+	Read DarkSky's "exclude" and "extend" query parameters.  Like DarkSky,
+	we ignore block names that we don't recognize.
+
+	args: the request's query parameters
+
+	Returns an (exclude, extend) tuple where exclude is a sorted tuple of
+	block names and extend is "hourly" or None
+	"""
+	exclude = set()
+	for block in args.get('exclude', '').split(','):
+		block = block.strip().lower()
+		if block in darksky_blocks:
+			exclude.add(block)
+	extend = 'hourly' if args.get('extend', '').strip().lower() == 'hourly' else None
+	return (tuple(sorted(exclude)), extend)
+
+def _locationKey(latitude, longitude):
+	"""
+	Return the last known good store key for a location
+	"""
+	return '{:.{precision}f},{:.{precision}f}'.format(latitude, longitude, precision=location_precision)
+
+def _responseExpires(output):
+	"""
+	Work out when a response goes stale from the ages of the NOAA and
+	Climacell data in it
+
+	Returns a UNIX timestamp
+	"""
+	now = datetime.datetime.now().timestamp()
+	if functions.getKeyValue(output, ['flags', 'partial']) or functions.getKeyValue(output, ['flags', 'stale']):
+		return now + partial_response_ttl
+	expires = [now + response_max_ttl]
+	noaa_update_time = functions.getKeyValue(output, ['flags', 'noaa-update-time'])
+	if noaa_update_time:
+		expires.append(noaa_update_time + noaa_update_interval)
+	if 'climacell' in (functions.getKeyValue(output, ['flags', 'sources']) or []):
+		observation_time = functions.getKeyValue(output, ['currently', 'time'])
+		expires.append((observation_time or now) + climacell_ttl)
+	return max(now + response_min_ttl, min(expires))
+
+def _fillFromLastKnownGood(latitude, longitude, output):
+	"""
+	Fill in the sections of a response that are listed in its "partial"
+	flag, and are empty, from the last good response for the location.
+	The sections that are filled in are moved to the "stale" flag.  Data
+	that has gone out of date, like hours that have passed, is left out.
+	"""
+	partial = functions.getKeyValue(output, ['flags', 'partial'])
+	if not partial:
+		return
+	last_good = last_known_good.get(_locationKey(latitude, longitude))
+	if not last_good:
+		return
+	now = datetime.datetime.now().timestamp()
+	stale = []
+	for section in list(partial):
+		if section == 'currently':
+			if output.get('currently') or not last_good.get('currently'):
+				continue
+			output['currently'] = last_good['currently']
+		elif section == 'alerts':
+			#  The alerts key is removed when there aren't any
+			output['alerts'] = [alert for alert in last_good.get('alerts', []) if (alert.get('expires') or 0) > now]
+		else:
+			if functions.getKeyValue(output, [section, 'data']) or section not in last_good:
+				continue
+			period = {'minutely': 60, 'hourly': 3600, 'daily': 86400}[section]
+			data = [item for item in (functions.getKeyValue(last_good, [section, 'data']) or []) if item['time'] + period > now]
+			if not data:
+				continue
+			output[section] = dict(last_good[section], data=data)
+		partial.remove(section)
+		stale.append(section)
+	if stale:
+		output['flags']['stale'] = stale
+	if not partial:
+		del output['flags']['partial']
+
+def _buildForecast(latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Collect the weather information for a location from the backend data
+	services.  The backend calls that are only needed for excluded blocks
+	are skipped.
+
+	Returns a DarkSky JSON structure or "False" if no data could be
+	obtained
+	"""
+	#  Start the Climacell calls so that they run while we collect the
+	#  NOAA data
+	climacell_fetched = ClimacellWeatherAPI.fetch(latitude, longitude, apikey, flask_app=app, exclude=exclude)
+
+	#  Get the weather information that NOAA is able to provide
+	output = NOAAWeatherAPI.get(latitude, longitude, noaa_useragent_string, flask_app=app, exclude=exclude, extend=extend)
+
+	#  Enhance the output with weather information from climacell
+	output = ClimacellWeatherAPI.get(latitude, longitude, apikey, input_dictionary=output, flask_app=app, fetched=climacell_fetched, exclude=exclude, extend=extend)
+	return _finishForecast(latitude, longitude, output, exclude, extend)
+
+def _finishForecast(latitude, longitude, output, exclude=(), extend=None):
+	"""
+	Finish a response built from the backend data services, and keep a
+	copy of it if it is complete
+
+	Returns the response
+	"""
+	if output:
+		#  Use the last good response for the sections that we couldn't
+		#  get in time
+		_fillFromLastKnownGood(latitude, longitude, output)
+		#  If there are no alerts in the output, remove the alerts key
+		if 'alerts' in output:
+			if len(output['alerts']) == 0:
+				del output['alerts']
+		#  Keep a copy of the output in the last known good store, as long
+		#  as it is complete
+		if not exclude and not extend and 'partial' not in output['flags'] and 'stale' not in output['flags']:
+			last_known_good.put(_locationKey(latitude, longitude), output)
+	return output
+
+def _refreshForecast(key, latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Replace a stale response in the cache.  This runs in a background
+	thread while the stale response is served.
+	"""
+	try:
+		output = _buildForecast(latitude, longitude, apikey, exclude, extend)
+		if output:
+			response_cache.put(key, output, _responseExpires(output))
+	except:
+		app.logger.exception('Failed to refresh the cached response for {},{}'.format(latitude, longitude))
+	finally:
+		response_cache.releaseRefresh(key)
+
+def _prefetchForecast(latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Build a response for the prefetcher, without a deadline
+
+	Returns a (DarkSky JSON structure, expiration time) tuple
+	"""
+	output = _buildForecast(latitude, longitude, apikey, exclude, extend)
+	return (output, _responseExpires(output) if output else None)
+
+prefetcher = DarkskyAPIPrefetch.Prefetcher('prefetch', _prefetchForecast, response_cache)
+
+def _addPrefetchLocation(latitude, longitude, apikey, query=''):
+	"""
+	Have the prefetcher always prefetch one of the prefetch_locations
+	"""
+	exclude, extend = _parseOptions(dict(urllib.parse.parse_qsl(query)))
+	prefetcher.add(_responseKey(latitude, longitude, apikey, exclude, extend), latitude, longitude, apikey, exclude, extend)
+
+for prefetch_location in prefetch_locations:
+	_addPrefetchLocation(*prefetch_location)
+
+def _getForecast(latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Get the weather information for a location from the response cache,
+	or build it if it isn't cached.  If the cached response is stale it
+	is returned anyway and one fresh response is built in the background.
+
+	Returns a (DarkSky JSON structure, cache status) tuple where the
+	status is "HIT", "STALE" or "MISS".  The JSON structure is "False" if
+	no data could be obtained.
+	"""
+	key = _responseKey(latitude, longitude, apikey, exclude, extend)
+	prefetcher.recordRequest(key, latitude, longitude, apikey, exclude, extend)
+	output, fresh = response_cache.get(key)
+	cache_status = 'HIT' if fresh else 'STALE'
+	if output is None:
+		def build():
+			#  The client is waiting for this one
+			with functions.deadline(response_deadline, section_budgets):
+				output = _buildForecast(latitude, longitude, apikey, exclude, extend)
+			if output:
+				response_cache.put(key, output, _responseExpires(output))
+			return output
+		def check():
+			output, fresh = response_cache.get(key)
+			return output
+		output = response_flights.do(key, build, check)
+		metrics.cacheLookup('response', 'miss')
+		if not output:
+			return (output, 'MISS')
+		fresh = True
+		cache_status = 'MISS'
+	else:
+		metrics.cacheLookup('response', 'hit' if fresh else 'stale')
+
+	if not fresh and response_cache.claimRefresh(key):
+		threading.Thread(target=_refreshForecast, args=(key, latitude, longitude, apikey, exclude, extend), daemon=True).start()
+
+	#  The response may have been built for a nearby location, and is
+	#  shared with other requests, so return a copy with our location
+	output = dict(output)
+	output['latitude'] = latitude
+	output['longitude'] = longitude
+	return (output, cache_status)
+
+def _parseGeolocation(geolocation):
+	"""
+	Parse and verify a "latitude,longitude" string
+
+	Returns a (latitude, longitude) tuple.  Raises ValueError, with a
+	message for the client, if the location isn't valid.
+	"""
 	gsplit = geolocation.split(',')
 	if len(gsplit) != 2:
 		app.logger.error('Unable to split the request latitude,longitude')
-		return 'URL must include a valid latitude,longitude', 400
+		raise ValueError('URL must include a valid latitude,longitude')
 	try:
 		latitude = float(gsplit[0])
 		longitude = float(gsplit[1])
 	except:
 		app.logger.error('Latitude,longitude are not valid floating point numbers')
-		return 'URL must include a valid latitude,longitude', 400
+		raise ValueError('URL must include a valid latitude,longitude')
 	if latitude > 65 or latitude < 19:
 		app.logger.error('Request latitude, {}, was not between 19 and 65'.format(latitude))
-		return 'URL must include a valid latitude,longitude for a location in the USA', 400
+		raise ValueError('URL must include a valid latitude,longitude for a location in the USA')
 	if longitude > -67 or longitude < -162:
 		app.logger.error('Request longitude, {}, was not between -162 and -67'.format(longitude))
-		return 'URL must include a valid latitude,longitude for a location in the USA', 400
-		
-	#  Get the weather information that NOAA is able to provide
-	output = NOAAWeatherAPI.get(latitude, longitude, noaa_useragent_string, flask_app=app)
-	
-	#  Enhance the output with weather information from climacell
-	output = ClimacellWeatherAPI.get(latitude, longitude, apikey, input_dictionary=output, flask_app=app)
+		raise ValueError('URL must include a valid latitude,longitude for a location in the USA')
+	return (latitude, longitude)
+
+def _getResponse(latitude, longitude, apikey, exclude=(), extend=None):
+	"""
+	Get the response for a location, falling back to the last good
+	response for the location if no data could be obtained, and leave out
+	the blocks that the client excluded
+
+	Returns a (DarkSky JSON structure, cache status) tuple.  The JSON
+	structure is "False" if there was no data at all.
+	"""
+	#  Get the weather information, from the cache if we can
+	output, cache_status = _getForecast(latitude, longitude, apikey, exclude, extend)
+	return _finishResponse(latitude, longitude, output, cache_status, exclude)
+
+def _finishResponse(latitude, longitude, output, cache_status, exclude=()):
+	"""
+	Fall back to the last good response for a location if no data could
+	be obtained, and leave out the blocks that the client excluded
+
+	Returns a (DarkSky JSON structure, cache status) tuple
+	"""
+	if not output:
+		#  We got no output from the backend data services, use the last
+		#  good response for this location, if there is one
+		output = last_known_good.get(_locationKey(latitude, longitude))
+		if output:
+			app.logger.warning('Failed to obtain any weather data.  Sending the last good response for this location.')
+			metrics.inc('darksky_fallback_responses_total')
+			output = dict(output)
+			output['latitude'] = latitude
+			output['longitude'] = longitude
+			cache_status = 'FALLBACK'
+	if not output:
+		return (False, cache_status)
+
+	#  Leave out the blocks that the client excluded
+	for block in exclude:
+		output.pop(block, None)
+	return (output, cache_status)
+
+def _collectExecutorStats():
+	"""
+	Copy the state of the shared upstream executor into the metrics
+	"""
+	stats = functions.executorStats()
+	for state in ['queued', 'running']:
+		metrics.setGauge('darksky_executor_tasks', {'state': state}, stats[state])
+	for host, upstream in stats['upstreams'].items():
+		for state in ['active', 'waiting']:
+			metrics.setGauge('darksky_upstream_calls_in_flight', {'host': host, 'state': state}, upstream[state])
+
+metrics.addCollector(_collectExecutorStats)
+
+@app.before_request
+def _startRequest():
+	flask.g.start_time = time.perf_counter()
+	metrics.startRequest()
+	functions.startRequest()
+	metrics.inc('darksky_requests_in_flight', {'route': flask.request.endpoint or 'unknown'})
+
+@app.after_request
+def _finishRequest(response):
+	#  Report the time taken to the client, in milliseconds, and record
+	#  it in the metrics
+	elapsed = time.perf_counter() - flask.g.start_time
+	response.headers['X-Response-Time'] = '{:.3f}ms'.format(elapsed * 1000)
+	response.headers['Server-Timing'] = metrics.serverTiming(elapsed)
+	route = flask.request.endpoint or 'unknown'
+	metrics.inc('darksky_requests_total', {'route': route, 'status': str(response.status_code)})
+	metrics.observe('darksky_request_seconds', {'route': route}, elapsed)
+	return response
+
+@app.teardown_request
+def _endRequest(exception):
+	metrics.inc('darksky_requests_in_flight', {'route': flask.request.endpoint or 'unknown'}, -1)
+
+#  Define the route and the routehandler function
+@app.route('/forecast/<apikey>/<geolocation>')
+def forecast(apikey, geolocation):
+	#  We will log the time it takes to process each request
+	start_timestamp = datetime.datetime.now().timestamp()
 	
-	#  Keep a cached copy of the output for those occasions when we are
-	#  completely unable to read any of the backend data services
-	cached_copy_filename = 'darksky-api.cached_output'
-	if output:
-		#  If there are no alerts in the output, remove the alerts key
-		if 'alerts' in output:
-			if len(output['alerts']) == 0:
-				del output['alerts']
-		#  Cache a copy of the output
-		with open(cached_copy_filename, 'w') as f:
-			json.dump(output, f)
-	elif os.path.exists(cached_copy_filename):
-		#  We got no output from the backend data services, read in the
-		#  cached file, if it exists
-		with open(cached_copy_filename, 'r') as f:
-			output = json.load(f)
-	else:
+	#  Parse and verify the latitude,longitude we received
+	try:
+		latitude, longitude = _parseGeolocation(geolocation)
+	except ValueError as e:
+		return str(e), 400
+		
+	#  Read the optional DarkSky query parameters
+	exclude, extend = _parseOptions(flask.request.args)
+
+	#  Get the weather information, from the cache if we can
+	output, cache_status = _getResponse(latitude, longitude, apikey, exclude, extend)
+	if not output:
 		#  When all else fails, return nothing
 		app.logger.warning('Failed to obtain any weather data.  Sending error message with status code = 502,')
-		elapsed_time = round(datetime.datetime.now().timestamp() - start_timestamp)
-		app.logger.warning('Processed request in {} seconds'.format(elapsed_time))
+		elapsed_time = round((datetime.datetime.now().timestamp() - start_timestamp) * 1000)
+		app.logger.warning('Processed request in {} ms'.format(elapsed_time))
 		return 'Failed to obtain any weather data.', 502
 	
 	#  Send the output response
 	output = json.dumps(output, indent=4)
 	r = flask.Response(output)
-	elapsed_time = round(datetime.datetime.now().timestamp() - start_timestamp)
-	r.headers['X-Response-Time'] = elapsed_time
-	app.logger.info('Processed request in {} seconds'.format(elapsed_time))
+	elapsed_time = round((datetime.datetime.now().timestamp() - start_timestamp) * 1000)
+	r.headers['X-Cache'] = cache_status
+	app.logger.info('Processed request in {} ms'.format(elapsed_time))
 	r.headers['Content-Type'] = 'application/json'
 	return r
+
+def _batchItem(latitude, longitude, apikey, exclude, extend):
+	"""
+	Get the response for one location in a batch.  Errors are returned as
+	part of the batch rather than failing the whole request.
+
+	Returns a DarkSky JSON structure or a dictionary with an "error" key
+	"""
+	#  Each location gets the retry budget of a request of its own
+	functions.startRequest()
+	try:
+		output, cache_status = _getResponse(latitude, longitude, apikey, exclude, extend)
+	except:
+		app.logger.exception('Failed to build the response for {},{} in a batch'.format(latitude, longitude))
+		output = False
+	if not output:
+		return {'latitude': latitude, 'longitude': longitude, 'error': 'Failed to obtain any weather data.'}
+	return output
+
+def _batchFollower(future, latitude, longitude, apikey, exclude, extend):
+	"""
+	Get the response for a location that isn't the first in its grid cell
+	and give it to the future that _batchResponses waits on
+	"""
+	try:
+		future.set_result(_batchItem(latitude, longitude, apikey, exclude, extend))
+	except BaseException as e:
+		future.set_exception(e)
+
+def _startFollowers(executor, followers, apikey, exclude, extend):
+	"""
+	Start on the other locations in a grid cell once the first one is
+	done, so that they share its forecasts.  They aren't submitted before
+	then so that no worker sits waiting for another location.
+
+	followers: a list of ((latitude, longitude), concurrent.futures.Future)
+	           tuples, one for each of the other locations
+
+	Returns a function to add as a done callback of the first location
+	"""
+	def start(leader):
+		for location, future in followers:
+			try:
+				executor.submit(_batchFollower, future, *location, apikey, exclude, extend)
+			except RuntimeError as e:
+				#  The batch was given up on and the executor shut down
+				future.set_exception(e)
+	return start
+
+def _batchGridCell(latitude, longitude):
+	"""
+	Look up the NOAA grid cell of a location in a batch.  A failed lookup
+	only costs the location its place in a group.
+
+	Returns the grid cell, or None if it couldn't be found
+	"""
+	try:
+		return NOAAWeatherAPI.getGridCell(latitude, longitude, noaa_useragent_string, flask_app=app)
+	except:
+		app.logger.exception('Failed to find the grid cell for {},{} in a batch'.format(latitude, longitude))
+		return None
+
+def _batchResponses(locations, apikey, exclude, extend):
+	"""
+	Get the responses for the locations in a batch.  Repeated locations
+	are only looked up once.  The locations are grouped by NOAA grid cell
+	and the first location in each cell is done before the others, which
+	then share its forecasts.  The cells are all worked on at once.
+
+	locations: a list of (latitude, longitude) tuples, or of dictionaries
+	           holding the error messages for locations that weren't
+	           valid
+
+	Yields the responses, in the same order as the locations
+	"""
+	with concurrent.futures.ThreadPoolExecutor(max_workers=batch_workers) as executor:
+		keys = {}
+		for location in locations:
+			if isinstance(location, tuple):
+				keys.setdefault(_responseKey(location[0], location[1], apikey, exclude, extend), location)
+		cells = {}
+		for key, cell in zip(keys, executor.map(lambda location: _batchGridCell(*location), keys.values())):
+			#  Locations that NOAA doesn't know, or whose lookup failed, are
+			#  each their own group
+			cells.setdefault(cell or key, []).append(key)
+
+		results = {}
+		for cell_keys in cells.values():
+			for key in cell_keys[1:]:
+				results[key] = concurrent.futures.Future()
+			leader = executor.submit(_batchItem, *keys[cell_keys[0]], apikey, exclude, extend)
+			results[cell_keys[0]] = leader
+			if len(cell_keys) > 1:
+				leader.add_done_callback(_startFollowers(executor, [(keys[key], results[key]) for key in cell_keys[1:]], apikey, exclude, extend))
+
+		for location in locations:
+			if not isinstance(location, tuple):
+				yield location
+				continue
+			output = results[_responseKey(location[0], location[1], apikey, exclude, extend)].result()
+			if 'error' not in output and (output['latitude'], output['longitude']) != location:
+				#  A repeated location shares the first one's response
+				output = dict(output)
+				output['latitude'] = location[0]
+				output['longitude'] = location[1]
+			yield output
+
+#  Batch requests list their locations in the URL, seperated by
+#  semicolons, or POST them as a JSON array of "latitude,longitude"
+#  strings, [latitude, longitude] arrays or objects with "latitude" and
+#  "longitude" keys
+@app.route('/batch/<apikey>', methods=['POST'])
+@app.route('/batch/<apikey>/<geolocations>')
+def batch(apikey, geolocations=None):
+	if geolocations is not None:
+		requested = geolocations.split(';')
+	else:
+		requested = flask.request.get_json(silent=True)
+		if not isinstance(requested, list):
+			app.logger.error('Batch request body was not a JSON array')
+			return 'Request body must be a JSON array of locations', 400
+	if len(requested) > batch_max_locations:
+		app.logger.error('Batch request asked for {} locations'.format(len(requested)))
+		return 'A batch may include at most {} locations'.format(batch_max_locations), 400
+
+	#  Parse and verify each location.  Invalid locations get an error
+	#  message in the output instead of a response.
+	locations = []
+	for item in requested:
+		if isinstance(item, dict):
+			item = '{},{}'.format(item.get('latitude'), item.get('longitude'))
+		elif isinstance(item, list):
+			item = ','.join(str(x) for x in item)
+		try:
+			locations.append(_parseGeolocation(str(item)))
+		except ValueError as e:
+			locations.append({'location': str(item), 'error': str(e)})
+
+	#  Read the optional DarkSky query parameters, which apply to every
+	#  location
+	exclude, extend = _parseOptions(flask.request.args)
+
+	#  The responses are sent as they are ready, either as a JSON array or
+	#  as newline delimited JSON if the client asked for it
+	ndjson = flask.request.args.get('format') == 'ndjson' or 'application/x-ndjson' in flask.request.headers.get('Accept', '')
+	def generate():
+		start_timestamp = datetime.datetime.now().timestamp()
+		first = True
+		for output in _batchResponses(locations, apikey, exclude, extend):
+			if ndjson:
+				yield json.dumps(output) + '\n'
+			else:
+				yield ('[\n' if first else ',\n') + json.dumps(output, indent=4)
+			first = False
+		if not ndjson:
+			yield '[]' if first else '\n]'
+		elapsed_time = round((datetime.datetime.now().timestamp() - start_timestamp) * 1000)
+		app.logger.info('Processed batch request for {} locations in {} ms'.format(len(locations), elapsed_time))
+
+	return flask.Response(generate(), content_type='application/x-ndjson' if ndjson else 'application/json')
+
+#  Metrics for all of the worker processes, in the Prometheus text format
+@app.route('/metrics')
+def metricsEndpoint():
+	return flask.Response(metrics.render(), content_type='text/plain; version=0.0.4')
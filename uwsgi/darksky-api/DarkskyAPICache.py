@@ -0,0 +1 @@
+../../DarkskyAPICache.py
\ No newline at end of file
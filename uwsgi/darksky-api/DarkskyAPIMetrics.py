@@ -0,0 +1 @@
+../../DarkskyAPIMetrics.py
\ No newline at end of file
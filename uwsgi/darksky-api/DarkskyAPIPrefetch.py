@@ -0,0 +1 @@
+../../DarkskyAPIPrefetch.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../DarkskyAPIStationIndex.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../darksky-api-async.py
\ No newline at end of file